@@ -0,0 +1,106 @@
+import threading
+import numpy as np
+import pandas as pd
+
+WEEKDAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+NANOSECONDS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+
+# Dictionary-encoded categories ("codes" into "categories") as the dense codes and sorted names pd.factorize(sort=True)
+# would give for the decoded column; only the dictionary is sorted, never the rows
+def dictionary_codes(codes, categories):
+    used = np.flatnonzero(np.bincount(codes, minlength=len(categories)))
+    names, dense = np.unique(np.asarray(categories, dtype=object)[used], return_inverse=True)
+    recode = np.full(len(categories), -1, dtype=np.intp)
+    recode[used] = dense
+    return recode[codes], pd.Index(names, dtype=object)
+
+
+# Everything the analysis functions derive from an expense frame, computed once per request:
+# integer date parts, interned category codes and memoized per-category / per-month aggregates
+# Codes and sorted category names that are already known (e.g. shared by another process) can be passed in
+class AnalysisContext:
+    def __init__(self, expenses, category_codes=None, categories=None):
+        self.expenses = expenses
+        self.size = len(expenses)
+        self.amounts = expenses['amount'].to_numpy(dtype=float)
+
+        # Dates as integers: nanoseconds, days and months since 1970 (cheap datetime64 casts instead of .dt accessors)
+        dates = expenses['date'].to_numpy(dtype='datetime64[ns]')
+        days = dates.astype('datetime64[D]')
+        months = days.astype('datetime64[M]')
+        self.timestamps = dates.view(np.int64)
+        self.day_keys = days.view(np.int64)
+        self.month_keys = months.view(np.int64)
+        self.year = self.month_keys // 12 + 1970
+        self.month = self.month_keys % 12 + 1
+        self.day = (days - months).astype(np.int64) + 1
+        self.weekday = (self.day_keys + 4) % 7  # 0 = Sunday (1970-01-01 was a Thursday)
+
+        # Categories interned once: sorted names plus one int code per row (-1 for a missing category)
+        if category_codes is not None:
+            self.category_codes, self.categories = category_codes, categories
+        elif 'category' in expenses:
+            self.category_codes, self.categories = pd.factorize(expenses['category'], sort=True)
+        else:
+            self.category_codes, self.categories = np.full(self.size, -1, dtype=np.intp), pd.Index([])
+        self._memo = {}
+        self._memo_lock = threading.RLock()
+
+    # Stages running in parallel share the context, so each aggregate is computed by the first caller only
+    def _memoized(self, name, compute):
+        with self._memo_lock:
+            if name not in self._memo:
+                self._memo[name] = compute()
+            return self._memo[name]
+
+    # Amounts of the rows that have a category, grouped by category code (integer keys, no string hashing)
+    def _by_category(self, *keys):
+        valid = self.category_codes >= 0
+        return pd.Series(self.amounts[valid]).groupby([self.category_codes[valid]] + [key[valid] for key in keys])
+
+    def _category_groups(self):
+        return self._memoized('category_groups', self._by_category)
+
+    def _named(self, values):
+        return pd.Series(values.to_numpy(), index=pd.Index(self.categories[values.index], name='category'), name='amount')
+
+    def category_sums(self):
+        return self._memoized('category_sums', lambda: self._named(self._category_groups().sum()))
+
+    def category_counts(self):
+        return self._memoized('category_counts', lambda: self._named(self._category_groups().size()))
+
+    def category_stds(self):
+        return self._memoized('category_stds', lambda: self._named(self._category_groups().std()))
+
+    # Total spending per calendar month, indexed by months since 1970
+    def monthly_sums(self):
+        return self._memoized('monthly_sums', lambda: pd.Series(self.amounts).groupby(self.month_keys).sum())
+
+    # One row per category, one column per month (months since 1970), NaN where the category had no spending
+    def category_monthly_sums(self):
+        def compute():
+            sums = self._by_category(self.month_keys).sum().unstack().sort_index(axis=1)
+            sums.index = pd.Index(self.categories[sums.index], name='category')
+            return sums
+        return self._memoized('category_monthly_sums', compute)
+
+    # (year, month) of the latest expense
+    def last_month(self):
+        last = int(self.month_keys.max())
+        return last // 12 + 1970, last % 12 + 1
+
+    def month_span(self):
+        if self.size == 0:
+            return 0
+        return int(self.month_keys.max() - self.month_keys.min() + 1)
+
+    # Whole days between the first and the last expense
+    def elapsed_days(self):
+        return int((self.timestamps.max() - self.timestamps.min()) // NANOSECONDS_PER_DAY)
+
+    # Days in the longest calendar month the expenses fall in
+    def days_in_month(self):
+        months = np.unique(self.month_keys).astype('datetime64[M]')
+        return int(((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64).max())
@@ -0,0 +1,115 @@
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+import pandas as pd
+
+from columnar import expenses_frame
+
+
+# Raised when a delta can't be applied to the cached state (no state, another month, unknown expense);
+# the caller then has to send a full /analysis
+class StaleAnalysisState(Exception):
+    pass
+
+
+def _month_key(dates):
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+
+# What a full analysis of a user's current month leaves behind for /analysis/delta: the month's expenses, the request
+# fields, the outputs that only depend on the history (forecasts, limits) and the user's spend index, plus the daily
+# category baskets (row counts per (date, category)) so an unchanged basket set reuses the association rules
+class AnalysisState:
+    def __init__(self, expenses, categories, monthly_budget, goal_amount, total_spent, history_values, history_sizes,
+                 spend_index, degraded_stages, association_rules=None):
+        self.expenses = expenses
+        self.categories = categories
+        self.monthly_budget = monthly_budget
+        self.goal_amount = goal_amount
+        self.total_spent = total_spent
+        self.history_values = history_values
+        self.history_sizes = history_sizes
+        self.spend_index = spend_index
+        self.degraded_stages = degraded_stages
+        self.month_key = int(_month_key(expenses['date']).max())
+        self.baskets = Counter(zip(expenses['date'].to_numpy(dtype='datetime64[ns]').view(np.int64).tolist(), expenses['category'].tolist()))
+        # (min_support, rules) of the last full-mode association rule mining
+        self.association_rules = association_rules
+        # Result cache key of the full analysis this state still matches (set by the route, cleared by a delta)
+        self.source = None
+        self.lock = threading.Lock()
+
+    # The month's expenses with one expense added and/or one removed, and whether the set of daily baskets changed;
+    # nothing is modified until commit()
+    def apply(self, added=None, deleted=None):
+        expenses = self.expenses
+        baskets = Counter(self.baskets)
+        total_spent = self.total_spent
+
+        if deleted is not None:
+            row = expenses_frame([deleted]).iloc[0]
+            matches = np.flatnonzero(
+                (expenses['date'].to_numpy(dtype='datetime64[ns]') == row['date'].to_datetime64())
+                & (expenses['amount'].to_numpy(dtype=float) == float(row['amount']))
+                & (expenses['category'].to_numpy() == row['category'])
+            )
+            if len(matches) == 0:
+                raise StaleAnalysisState("The deleted expense is not part of the cached analysis")
+            expenses = expenses.drop(index=expenses.index[matches[0]]).reset_index(drop=True)
+            key = (row['date'].value, row['category'])
+            baskets[key] -= 1
+            if baskets[key] == 0:
+                del baskets[key]
+            total_spent -= float(row['amount'])
+
+        if added is not None:
+            frame = expenses_frame([added])
+            if int(_month_key(frame['date'])[0]) != self.month_key:
+                raise StaleAnalysisState("The expense is not in the month of the cached analysis")
+            expenses = pd.concat([expenses, frame], ignore_index=True)
+            baskets[(frame['date'].iloc[0].value, frame['category'].iloc[0])] += 1
+            total_spent += float(frame['amount'].iloc[0])
+
+        if len(expenses) == 0:
+            raise StaleAnalysisState("No expenses are left in the cached month")
+        return expenses, baskets, total_spent, baskets.keys() != self.baskets.keys()
+
+    def commit(self, expenses, baskets, total_spent, association_rules):
+        self.expenses = expenses
+        self.baskets = baskets
+        self.total_spent = total_spent
+        self.association_rules = association_rules
+        self.source = None
+
+
+# Bounded LRU of per-user analysis states (per process, like the spend indexes)
+class AnalysisStates:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def save(self, user, state):
+        with self.lock:
+            self.states[user] = state
+            self.states.move_to_end(user)
+            while len(self.states) > max(self.max_entries, 1):
+                self.states.popitem(last=False)
+
+    def get(self, user):
+        with self.lock:
+            state = self.states.get(user)
+            if state is not None:
+                self.states.move_to_end(user)
+            return state
+
+    def invalidate(self, user=None):
+        with self.lock:
+            if user is None:
+                removed = len(self.states)
+                self.states.clear()
+                return removed
+            return 1 if self.states.pop(user, None) is not None else 0
+
+    def __len__(self):
+        return len(self.states)
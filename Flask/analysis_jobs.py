@@ -0,0 +1,174 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import JOB_SECONDS
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+# Runs in the worker process: the job function plus when it actually started and finished there
+def _timed_call(func, payload):
+    started = time.time()
+    result = func(payload)
+    return result, started, time.time()
+
+
+# Bounded queue of analysis jobs executed by a local process pool (no broker): submit returns an id right away,
+# the job's status, timings and result are polled with "status", and finished jobs are forgotten after "ttl" seconds
+# "func" must be a module-level function so that worker processes can import it
+class AnalysisJobs:
+    def __init__(self, func, max_workers=2, max_queued=64, ttl=600, start_method='spawn', on_done=None, clock=time.time):
+        self.func = func
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.start_method = start_method
+        self.on_done = on_done
+        self.clock = clock
+        self.jobs = {}
+        self.futures = {}
+        self.pool = None
+        self.lock = threading.Lock()
+        self.totals = {state: 0 for state in ('done', 'failed', 'cancelled')}
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.start_method))
+        return self.pool
+
+    # A queued job whose future was handed to a worker process is reported as running
+    def _state(self, job_id, job):
+        future = self.futures.get(job_id)
+        return 'running' if job['status'] == 'queued' and future is not None and future.running() else job['status']
+
+    # Jobs holding a queue slot: queued, running, and cancelled while running ("cancelling": the worker is still busy)
+    def _pending(self):
+        return sum(1 for job in self.jobs.values() if job['status'] in ('queued', 'cancelling'))
+
+    def _expire(self, now):
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['finished_at'] is not None and job['finished_at'] + self.ttl <= now]:
+            del self.jobs[job_id]
+            self.futures.pop(job_id, None)
+
+    # Queue a payload; "result" records an already known result (e.g. from the result cache) as a finished job
+    def submit(self, payload, result=None, context=None):
+        now = self.clock()
+        job_id = uuid.uuid4().hex
+        job = {
+            'job_id': job_id, 'status': 'queued', 'submitted_at': now, 'started_at': None, 'finished_at': None,
+            'result': None, 'error': None, 'context': context,
+        }
+
+        with self.lock:
+            self._expire(now)
+            if result is not None:
+                job.update(status='done', started_at=now, finished_at=now, result=result)
+                self.jobs[job_id] = job
+                self.totals['done'] += 1
+                return job_id
+
+            if self._pending() >= self.max_queued:
+                raise JobQueueFull(f"{self.max_queued} analysis jobs are already queued or running")
+
+            try:
+                future = self._get_pool().submit(_timed_call, self.func, payload)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool for this and later jobs
+                self.pool = None
+                future = self._get_pool().submit(_timed_call, self.func, payload)
+            self.jobs[job_id] = job
+            self.futures[job_id] = future
+
+        future.add_done_callback(lambda future: self._finish(job_id, future))
+        return job_id
+
+    def _finish(self, job_id, future):
+        now = self.clock()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+
+            # A job cancelled while running is finished now; its result is discarded
+            if future.cancelled() or job['status'] == 'cancelling':
+                job.update(status='cancelled', finished_at=now)
+            elif future.exception() is not None:
+                job.update(status='failed', finished_at=now, error=f"{type(future.exception()).__name__}: {future.exception()}")
+            else:
+                result, started, finished = future.result()
+                job.update(status='done', started_at=started, finished_at=finished, result=result)
+                JOB_SECONDS.observe('queued', max(started - job['submitted_at'], 0))
+                JOB_SECONDS.observe('running', finished - started)
+            self.totals[job['status']] += 1
+            self.futures.pop(job_id, None)
+
+        if job['status'] == 'done' and self.on_done is not None:
+            self.on_done(job['result'], job['context'])
+
+    # Public view of a job: status, timings in seconds and the result or error once finished (None for unknown ids)
+    def status(self, job_id):
+        now = self.clock()
+        with self.lock:
+            self._expire(now)
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = self._state(job_id, job)
+
+            view = {'job_id': job_id, 'status': status, 'queued_seconds': None, 'run_seconds': None}
+            if job['started_at'] is not None:
+                view['queued_seconds'] = round(max(job['started_at'] - job['submitted_at'], 0), 6)
+            if job['finished_at'] is not None and job['started_at'] is not None:
+                view['run_seconds'] = round(job['finished_at'] - job['started_at'], 6)
+            if status == 'queued':
+                view['queue_position'] = sum(
+                    1 for other_id, other in self.jobs.items()
+                    if self._state(other_id, other) == 'queued' and other['submitted_at'] < job['submitted_at']
+                )
+            if status == 'done':
+                view['result'] = job['result']
+            if status == 'failed':
+                view['error'] = job['error']
+            return view
+
+    # Cancel a queued job; a job that is already running can't be interrupted, so it is reported as "cancelling" (and
+    # keeps its queue slot) until its worker is done, and its result is discarded
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            future = self.futures.get(job_id) if job['status'] == 'queued' else None
+
+        # Outside the lock: cancelling runs the future's done callback (_finish) right away
+        if future is not None and not future.cancel():
+            with self.lock:
+                if job['status'] == 'queued':
+                    job['status'] = 'cancelling'
+        return self.status(job_id)
+
+    # Queue depth and totals, for /analysis/jobs and /metrics
+    def stats(self):
+        with self.lock:
+            self._expire(self.clock())
+            states = [self._state(job_id, job) for job_id, job in self.jobs.items()]
+            return {
+                'queued': states.count('queued'),
+                'running': states.count('running'),
+                'cancelling': states.count('cancelling'),
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+                **{f'{state}_total': count for state, count in self.totals.items()},
+            }
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
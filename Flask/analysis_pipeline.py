@@ -0,0 +1,190 @@
+import pandas as pd
+
+from ml_models import linear_regression, category_linear_regression, state_linear_regression, state_category_linear_regression, kmeans_clustering, spending_kmeans_clustering, frequency_kmeans_clustering, get_association_rules
+from business_logic import assign_limits, predictive_insights, analyze_spending_variability, analyze_spending_deviations, day_of_week_analysis
+from stage_scheduler import Stage
+from shared_frames import category_predictions_task, deviation_insights_task
+
+# Outputs of the optional stages when they don't run (too little data)
+ANALYSIS_DEFAULTS = {
+    'predictions': [],
+    'category_predictions': {},
+    'expenses_clustering': [],
+    'kmeans_insights': [],
+    'spending_clustering': [],
+    'frequency_clustering': [],
+    'association_rules': [],
+    'variability_insights': [],
+    'deviation_insights': [],
+    'day_of_week_insights': [],
+}
+
+# Cheaper settings used when a request's latency budget is at risk
+REDUCED_FORECAST_MONTHS = 3
+REDUCED_MIN_SUPPORT = 0.3
+
+# Stages whose outputs only depend on the history, the categories and the budget, not on the current month's expenses
+HISTORY_STAGES = ['assign_limits', 'linear_regression', 'category_linear_regression']
+
+# Smart insights are reported in this order whatever order their stages finish in
+SMART_INSIGHT_OUTPUTS = ['kmeans_insights', 'variability_insights', 'deviation_insights', 'day_of_week_insights']
+
+
+# Assign limits to categories, with the goal as the first "category"
+def category_limits(categories, allowed_spending, goal_amount):
+    category_limits = assign_limits(categories.copy(), allowed_spending)
+    goal_row = pd.DataFrame([{'name': 'Goal', 'limit': goal_amount}])
+    return pd.concat([goal_row, category_limits], ignore_index=True)
+
+
+def category_totals(context, category_limits):
+    totals = context.category_sums().reset_index()
+    return totals.merge(category_limits, left_on='category', right_on='name', how='left')
+
+
+# Budget and goal advice from the current spending and the month-end estimate
+def budget_advice(predicted_current_month, category_totals, monthly_budget, goal_amount, total_spent, allowed_spending):
+    advice = []
+
+    if goal_amount > 0:
+        if total_spent > monthly_budget:
+            advice.append("You've exceeded your monthly budget!")
+
+        elif total_spent > allowed_spending:
+            advice.append("You've spent more than your goal allows.")
+
+            if predicted_current_month is not None and predicted_current_month > monthly_budget:
+                advice.append("Your spending is estimated to exceed your monthly budget.")
+
+        elif predicted_current_month is not None and predicted_current_month > monthly_budget:
+            advice.append("Your spending is estimated to exceed your monthly budget.")
+
+        elif predicted_current_month is not None and predicted_current_month > allowed_spending:
+            advice.append("Your spending is estimated to be more than what your goal allows.")
+
+    else:
+        advice.append('No goal was set for this month.')
+
+        if total_spent > monthly_budget:
+            advice.append("You've exceeded your monthly budget!")
+
+        elif predicted_current_month is not None and predicted_current_month > monthly_budget:
+            advice.append("Your spending is estimated to exceed your monthly budget.")
+
+    over_budget_categories = category_totals[category_totals['amount'] > category_totals['limit']]
+
+    if len(over_budget_categories) > 0:
+        combined_categories = "', '".join(over_budget_categories['category'])
+        advice.append(f"You're overspending on '{combined_categories}'. Stop spending to avoid risks.")
+
+    return advice
+
+
+# Run one of the analysis functions that append to result lists and return those lists instead
+def _collect(func, *args, lists=1, **kwargs):
+    results = [[] for _ in range(lists)]
+    func(*args, *results, **kwargs)
+    return results[0] if lists == 1 else tuple(results)
+
+
+# Forecasts come from the user's persisted trend statistics when there are some, otherwise from a fit of the history
+def _predictions(history, context, state, month_num=12):
+    if state is not None:
+        return _collect(state_linear_regression, state, month_num=month_num)
+    return _collect(linear_regression, history, month_num=month_num, context=context)
+
+
+# With a process pool ("processes"), the per-category fit and the deviation insight run in a worker process on the
+# shared memory copies of the frames ("shared_*" descriptors) instead of in this one
+def _category_predictions(history, context, state, processes, shared_history, month_num=12):
+    predictions = {}
+    if state is not None:
+        state_category_linear_regression(state, predictions, month_num=month_num)
+    elif processes is not None:
+        predictions = processes.submit(category_predictions_task, shared_history, month_num).result()
+    else:
+        category_linear_regression(history, predictions, month_num=month_num, context=context)
+    return predictions
+
+
+def _deviation_insights(expenses, history, spend_index, context, processes, shared_expenses, shared_history, user):
+    if processes is not None:
+        # The worker keeps its own index for the user, when this request uses one at all
+        return processes.submit(deviation_insights_task, shared_expenses, shared_history, user if spend_index is not None else None).result()
+    return _collect(analyze_spending_deviations, expenses, history, spend_index=spend_index, context=context)
+
+
+# Association rule thresholds get stricter as the month has fewer expenses
+def association_min_support(expense_rows):
+    if expense_rows >= 30:
+        return 0.1
+    elif expense_rows >= 20:
+        return 0.15
+    return 0.25
+
+
+def _association_rules(expenses, context, reduced=False):
+    min_support = association_min_support(len(expenses))
+    # Fewer frequent itemsets to mine when short on time
+    if reduced:
+        min_support = max(min_support, REDUCED_MIN_SUPPORT)
+    return _collect(get_association_rules, expenses, min_support=min_support, min_confidence=0.3, min_lift=1.0, context=context)
+
+
+# The /analysis pipeline as a DAG: stages only read their inputs (names in the value table) and return their outputs,
+# so independent ones (history regressions, current-month clustering, association rules...) can run in parallel
+# Limits, the month-end estimate and advice are always computed; every other stage is optional under a latency budget
+def analysis_stages(expense_rows, expense_categories, category_count, history_rows, history_months, history_size):
+    stages = [
+        Stage('assign_limits', category_limits, ['categories', 'allowed_spending', 'goal_amount'], ['category_limits'],
+              sizes={'rows': expense_rows, 'categories': category_count}),
+        Stage('category_totals', category_totals, ['context', 'category_limits'], ['category_totals'],
+              sizes={'rows': expense_rows, 'categories': expense_categories}),
+        Stage('predictive_insights', lambda expenses, context: predictive_insights(expenses, context) if expense_rows >= 5 else None,
+              ['expenses', 'context'], ['predicted_current_month'], sizes={'rows': expense_rows}),
+        Stage('budget_advice', budget_advice,
+              ['predicted_current_month', 'category_totals', 'monthly_budget', 'goal_amount', 'total_spent', 'allowed_spending'], ['advice']),
+    ]
+
+    history_sizes = {'rows': history_rows, 'months': history_months}
+    if history_size >= 5:
+        stages += [
+            Stage('linear_regression', _predictions,
+                  ['history', 'history_context', 'forecast_state'], ['predictions'], sizes=history_sizes, optional=True,
+                  reduced=lambda history, context, state: _predictions(history, context, state, REDUCED_FORECAST_MONTHS)),
+            Stage('category_linear_regression', _category_predictions,
+                  ['history', 'history_context', 'forecast_state', 'stage_processes', 'shared_history'], ['category_predictions'],
+                  sizes=history_sizes, optional=True,
+                  reduced=lambda *inputs: _category_predictions(*inputs, month_num=REDUCED_FORECAST_MONTHS)),
+        ]
+
+    category_sizes = {'rows': expense_rows, 'categories': expense_categories}
+    if expense_rows >= 5:
+        stages += [
+            Stage('kmeans_clustering', lambda expenses, context: _collect(kmeans_clustering, expenses, lists=2, context=context),
+                  ['expenses', 'context'], ['kmeans_insights', 'expenses_clustering'], sizes={'rows': expense_rows}, optional=True),
+            Stage('spending_kmeans_clustering', lambda expenses, context: _collect(spending_kmeans_clustering, expenses, context=context),
+                  ['expenses', 'context'], ['spending_clustering'], sizes=category_sizes, optional=True),
+            Stage('frequency_kmeans_clustering', lambda expenses, context: _collect(frequency_kmeans_clustering, expenses, context=context),
+                  ['expenses', 'context'], ['frequency_clustering'], sizes=category_sizes, optional=True),
+            Stage('day_of_week_analysis', lambda expenses, context: _collect(day_of_week_analysis, expenses, context=context),
+                  ['expenses', 'context'], ['day_of_week_insights'], sizes={'rows': expense_rows}, optional=True),
+        ]
+
+    if expense_rows >= 10:
+        stages.append(Stage('get_association_rules', _association_rules, ['expenses', 'context'], ['association_rules'],
+                            sizes=category_sizes, optional=True,
+                            reduced=lambda expenses, context: _association_rules(expenses, context, reduced=True)))
+
+    if expense_rows >= 5 and expense_categories >= 3:
+        stages.append(Stage('analyze_spending_variability',
+                            lambda expenses, context: _collect(analyze_spending_variability, expenses, context=context),
+                            ['expenses', 'context'], ['variability_insights'], sizes=category_sizes, optional=True))
+
+    if expense_rows >= 5 and history_size >= 5 and expense_categories >= 3:
+        stages.append(Stage('analyze_spending_deviations', _deviation_insights,
+                            ['expenses', 'history', 'spend_index', 'context', 'stage_processes', 'shared_expenses', 'shared_history', 'user'],
+                            ['deviation_insights'],
+                            sizes={'rows': history_rows, 'categories': expense_categories, 'months': history_months}, optional=True))
+
+    return stages
@@ -0,0 +1,302 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+
+from analysis_pipeline import analysis_stages, association_min_support, ANALYSIS_DEFAULTS, HISTORY_STAGES, SMART_INSIGHT_OUTPUTS
+from analysis_delta import AnalysisState, AnalysisStates, StaleAnalysisState
+from stage_scheduler import run_stages, StageCosts
+from rollup_store import load_history
+from history_store import load_history as load_stored_history
+from forecast_store import update_forecast_state
+from result_cache import user_fingerprint
+from spend_index import SpendIndexCache, FrozenSpendIndex
+from analysis_context import AnalysisContext
+from columnar import expenses_frame, expenses_context
+from shared_frames import SharedExpenses, worker_pid
+from metrics import RequestTrace
+from serialization import records
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Threads running independent /analysis stages at once (1 runs them one after another), one per CPU up to 4 by default
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS") or min(4, os.cpu_count() or 1))
+
+# Analyses slower than this many seconds are logged with their per-stage breakdown
+SLOW_ANALYSIS_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 1.0))
+
+# Worker processes for the heaviest history stages (per-category regression, spending deviations), which get the
+# frames through shared memory instead of pickles; 0 (the default) keeps every stage on the thread pool
+ANALYSIS_PROCESS_WORKERS = int(os.getenv("ANALYSIS_PROCESS_WORKERS", 0))
+stage_processes = None
+_stage_processes_lock = threading.Lock()
+
+
+def get_stage_processes():
+    global stage_processes
+    with _stage_processes_lock:
+        if stage_processes is None and ANALYSIS_PROCESS_WORKERS > 0:
+            stage_processes = ProcessPoolExecutor(max_workers=ANALYSIS_PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            # Start the workers (and their imports) now, outside any stage, so the first stages don't time the spawn
+            list(stage_processes.map(worker_pid, range(ANALYSIS_PROCESS_WORKERS)))
+        return stage_processes
+
+# Learned per-stage costs for latency budgets, and per-user historical cumulative-spend curves for the deviation
+# insight (recomputed only when past months change); both are per process
+stage_costs = StageCosts()
+spend_indexes = SpendIndexCache(max_entries=int(os.getenv("SPEND_INDEX_CACHE_SIZE", 1024)))
+
+# Per-user state of the last full analysis of a user ("user_id"), updated in place by /analysis/delta
+analysis_states = AnalysisStates(max_entries=int(os.getenv("ANALYSIS_STATE_CACHE_SIZE", 1024)))
+
+
+# In-process entry point of the analysis (used by /analysis/jobs workers and batch_analysis.py): the /analysis result
+# of one payload as a dict. Raises ValueError for payloads /analysis would reject with a 400; only a "deadline_ms"
+# in the payload sets a latency budget. Pass a RequestTrace to collect the per-stage timings, and save_state=False
+# where nothing will send /analysis/delta requests to this process (see run_analysis)
+def analyze(payload, trace=None, save_state=True):
+    error = analysis_payload_error(payload)
+    if error is not None:
+        raise ValueError(error)
+
+    own_trace = trace is None
+    trace = trace or RequestTrace('analyze')
+    budget_seconds = analysis_budget(payload, 0)
+    result = run_analysis(payload, trace, trace.started + budget_seconds if budget_seconds > 0 else None, save_state)
+    if own_trace:
+        trace.finish(logger, SLOW_ANALYSIS_SECONDS)
+    return result
+
+
+# Validation shared by every analysis entry point: an error message, or None when the payload can be analyzed
+def analysis_payload_error(data):
+    if not all(key in data for key in ['expenses', 'categories', 'monthly_budget', 'goal_amount', 'total_spent']):
+        return 'Missing required data'
+
+    # History comes either from the payload ("all_expenses") or, for a "user_id", from the user's stored rollups or
+    # ("history_source": "store") the user's columnar history
+    if 'all_expenses' not in data and 'user_id' not in data:
+        return 'Missing required data'
+
+    if data.get('history_source', 'rollups') not in ('rollups', 'store'):
+        return 'history_source should be "rollups" or "store"'
+
+    history_months = data.get('history_months')
+    if history_months is not None and (not isinstance(history_months, int) or isinstance(history_months, bool) or history_months <= 0):
+        return 'history_months should be a positive number of months'
+
+    if data['total_spent'] <= 0:
+        return 'Total spent should be greater than 0'
+
+    try:
+        analysis_budget(data, 0)
+    except (TypeError, ValueError):
+        return 'deadline_ms should be a number of milliseconds'
+    return None
+
+
+# Latency budget in seconds: the payload's "deadline_ms", otherwise "default_seconds" (0 means no budget)
+def analysis_budget(data, default_seconds):
+    return float(data['deadline_ms']) / 1000 if data.get('deadline_ms') is not None else default_seconds
+
+
+# The whole analysis of a validated payload ("deadline" is a time.perf_counter() value or None)
+# With "save_state" false, the user's /analysis/delta state and spend index are neither used nor kept (job and batch
+# workers: nothing in their processes ever reads them)
+def run_analysis(data, trace, deadline=None, save_state=True):
+    with trace.stage('build_frames'):
+        expenses = expenses_frame(data['expenses'])
+        categories = pd.DataFrame(data['categories'])
+        # Date parts and category codes are derived once here and shared by every analysis function
+        context = expenses_context(expenses, data['expenses'])
+    monthly_budget = data['monthly_budget']
+    goal_amount = data['goal_amount']
+    total_spent = data['total_spent']
+    allowed_spending = monthly_budget - goal_amount
+
+    
+    # Remove current month's expenses from all expenses
+    with trace.stage('load_history'):
+        current_year, current_month = context.last_month()
+
+        if 'all_expenses' in data:
+            all_expenses = expenses_frame(data['all_expenses'])
+            current_month_key = (current_year - 1970) * 12 + current_month - 1
+            in_current_month = all_expenses['date'].to_numpy(dtype='datetime64[ns]').astype('datetime64[M]').astype(int) == current_month_key
+            distinct_all_expenses = all_expenses[~in_current_month].copy()
+            history_size = len(distinct_all_expenses)
+            forecast_state = None
+            history_context = expenses_context(distinct_all_expenses, data['all_expenses'], ~in_current_month)
+        elif data.get('history_source') == 'store':
+            # Only the months the analysis looks at are read from the memory-mapped segments
+            since_year, since_month = None, None
+            if data.get('history_months'):
+                since_key = current_year * 12 + current_month - 1 - data['history_months']
+                since_year, since_month = since_key // 12, since_key % 12 + 1
+            distinct_all_expenses, history_context = load_stored_history(data['user_id'], current_year, current_month, since_year, since_month)
+            history_size = len(distinct_all_expenses)
+            forecast_state = None
+        else:
+            # Rollups hold one row per (day, category), so the real number of past expenses is the summed count
+            distinct_all_expenses = load_history(data['user_id'], current_year, current_month)
+            history_size = int(distinct_all_expenses['count'].sum())
+            # Trend statistics of the closed months, so the forecasts need no refit
+            forecast_state = update_forecast_state(data['user_id'], current_year, current_month)
+            history_context = AnalysisContext(distinct_all_expenses)
+
+    # Input sizes recorded next to each stage's duration
+    expense_rows = len(expenses)
+    expense_categories = len(context.categories)
+    history_rows = len(distinct_all_expenses)
+    history_months = history_context.month_span()
+
+    _set_priorities(expenses, context, categories)
+
+    # predicted_next_month = weighted_average(distinct_all_expenses, expenses, predicted_current_month) if len(distinct_all_expenses) >= 5 and len(expenses) >= 5 else None
+
+    # Independent stages run in parallel; each reads the shared frames/contexts and returns its own results
+    # Optional stages are reduced, skipped or abandoned when they would overrun the latency budget
+    degraded_stages = []
+    stages = analysis_stages(expense_rows, expense_categories, len(categories), history_rows, history_months, history_size)
+
+    user = user_fingerprint(data)
+    # Only a real user has a spend index of their own: anonymous requests ("_") would all share, and serialize on, one
+    spend_index = spend_indexes.get(user) if save_state and data.get('user_id') is not None else None
+    processes = get_stage_processes()
+    shared = {}
+    if processes is not None:
+        with trace.stage('share_frames', rows=expense_rows + history_rows):
+            shared = {'expenses': SharedExpenses(context, 'expenses'), 'history': SharedExpenses(history_context, 'history')}
+    try:
+        values = run_stages(stages, {
+            **ANALYSIS_DEFAULTS,
+            'expenses': expenses,
+            'context': context,
+            'categories': categories,
+            'history': distinct_all_expenses,
+            'history_context': history_context,
+            'forecast_state': forecast_state,
+            'spend_index': spend_index,
+            'stage_processes': processes,
+            'shared_expenses': shared['expenses'].descriptor if shared else None,
+            'shared_history': shared['history'].descriptor if shared else None,
+            'user': user,
+            'monthly_budget': monthly_budget,
+            'goal_amount': goal_amount,
+            'total_spent': total_spent,
+            'allowed_spending': allowed_spending,
+        }, max_workers=ANALYSIS_WORKERS, trace=trace, deadline=deadline, costs=stage_costs, degraded_stages=degraded_stages)
+    finally:
+        # Stages abandoned at the deadline may still be attached in a worker; unlinking only removes the name
+        for segment in shared.values():
+            segment.close()
+
+    if save_state and data.get('user_id') is not None:
+        history_degraded = [stage for stage in degraded_stages if stage['stage'] in HISTORY_STAGES]
+        association = _full_association_rules(values, degraded_stages, expense_rows)
+        analysis_states.save(user, AnalysisState(
+            expenses, categories, monthly_budget, goal_amount, total_spent,
+            {name: values[name] for name in ['category_limits', 'predictions', 'category_predictions']},
+            {'history_rows': history_rows, 'history_months': history_months, 'history_size': history_size},
+            spend_index, history_degraded, association
+        ))
+
+    return analysis_result(values, degraded_stages)
+
+
+# Legacy per-expense priority column (-1 for categories without a priority)
+def _set_priorities(expenses, context, categories):
+    category_priorities = pd.Series(context.categories).map(dict(zip(categories['name'], categories['priority']))).fillna(-1)
+    expenses['priority'] = category_priorities.to_numpy()[context.category_codes]
+
+
+# (min_support, rules) when the association rules were mined in full mode, so /analysis/delta can reuse them
+def _full_association_rules(values, degraded_stages, expense_rows):
+    if expense_rows < 10 or any(stage['stage'] == 'get_association_rules' for stage in degraded_stages):
+        return None
+    return association_min_support(expense_rows), values['association_rules']
+
+
+# Prepare results for API response
+def analysis_result(values, degraded_stages):
+    category_limits_dict = records(values['category_limits'])
+
+    result = {
+        'predicted_current_month': values['predicted_current_month'],
+        'predictions': values['predictions'],
+        'category_predictions': values['category_predictions'],
+        'category_limits': category_limits_dict,
+        'advice': values['advice'],
+        'smart_insights': [insight for name in SMART_INSIGHT_OUTPUTS for insight in values[name]],
+        'expenses_clustering': values['expenses_clustering'],
+        'spending_clustering': values['spending_clustering'],
+        'frequency_clustering': values['frequency_clustering'],
+        'association_rules': values['association_rules'],
+        'degraded_stages': degraded_stages,
+    }
+    return result
+
+
+# Update a user's last full analysis with one added and/or one deleted expense of the same month ("expense",
+# "deleted_expense"): the history stages are not run again, their cached outputs are reused, and the association
+# rules too when no daily basket changed. Raises StaleAnalysisState when a full /analysis is needed instead
+def analyze_delta(data, trace, deadline=None):
+    state = analysis_states.get(user_fingerprint(data))
+    if state is None:
+        raise StaleAnalysisState("No cached analysis for this user")
+
+    with state.lock:
+        with trace.stage('apply_delta'):
+            expenses, baskets, total_spent, baskets_changed = state.apply(data.get('expense'), data.get('deleted_expense'))
+            if total_spent <= 0:
+                raise ValueError('Total spent should be greater than 0')
+            context = AnalysisContext(expenses)
+            _set_priorities(expenses, context, state.categories)
+
+        expense_rows = len(expenses)
+        sizes = state.history_sizes
+        stages = [
+            stage for stage in analysis_stages(expense_rows, len(context.categories), len(state.categories),
+                                               sizes['history_rows'], sizes['history_months'], sizes['history_size'])
+            if stage.name not in HISTORY_STAGES
+        ]
+        values = {
+            **ANALYSIS_DEFAULTS,
+            **state.history_values,
+            'expenses': expenses,
+            'context': context,
+            'categories': state.categories,
+            'history': None,
+            'history_context': None,
+            'forecast_state': None,
+            'spend_index': FrozenSpendIndex(state.spend_index),
+            'stage_processes': None,
+            'shared_expenses': None,
+            'shared_history': None,
+            'user': user_fingerprint(data),
+            'monthly_budget': state.monthly_budget,
+            'goal_amount': state.goal_amount,
+            'total_spent': total_spent,
+            'allowed_spending': state.monthly_budget - state.goal_amount,
+        }
+
+        # Rules only depend on the set of (date, category) baskets and on the support threshold
+        reuse_rules = (
+            state.association_rules is not None and not baskets_changed
+            and state.association_rules[0] == association_min_support(expense_rows) and expense_rows >= 10
+        )
+        if reuse_rules:
+            stages = [stage for stage in stages if stage.name != 'get_association_rules']
+            values['association_rules'] = state.association_rules[1]
+
+        degraded_stages = list(state.degraded_stages)
+        values = run_stages(stages, values, max_workers=ANALYSIS_WORKERS, trace=trace, deadline=deadline, costs=stage_costs,
+                            degraded_stages=degraded_stages)
+
+        association = state.association_rules if reuse_rules else _full_association_rules(values, degraded_stages, expense_rows)
+        state.commit(expenses, baskets, total_spent, association)
+        return analysis_result(values, degraded_stages)
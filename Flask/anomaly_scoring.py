@@ -0,0 +1,326 @@
+import json
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from rollup_store import connect as connect_rollups
+
+# An expense is unusual when it is both far from the category's mean (z-score, plain or EWMA) and above this share
+# of the category's past expenses, once the category has enough of them
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", 3.0))
+ANOMALY_PERCENTILE = float(os.getenv("ANOMALY_PERCENTILE", 0.95))
+ANOMALY_MIN_COUNT = int(os.getenv("ANOMALY_MIN_COUNT", 8))
+ANOMALY_EWMA_ALPHA = float(os.getenv("ANOMALY_EWMA_ALPHA", 0.1))
+
+# The statistics of all of a user's expenses are stored under this category, and used for categories without history
+ALL_CATEGORIES = ''
+
+logger = logging.getLogger(__name__)
+
+
+# Streaming quantile sketch with relative accuracy: positive amounts are counted in logarithmic buckets, so any
+# quantile is known within +-"relative_accuracy" of the true value whatever the number of expenses
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.01, buckets=None, zeros=0):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = buckets or {}
+        self.zeros = zeros
+        self.count = zeros + sum(self.buckets.values())
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value):
+        if value <= 0:
+            self.zeros += 1
+        else:
+            key = self._key(value)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+
+    # Share of the counted values that are <= value
+    def rank(self, value):
+        if self.count == 0:
+            return 0.0
+        if value <= 0:
+            return self.zeros / self.count
+        key = self._key(value)
+        return (self.zeros + sum(count for bucket, count in self.buckets.items() if bucket <= key)) / self.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'zeros': self.zeros, 'buckets': {str(key): count for key, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['relative_accuracy'], {int(key): count for key, count in data['buckets'].items()}, data['zeros'])
+
+
+# O(1) running statistics of one category's expense amounts: Welford mean/variance, an exponentially weighted
+# mean/variance (recent spending counts more) and the quantile sketch
+class RunningStats:
+    def __init__(self, n=0, mean=0.0, m2=0.0, ewma=0.0, ewm_var=0.0, sketch=None):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.ewma = ewma
+        self.ewm_var = ewm_var
+        self.sketch = sketch or QuantileSketch()
+
+    def add(self, amount, alpha=ANOMALY_EWMA_ALPHA):
+        self.n += 1
+        delta = amount - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (amount - self.mean)
+
+        if self.n == 1:
+            self.ewma, self.ewm_var = amount, 0.0
+        else:
+            difference = amount - self.ewma
+            increment = alpha * difference
+            self.ewma += increment
+            self.ewm_var = (1 - alpha) * (self.ewm_var + difference * increment)
+        self.sketch.add(amount)
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    # How an amount compares with the expenses seen so far
+    def score(self, amount, z_threshold=ANOMALY_Z_THRESHOLD, percentile_threshold=ANOMALY_PERCENTILE, min_count=ANOMALY_MIN_COUNT):
+        std, ewm_std = self.std(), math.sqrt(self.ewm_var)
+        z_score = (amount - self.mean) / std if std > 0 else None
+        ewma_z_score = (amount - self.ewma) / ewm_std if ewm_std > 0 else None
+        percentile = self.sketch.rank(amount)
+
+        z = max(value for value in (z_score, ewma_z_score, 0.0) if value is not None)
+        return {
+            'unusual': self.n >= min_count and z >= z_threshold and percentile >= percentile_threshold,
+            'count': self.n,
+            'z_score': None if z_score is None else round(z_score, 3),
+            'ewma_z_score': None if ewma_z_score is None else round(ewma_z_score, 3),
+            'percentile': round(percentile, 4),
+            'mean': round(self.mean, 2),
+            'ewma': round(self.ewma, 2),
+            'typical_max': None if self.n == 0 else round(self.sketch.quantile(percentile_threshold), 2),
+        }
+
+    def to_dict(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2, 'ewma': self.ewma, 'ewm_var': self.ewm_var, 'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['n'], data['mean'], data['m2'], data['ewma'], data['ewm_var'], QuantileSketch.from_dict(data['sketch']))
+
+
+# Running statistics of every category of a user, plus ALL_CATEGORIES
+class UserAnomalyState:
+    def __init__(self, categories=None):
+        self.categories = categories or {}
+        self.lock = threading.Lock()
+
+    def add(self, amount, category):
+        for key in (category, ALL_CATEGORIES):
+            self.categories.setdefault(key, RunningStats()).add(amount)
+
+    # Score against the category's statistics, or the user's overall ones while the category has too few expenses
+    def score(self, amount, category):
+        stats = self.categories.get(category)
+        scope = 'category'
+        if stats is None or stats.n < ANOMALY_MIN_COUNT:
+            stats, scope = self.categories.get(ALL_CATEGORIES, RunningStats()), 'all_categories'
+        return {**stats.score(amount), 'scope': scope}
+
+
+# Open the rollup database with the anomaly statistics table next to the other per-user state
+def connect(db_path=None):
+    conn = connect_rollups(db_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS anomaly_stats (
+            user_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (user_id, category)
+        );
+    """)
+    return conn
+
+
+def load_anomaly_state(user_id, db_path=None):
+    conn = connect(db_path)
+    try:
+        rows = conn.execute("SELECT category, state FROM anomaly_stats WHERE user_id = ?", (str(user_id),)).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    return UserAnomalyState({category: RunningStats.from_dict(json.loads(state)) for category, state in rows})
+
+
+def save_anomaly_states(states, db_path=None):
+    conn = connect(db_path)
+    try:
+        with conn:
+            for user_id, state in states.items():
+                with state.lock:
+                    rows = [(str(user_id), category, json.dumps(stats.to_dict())) for category, stats in state.categories.items()]
+                conn.execute("DELETE FROM anomaly_stats WHERE user_id = ?", (str(user_id),))
+                conn.executemany("INSERT INTO anomaly_stats (user_id, category, state) VALUES (?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+
+def delete_anomaly_state(user_id, db_path=None):
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM anomaly_stats WHERE user_id = ?", (str(user_id),))
+    finally:
+        conn.close()
+
+
+# A user's statistics built from past expenses (a frame with date, amount and category), fed in date order
+def build_anomaly_state(expenses):
+    state = UserAnomalyState()
+    order = np.argsort(expenses['date'].to_numpy(dtype='datetime64[ns]'), kind='stable')
+    for amount, category in zip(expenses['amount'].to_numpy(dtype=float)[order], expenses['category'].to_numpy()[order]):
+        state.add(float(amount), category)
+    return state
+
+
+# In-memory states of recently scored users, loaded from the database on first use. Recorded expenses (and dirty
+# users evicted from memory) are written back by a background thread every "flush_seconds" and by flush(), e.g. at
+# exit, so that scoring never waits for the disk; what a crash loses can be rebuilt
+class AnomalyScorer:
+    def __init__(self, max_users=10000, flush_seconds=5.0, db_path=None):
+        self.max_users = max_users
+        self.flush_seconds = flush_seconds
+        self.db_path = db_path
+        self.states = OrderedDict()
+        self.dirty = set()
+        self.evicted = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stopped = threading.Event()
+
+    # The user's state: cached, waiting to be written back, stored, or built by "rebuild" (a callable returning a
+    # state, or None)
+    def state(self, user_id, rebuild=None):
+        user_id = str(user_id)
+        with self.lock:
+            state = self.states.get(user_id)
+            if state is not None:
+                self.states.move_to_end(user_id)
+                return state
+            state = self.evicted.pop(user_id, None)
+            if state is not None:
+                self.dirty.add(user_id)
+
+        if state is None:
+            state = load_anomaly_state(user_id, self.db_path)
+            if state is None and rebuild is not None:
+                state = rebuild()
+                if state is not None:
+                    save_anomaly_states({user_id: state}, self.db_path)
+        state = state or UserAnomalyState()
+        self._keep(user_id, state)
+        return state
+
+    def _keep(self, user_id, state):
+        with self.lock:
+            self.states[user_id] = state
+            self.states.move_to_end(user_id)
+            while len(self.states) > max(self.max_users, 1):
+                old_user, old_state = self.states.popitem(last=False)
+                if old_user in self.dirty:
+                    self.dirty.discard(old_user)
+                    self.evicted[old_user] = old_state
+
+    # Score an expense against the user's statistics, then (record=True) add it to them
+    def score(self, user_id, amount, category, record=True, rebuild=None):
+        state = self.state(user_id, rebuild)
+        with state.lock:
+            result = state.score(amount, category)
+            if record:
+                state.add(amount, category)
+        if record:
+            with self.lock:
+                self.dirty.add(str(user_id))
+            self._start_flusher()
+        return result
+
+    # Replace a user's statistics (e.g. rebuilt from their history) and store them right away
+    def replace(self, user_id, state):
+        user_id = str(user_id)
+        save_anomaly_states({user_id: state}, self.db_path)
+        with self.lock:
+            self.dirty.discard(user_id)
+            self.evicted.pop(user_id, None)
+        self._keep(user_id, state)
+
+    def forget(self, user_id):
+        user_id = str(user_id)
+        with self.lock:
+            self.states.pop(user_id, None)
+            self.dirty.discard(user_id)
+            self.evicted.pop(user_id, None)
+        delete_anomaly_state(user_id, self.db_path)
+
+    # Write back every dirty user now; users whose write fails stay dirty for the next flush
+    def flush(self):
+        with self.lock:
+            dirty = {**self.evicted, **{user_id: self.states[user_id] for user_id in self.dirty if user_id in self.states}}
+            self.dirty.clear()
+            self.evicted.clear()
+        if not dirty:
+            return 0
+        try:
+            save_anomaly_states(dirty, self.db_path)
+        except Exception:
+            with self.lock:
+                for user_id, state in dirty.items():
+                    if self.states.get(user_id) is state:
+                        self.dirty.add(user_id)
+                    elif user_id not in self.states:
+                        self.evicted.setdefault(user_id, state)
+            raise
+        return len(dirty)
+
+    # The background writer starts with the first recorded expense (processes that never score don't get one)
+    def _start_flusher(self):
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_periodically, name='anomaly-flush', daemon=True)
+                self.flusher.start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing back anomaly statistics failed")
+
+    # Stop the background writer and write back what is left
+    def close(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        return self.flush()
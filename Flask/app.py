@@ -1,170 +1,525 @@
-from flask import Flask, request, jsonify
-from ml_models import linear_regression, category_linear_regression, kmeans_clustering, spending_kmeans_clustering, frequency_kmeans_clustering, get_association_rules, Rule_Based_labeling
-from business_logic import assign_limits, predictive_insights, analyze_spending_variability, analyze_spending_deviations, day_of_week_analysis
-import pandas as pd
+from startup import startup_phase, startup_report, is_ready, start_warmup, WARMUP_USER_ID
+
+with startup_phase('flask'):
+    from flask import Flask, Response, request, jsonify, stream_with_context
+    import requests
+    from dotenv import load_dotenv
+
+with startup_phase('pandas'):
+    import pandas as pd
+
+with startup_phase('analysis_modules'):
+    from ml_models import Rule_Based_labeling, batch_rule_based_labeling
+    from analysis_service import analyze, analyze_delta, analysis_payload_error, analysis_budget, run_analysis, spend_indexes, analysis_states, get_stage_processes
+    from analysis_delta import StaleAnalysisState
+    from shared_frames import SharedExpenses, importance_labels_task
+    from analysis_context import AnalysisContext
+    from rollup_store import ingest_expenses
+    from forecast_store import invalidate_forecast_state
+    from history_store import append_expenses, load_history as load_stored_history, history_stats, has_history
+    from anomaly_scoring import AnomalyScorer, build_anomaly_state
+    from result_cache import ResultCache, payload_hash, user_fingerprint
+    from columnar import read_payload, expenses_frame, UnsupportedPayload
+    from llm_client import LLMClient, LLMBusy, DEFAULT_LLM_URL
+    from metrics import RequestTrace, render_metrics
+    from analysis_jobs import AnalysisJobs, JobQueueFull
+    from serialization import FastJSONProvider
+    from transport import decompress_request, compress_response, PayloadTooLarge
+
+import atexit
 from datetime import datetime
-import requests
-import json
-from dotenv import load_dotenv
+from functools import partial
+import math
+import multiprocessing
 import os
 
 app = Flask(__name__)
+# jsonify() responses are encoded by orjson (NumPy-aware) when it is installed
+app.json = FastJSONProvider(app)
 
 load_dotenv()
 FLASK_PASSWORD = os.getenv("FLASK_PASSWORD")
 
+# Requests slower than this many seconds are logged with their per-stage breakdown
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 1.0))
+
+# One pooled keep-alive client shared by every /chat request
+llm_client = LLMClient(
+    url=os.getenv("LLM_API_URL", DEFAULT_LLM_URL),
+    connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.getenv("LLM_READ_TIMEOUT", 60)),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", 2)),
+    retry_backoff=float(os.getenv("LLM_RETRY_BACKOFF", 0.5)),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 10))
+)
+
+# Results are cached by a hash of the fields they depend on, so identical payloads skip the whole pipeline
+ANALYSIS_CACHE_FIELDS = ['expenses', 'all_expenses', 'categories', 'monthly_budget', 'goal_amount', 'total_spent', 'user_id', 'history_source', 'history_months']
+LABELING_CACHE_FIELDS = ['past_expenses', 'user_id', 'history_source']
+result_cache = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", 300)),
+    disk_dir=os.getenv("RESULT_CACHE_DIR") or None
+)
+
+# Default /analysis latency budget in seconds (0 disables it); expensive stages are degraded rather than overrun it
+ANALYSIS_DEADLINE_SECONDS = float(os.getenv("ANALYSIS_DEADLINE_SECONDS", 20))
+
+# Largest request body accepted once decompressed, so a small compressed body can't expand without bound
+MAX_DECOMPRESSED_BODY_BYTES = int(os.getenv("MAX_DECOMPRESSED_BODY_BYTES", 256 * 1024 * 1024))
+
+
+# Compressed request bodies (Content-Encoding: gzip or zstd) are decompressed before any route reads them
+@app.before_request
+def decompress_request_body():
+    try:
+        decompress_request(request, MAX_DECOMPRESSED_BODY_BYTES)
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except PayloadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+
+# Responses are compressed when the client accepts gzip or zstd (Accept-Encoding)
+@app.after_request
+def compress_response_body(response):
+    return compress_response(request, response)
+
+
 # API endpoint responsible for the whole analyzing
 @app.route('/analysis', methods=['POST'])
 def analyze_expenses():
-    data = request.json
+    trace = RequestTrace('analysis')
+    try:
+        with trace.stage('parse_payload', bytes=request.content_length or 0):
+            data = read_payload(request)
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
     if data.get('password') != FLASK_PASSWORD:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    if not all(key in data for key in ['expenses', 'all_expenses', 'categories', 'monthly_budget', 'goal_amount', 'total_spent']):
-        return jsonify({'error': 'Missing required data'}), 400
+    error = analysis_payload_error(data)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    # Latency budget counted from the request's arrival: the caller's "deadline_ms" or ANALYSIS_DEADLINE_SECONDS
+    budget_seconds = analysis_budget(data, ANALYSIS_DEADLINE_SECONDS)
+    deadline = trace.started + budget_seconds if budget_seconds > 0 else None
+
+    with trace.stage('cache_lookup'):
+        cache_key = payload_hash('analysis', data, ANALYSIS_CACHE_FIELDS)
+        cached_result = result_cache.get(cache_key, user_fingerprint(data))
+    if cached_result is not None:
+        # The /analysis/delta state describes the user's last computed analysis; unless that was this payload, it is
+        # dropped, so /analysis/delta answers 409 until the next full analysis instead of updating another month's state
+        if data.get('user_id') is not None:
+            state = analysis_states.get(user_fingerprint(data))
+            if state is not None and state.source != cache_key:
+                analysis_states.invalidate(user_fingerprint(data))
+        response = jsonify(cached_result)
+        trace.finish(app.logger, SLOW_REQUEST_SECONDS)
+        return response
+
+    result = run_analysis(data, trace, deadline)
+    state = analysis_states.get(user_fingerprint(data)) if data.get('user_id') is not None else None
+    if state is not None:
+        state.source = cache_key
+
+    with trace.stage('serialize'):
+        # Degraded results are not cached, so the next identical request gets a chance at the full analysis
+        if not result['degraded_stages']:
+            result_cache.set(cache_key, result, user_fingerprint(data))
+        response = jsonify(result)
+
+    trace.finish(app.logger, SLOW_REQUEST_SECONDS)
+    return response
+
+
+# API endpoint for the common case of one expense being added or deleted in the current month: "expense" and/or
+# "deleted_expense" update the state kept from the user's last full /analysis instead of re-sending everything.
+# Answers 409 when there is no usable state (another process, another month, evicted), and a full /analysis is needed
+@app.route('/analysis/delta', methods=['POST'])
+def analyze_expense_delta():
+    trace = RequestTrace('analysis_delta')
+    try:
+        with trace.stage('parse_payload', bytes=request.content_length or 0):
+            data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
-    if data['total_spent'] <= 0:
-        return jsonify({'error': 'Total spent should be greater than 0'}), 400
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    expenses = pd.DataFrame(data['expenses'])
-    all_expenses = pd.DataFrame(data['all_expenses'])
-    categories = pd.DataFrame(data['categories'])
-    monthly_budget = data['monthly_budget']
-    goal_amount = data['goal_amount']
-    total_spent = data['total_spent']
-    expenses['date'] = pd.to_datetime(expenses['date'])
-    all_expenses['date'] = pd.to_datetime(all_expenses['date'])
-    allowed_spending = monthly_budget - goal_amount
+    if data.get('user_id') is None or not (data.get('expense') or data.get('deleted_expense')):
+        return jsonify({'error': 'Missing required data: user_id and expense or deleted_expense'}), 400
+
+    try:
+        budget_seconds = analysis_budget(data, ANALYSIS_DEADLINE_SECONDS)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'deadline_ms should be a number of milliseconds'}), 400
+
+    try:
+        result = analyze_delta(data, trace, trace.started + budget_seconds if budget_seconds > 0 else None)
+    except StaleAnalysisState as e:
+        return jsonify({'error': f'Full analysis required: {e}'}), 409
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid expense: {e}'}), 400
+
+    with trace.stage('serialize'):
+        response = jsonify(result)
+    trace.finish(app.logger, SLOW_REQUEST_SECONDS)
+    return response
+
+
+# Finished jobs fill the result cache like synchronous requests do
+def cache_job_result(result, cache_entry):
+    cache_key, user = cache_entry
+    if not result['degraded_stages']:
+        result_cache.set(cache_key, result, user)
+
+
+# Workers keep no per-user /analysis/delta state: deltas are answered by this process from its own full analyses
+analysis_jobs = AnalysisJobs(
+    partial(analyze, save_state=False),
+    max_workers=int(os.getenv("ANALYSIS_JOB_WORKERS") or os.cpu_count() or 1),
+    max_queued=int(os.getenv("ANALYSIS_JOB_QUEUE_SIZE", 64)),
+    ttl=float(os.getenv("ANALYSIS_JOB_TTL", 600)),
+    on_done=cache_job_result
+)
+
+
+# API endpoint for queueing an analysis: returns a job id right away, the result is polled from /analysis/jobs/<id>
+@app.route('/analysis/jobs', methods=['POST'])
+def submit_analysis_job():
+    try:
+        data = read_payload(request)
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
-    
-    # Remove current month's expenses from all expenses
-    expenses_copy = expenses.copy() # Creating a copy of 'expenses' to avoid modifying the original DataFrame (Error)
-    current_year = expenses_copy['date'].max().year
-    current_month = expenses_copy['date'].max().month
-    distinct_all_expenses = all_expenses[~((all_expenses['date'].dt.year == current_year) & 
-                                        (all_expenses['date'].dt.month == current_month))].copy()
-    distinct_all_expenses['month'] = distinct_all_expenses['date'].dt.month
-    
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    # Assign limits to categories
-    expenses['priority'] = expenses['category'].map(dict(zip(categories['name'], categories['priority']))).fillna(-1)
-    category_limits = assign_limits(categories, allowed_spending)
-    goal_row = pd.DataFrame([{'name': 'Goal', 'limit': goal_amount}])
-    category_limits = pd.concat([goal_row, category_limits], ignore_index=True)
-
-    category_totals = expenses.groupby('category')['amount'].sum().reset_index()
-    category_totals = category_totals.merge(category_limits, left_on='category', right_on='name', how='left')
-
-    advice = []
-    smart_insights = []
-    predictions = []
-    category_predictions = {}
-    expenses_clustering = []
-    spending_clustering = []
-    frequency_clustering = []
-    association_rules = []
-    
+    error = analysis_payload_error(data)
+    if error is not None:
+        return jsonify({'error': error}), 400
 
-    predicted_current_month = predictive_insights(expenses) if len(expenses) >= 5 else None
+    cache_key = payload_hash('analysis', data, ANALYSIS_CACHE_FIELDS)
+    try:
+        job_id = analysis_jobs.submit(data, result=result_cache.get(cache_key, user_fingerprint(data)), context=(cache_key, user_fingerprint(data)))
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
 
-    if goal_amount > 0:
-        if total_spent > monthly_budget:
-            advice.append("You've exceeded your monthly budget!")
+    return jsonify(analysis_jobs.status(job_id)), 202, {'Location': f'/analysis/jobs/{job_id}'}
 
-        elif total_spent > allowed_spending:
-            advice.append("You've spent more than your goal allows.")
 
-            if predicted_current_month is not None and predicted_current_month > monthly_budget:
-                advice.append("Your spending is estimated to exceed your monthly budget.")
-        
-        elif predicted_current_month is not None and predicted_current_month > monthly_budget:
-            advice.append("Your spending is estimated to exceed your monthly budget.")
+# Job endpoints take the password from the "X-Flask-Password" header (or a JSON body)
+def job_request_authorized():
+    body = request.get_json(silent=True) or {}
+    return (request.headers.get('X-Flask-Password') or body.get('password')) == FLASK_PASSWORD
 
-        elif predicted_current_month is not None and predicted_current_month > allowed_spending:
-            advice.append("Your spending is estimated to be more than what your goal allows.")
 
-    else:
-        advice.append('No goal was set for this month.')
+# API endpoint for the queue depth and job totals
+@app.route('/analysis/jobs', methods=['GET'])
+def analysis_jobs_stats():
+    if not job_request_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
 
-        if total_spent > monthly_budget:
-            advice.append("You've exceeded your monthly budget!")
+    return jsonify(analysis_jobs.stats())
 
-        elif predicted_current_month is not None and predicted_current_month > monthly_budget:
-            advice.append("Your spending is estimated to exceed your monthly budget.")
 
+# API endpoint for polling a job: status, queue/run seconds and the result once done; DELETE cancels it
+@app.route('/analysis/jobs/<job_id>', methods=['GET', 'DELETE'])
+def analysis_job(job_id):
+    if not job_request_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    over_budget_categories = category_totals[category_totals['amount'] > category_totals['limit']]
+    job = analysis_jobs.cancel(job_id) if request.method == 'DELETE' else analysis_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job)
 
-    if len(over_budget_categories) > 0:
-        combined_categories = "', '".join(over_budget_categories['category'])
-        advice.append(f"You're overspending on '{combined_categories}'. Stop spending to avoid risks.")
 
-    # predicted_next_month = weighted_average(distinct_all_expenses, expenses, predicted_current_month) if len(distinct_all_expenses) >= 5 and len(expenses) >= 5 else None
-    
-    if len(distinct_all_expenses) >= 5:
-        linear_regression(distinct_all_expenses, predictions)
-        category_linear_regression(distinct_all_expenses, category_predictions)
-    
-    if len(expenses) >= 5:
-        kmeans_clustering(expenses, smart_insights, expenses_clustering)
-        spending_kmeans_clustering(expenses, spending_clustering)
-        frequency_kmeans_clustering(expenses, frequency_clustering)
-
-    if len(expenses) >= 30:
-        get_association_rules(expenses, association_rules, min_support=0.1, min_confidence=0.3, min_lift=1.0)
-    elif len(expenses) >= 20:
-        get_association_rules(expenses, association_rules, min_support=0.15, min_confidence=0.3, min_lift=1.0)
-    elif len(expenses) >= 10:
-        get_association_rules(expenses, association_rules, min_support=0.25, min_confidence=0.3, min_lift=1.0)
-
-    if len(expenses) >= 5 and len(expenses['category'].unique()) >= 3:
-        analyze_spending_variability(expenses, smart_insights)
-
-    if len(expenses) >= 5 and len(distinct_all_expenses) >= 5 and len(expenses['category'].unique()) >= 3:
-        analyze_spending_deviations(expenses, distinct_all_expenses, smart_insights)
-
-    if len(expenses) >= 5:
-        day_of_week_analysis(expenses, smart_insights)
-
-    # Prepare results for API response
-    category_limits_dict = category_limits.to_dict(orient='records')
-
-    result = {
-        'predicted_current_month': predicted_current_month,
-        'predictions': predictions,
-        'category_predictions': category_predictions,
-        'category_limits': category_limits_dict,
-        'advice': advice,
-        'smart_insights': smart_insights,
-        'expenses_clustering': expenses_clustering,
-        'spending_clustering': spending_clustering,
-        'frequency_clustering': frequency_clustering,
-        'association_rules': association_rules,
-    }
+# API endpoint for appending new/deleted expenses to a user's stored monthly rollups
+# Rollups are updated per (day, category) row, so expenses come as rows in any body format, never as columnar frames
+@app.route('/rollups/ingest', methods=['POST'])
+def ingest_rollups():
+    try:
+        data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if 'user_id' not in data or not ('expenses' in data or 'deleted_expenses' in data):
+        return jsonify({'error': 'Missing required data: user_id and expenses or deleted_expenses'}), 400
+
+    expenses, deleted_expenses = data.get('expenses', []), data.get('deleted_expenses', [])
+    rows = expenses + deleted_expenses if isinstance(expenses, list) and isinstance(deleted_expenses, list) else None
+    if rows is None or not all(isinstance(row, dict) and {'amount', 'date', 'category'} <= row.keys() for row in rows):
+        return jsonify({'error': 'expenses and deleted_expenses should be lists of {amount, date, category}'}), 400
+
+    # Every row is parsed before anything is written
+    try:
+        changed_dates = pd.to_datetime([row['date'] for row in rows])
+        updated_buckets = ingest_expenses(data['user_id'], expenses, deleted_expenses=deleted_expenses, replace=bool(data.get('replace', False)))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Malformed expenses: {e}'}), 400
+
+    # Analyses of this user were computed from the old rollups, and changed closed months need a new forecast state
+    result_cache.invalidate(user_fingerprint(data))
+    analysis_states.invalidate(user_fingerprint(data))
+    spend_indexes.invalidate(user_fingerprint(data))
+    if data.get('replace'):
+        invalidate_forecast_state(data['user_id'])
+    elif len(changed_dates):
+        first_changed = changed_dates.min()
+        invalidate_forecast_state(data['user_id'], first_changed.year, first_changed.month)
+
+    return jsonify({'updated_buckets': updated_buckets})
+
+
+# API endpoint for appending new (and deleted) expenses to a user's columnar history, which /analysis and
+# /label_categories read instead of a payload history when given "history_source": "store"
+@app.route('/history/ingest', methods=['POST'])
+def ingest_history():
+    try:
+        data = read_payload(request, ('expenses', 'deleted_expenses'))
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if 'user_id' not in data or not ('expenses' in data or 'deleted_expenses' in data):
+        return jsonify({'error': 'Missing required data: user_id and expenses or deleted_expenses'}), 400
+
+    try:
+        appended_rows = append_expenses(data['user_id'], data.get('expenses'), data.get('deleted_expenses'), replace=bool(data.get('replace', False)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Analyses of this user were computed from the old history, and removed expenses can't be taken out of the
+    # anomaly statistics (they are rebuilt from the history on the next score)
+    result_cache.invalidate(user_fingerprint(data))
+    analysis_states.invalidate(user_fingerprint(data))
+    spend_indexes.invalidate(user_fingerprint(data))
+    if data.get('deleted_expenses') or data.get('replace'):
+        anomaly_scorer.forget(data['user_id'])
+    return jsonify({'appended_rows': appended_rows, **history_stats(data['user_id'])})
+
+
+# Per-user running statistics of expense amounts for /anomaly/score, kept in memory and written back periodically
+anomaly_scorer = AnomalyScorer(
+    max_users=int(os.getenv("ANOMALY_CACHE_SIZE", 10000)),
+    flush_seconds=float(os.getenv("ANOMALY_FLUSH_SECONDS", 5))
+)
+atexit.register(anomaly_scorer.close)
+
+
+# Anomaly statistics of a user from the columnar history, when the user has one
+def stored_anomaly_state(user_id):
+    if not has_history(user_id):
+        return None
+    history, _ = load_stored_history(user_id)
+    return build_anomaly_state(history)
+
+
+# API endpoint for scoring one expense at entry time against the user's past expenses of the same category:
+# {"unusual", z-scores, "percentile", ...}; the expense is then added to the statistics unless "record" is false
+@app.route('/anomaly/score', methods=['POST'])
+def score_expense():
+    trace = RequestTrace('anomaly_score')
+    try:
+        data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    expense = data.get('expense')
+    if data.get('user_id') is None or not isinstance(expense, dict) or 'amount' not in expense or 'category' not in expense:
+        return jsonify({'error': 'Missing required data: user_id and expense (amount, category)'}), 400
+
+    try:
+        amount = float(expense['amount'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'amount should be a number'}), 400
+    if not math.isfinite(amount):
+        return jsonify({'error': 'amount should be a finite number'}), 400
+
+    with trace.stage('score'):
+        result = anomaly_scorer.score(data['user_id'], amount, expense['category'], record=bool(data.get('record', True)),
+                                      rebuild=lambda: stored_anomaly_state(data['user_id']))
+    trace.finish(app.logger, SLOW_REQUEST_SECONDS)
     return jsonify(result)
 
 
+# API endpoint for rebuilding a user's anomaly statistics from "past_expenses", or from the columnar history
+@app.route('/anomaly/rebuild', methods=['POST'])
+def rebuild_anomaly_state():
+    try:
+        data = read_payload(request, ('past_expenses',))
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if data.get('user_id') is None:
+        return jsonify({'error': 'Missing required data: user_id'}), 400
+
+    if 'past_expenses' in data:
+        state = build_anomaly_state(expenses_frame(data['past_expenses']))
+    else:
+        state = stored_anomaly_state(data['user_id'])
+        if state is None:
+            return jsonify({'error': 'Missing required data: past_expenses (the user has no stored history)'}), 400
+
+    anomaly_scorer.replace(data['user_id'], state)
+    return jsonify({'categories': {category or 'all': stats.n for category, stats in state.categories.items()}})
+
+
 # API endpoint for rule-based labeling only
 @app.route('/label_categories', methods=['POST'])
 def labeling_endpoint():
-    data = request.json
+    trace = RequestTrace('label_categories')
+    try:
+        with trace.stage('parse_payload', bytes=request.content_length or 0):
+            data = read_payload(request)
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
     if data.get('password') != FLASK_PASSWORD:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    if 'past_expenses' not in data:
+    # Past expenses come from the payload, or ("history_source": "store") from the user's columnar history
+    from_store = 'past_expenses' not in data and data.get('history_source') == 'store' and 'user_id' in data
+    if 'past_expenses' not in data and not from_store:
         return jsonify({'error': 'Missing required data: past_expenses'}), 400
 
-    past_expenses = pd.DataFrame(data['past_expenses'])
-    past_expenses['date'] = pd.to_datetime(past_expenses['date'])
+    cache_key = payload_hash('label_categories', data, LABELING_CACHE_FIELDS)
+    cached_result = result_cache.get(cache_key, user_fingerprint(data))
+    if cached_result is not None:
+        return jsonify(cached_result)
+
+    if from_store:
+        with trace.stage('load_history'):
+            past_expenses, past_context = load_stored_history(data['user_id'])
+    else:
+        past_expenses, past_context = expenses_frame(data['past_expenses']), None
 
     labaled_categories = []
     if len(past_expenses) >= 5:
-        Rule_Based_labeling(past_expenses, labaled_categories)
+        processes = get_stage_processes()
+        with trace.stage('Rule_Based_labeling', rows=len(past_expenses)):
+            if processes is None:
+                Rule_Based_labeling(past_expenses, labaled_categories, context=past_context)
+            else:
+                with SharedExpenses(past_context or AnalysisContext(past_expenses), 'past_expenses') as shared:
+                    labaled_categories = processes.submit(importance_labels_task, shared.descriptor).result()
+
+    result = {'labaled_categories': labaled_categories}
+    result_cache.set(cache_key, result, user_fingerprint(data))
+    response = jsonify(result)
+    trace.finish(app.logger, SLOW_REQUEST_SECONDS)
+    return response
+
+
+# API endpoint for re-labeling many users at once (nightly job): "past_expenses" rows carry a "user_id"
+@app.route('/label_categories/batch', methods=['POST'])
+def batch_labeling_endpoint():
+    trace = RequestTrace('label_categories_batch')
+    try:
+        data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
 
-    return jsonify({'labaled_categories': labaled_categories})
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if 'past_expenses' not in data:
+        return jsonify({'error': 'Missing required data: past_expenses'}), 400
+
+    # Rows only: a columnar frame has no per-expense user_id
+    if not isinstance(data['past_expenses'], list):
+        return jsonify({'error': 'past_expenses should be a list of expenses with a user_id'}), 400
+    try:
+        past_expenses = expenses_frame(data['past_expenses'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Malformed past_expenses: {e}'}), 400
+    if len(past_expenses) > 0 and 'user_id' not in past_expenses:
+        return jsonify({'error': 'Every past expense needs a user_id'}), 400
+
+    labeled_users = []
+    if len(past_expenses) > 0:
+        with trace.stage('batch_rule_based_labeling', rows=len(past_expenses)):
+            labeled = batch_rule_based_labeling(past_expenses)
+        labeled_users = [{'user_id': user_id, 'predicted_importance': importance} for user_id, importance in labeled.items()]
+
+    response = jsonify({'labaled_users': labeled_users})
+    trace.finish(app.logger, SLOW_REQUEST_SECONDS)
+    return response
+
+
+# API endpoint for dropping cached results of one user ("user_id") or of everyone
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    try:
+        data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user = user_fingerprint(data) if 'user_id' in data else None
+    removed = result_cache.invalidate(user)
+    spend_indexes.invalidate(user)
+    # /analysis/delta states were built by the analyses just dropped, so they go too (the next full run rebuilds them)
+    analysis_states.invalidate(user)
+    return jsonify({'removed_entries': removed})
+
+
+# API endpoint for result cache hit/miss counters
+@app.route('/cache/stats', methods=['POST'])
+def cache_stats():
+    try:
+        data = read_payload(request, ())
+    except UnsupportedPayload as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': f'Malformed payload: {e}'}), 400
+
+    if data.get('password') != FLASK_PASSWORD:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify(result_cache.stats())
 
 
 # API endpoint for calling LLM "Gemini Flash 2.0 Experimental"
@@ -266,19 +621,32 @@ def chat():
 
     # Option 1 (Z.AI: GLM 4.5 Air): z-ai/glm-4.5-air:free
     # Option 2 (Mistral Small 3.2 24B): mistralai/mistral-small-3.2-24b-instruct:free
-    data = json.dumps({
+    data = {
         "model": "z-ai/glm-4.5-air:free",
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message}
         ]
-    })
+    }
 
-    response = requests.post(
-        url="https://openrouter.ai/api/v1/chat/completions",
-        headers=headers,
-        data=data
-    )
+    try:
+        # Streaming mode relays the model's server-sent events as they arrive
+        if request.json.get("stream"):
+            response, events, release = llm_client.stream(headers, data)
+            if events is not None:
+                streamed = Response(stream_with_context(events), mimetype='text/event-stream',
+                                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+                # The upstream slot is given back when the response is closed, even if the body was never iterated
+                streamed.call_on_close(release)
+                return streamed
+        else:
+            response = llm_client.complete(headers, data)
+    except LLMBusy as e:
+        return jsonify({"error": str(e)}), 503
+    except requests.exceptions.Timeout:
+        return jsonify({"error": "The language model took too long to respond"}), 504
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Failed to reach the language model", "details": str(e)}), 502
 
     if response.status_code != 200:
         return jsonify({"error": "Failed to fetch response", "details": response.text}), response.status_code
@@ -286,5 +654,41 @@ def chat():
     return jsonify(response.json())
 
 
+# Prometheus scrape endpoint: per-stage latency and input size histograms plus result cache counters
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    cache_stats = result_cache.stats()
+    job_stats = analysis_jobs.stats()
+    body = render_metrics({
+        'result_cache_hits_total': ('counter', cache_stats['hits'] + cache_stats['disk_hits']),
+        'result_cache_misses_total': ('counter', cache_stats['misses']),
+        'result_cache_entries': ('gauge', cache_stats['entries']),
+        'analysis_jobs_queued': ('gauge', job_stats['queued']),
+        'analysis_jobs_running': ('gauge', job_stats['running']),
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+# Readiness probe: healthy only once the opt-in warm-up has run, with the startup-time breakdown
+@app.route('/ready', methods=['GET'])
+def ready():
+    return jsonify({'ready': is_ready(), **startup_report()}), 200 if is_ready() else 503
+
+
+# Drop everything the warm-up requests kept for their synthetic user: cached results, /analysis/delta state, spend index
+def forget_warmup_user():
+    user = user_fingerprint({'user_id': WARMUP_USER_ID})
+    result_cache.invalidate(user)
+    analysis_states.invalidate(user)
+    spend_indexes.invalidate(user)
+
+
+# Opt-in warm-up ("WARMUP_ON_START=1") runs the pipeline once on synthetic expenses in the background
+# (not in analysis job worker processes, which import this module too)
+if os.getenv("WARMUP_ON_START", "0").lower() in ("1", "true", "yes") and multiprocessing.parent_process() is None:
+    start_warmup(app, FLASK_PASSWORD, on_done=forget_warmup_user)
+
+
 if __name__ == '__main__':
+    app.logger.info("Startup breakdown: %s", startup_report())
     app.run(port=5000, debug=True)
@@ -0,0 +1,127 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from analysis_service import analyze
+from metrics import RequestTrace
+
+
+# Payloads of a JSONL dump (one /analysis payload per line) or a Parquet dump (one row per payload), read lazily
+def read_payloads(path, file_format=None, batch_size=1000):
+    file_format = file_format or ('parquet' if path.endswith('.parquet') else 'jsonl')
+
+    if file_format == 'jsonl':
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Reading Parquet dumps needs pyarrow installed")
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        # Columns a payload doesn't have (e.g. "all_expenses" for rollup users) come back as nulls
+        for row in batch.to_pylist():
+            yield {key: value for key, value in row.items() if value is not None}
+
+
+def _chunks(payloads, size):
+    payloads = iter(payloads)
+    while True:
+        chunk = list(islice(payloads, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Runs in a worker process: one output record per payload (its result or error) and the chunk's seconds per stage
+def analyze_chunk(payloads):
+    records = []
+    stage_seconds = {}
+    for payload in payloads:
+        trace = RequestTrace('batch_analysis')
+        try:
+            records.append({'user_id': payload.get('user_id'), 'result': analyze(payload, trace, save_state=False)})
+        except Exception as e:
+            # One bad payload must not stop the whole run
+            records.append({'user_id': payload.get('user_id'), 'error': f"{type(e).__name__}: {e}"})
+        for stage in trace.stages:
+            stage_seconds[stage['stage']] = stage_seconds.get(stage['stage'], 0.0) + stage['seconds']
+    return records, stage_seconds
+
+
+# Analyze every payload of "input_path" on a process pool, in chunks of "chunk_size" payloads with at most two chunks
+# per worker in flight, appending one JSON line per payload to "output_path" in input order as chunks complete
+def run_batch(input_path, output_path, workers=None, chunk_size=50, file_format=None, progress=None, progress_seconds=10):
+    workers = workers or multiprocessing.cpu_count()
+    summary = {'users': 0, 'errors': 0}
+    stage_seconds = {}
+    started = time.perf_counter()
+    last_progress = started
+
+    def write(records, chunk_stage_seconds):
+        nonlocal last_progress
+        for record in records:
+            output.write(json.dumps(record) + '\n')
+        summary['users'] += len(records)
+        summary['errors'] += sum(1 for record in records if 'error' in record)
+        for stage, seconds in chunk_stage_seconds.items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+
+        now = time.perf_counter()
+        if progress is not None and now - last_progress >= progress_seconds:
+            last_progress = now
+            progress.write(f"{summary['users']} users, {summary['users'] / (now - started):.1f} users/s\n")
+
+    chunks = _chunks(read_payloads(input_path, file_format), chunk_size)
+    with open(output_path, 'w', encoding='utf-8') as output:
+        if workers <= 1:
+            for chunk in chunks:
+                write(*analyze_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                in_flight = deque()
+                for chunk in chunks:
+                    in_flight.append(pool.submit(analyze_chunk, chunk))
+                    if len(in_flight) >= 2 * workers:
+                        write(*in_flight.popleft().result())
+                while in_flight:
+                    write(*in_flight.popleft().result())
+
+    seconds = time.perf_counter() - started
+    return {
+        **summary,
+        'seconds': round(seconds, 3),
+        'users_per_second': round(summary['users'] / seconds, 2) if seconds > 0 else None,
+        'stage_seconds': {stage: round(total, 3) for stage, total in sorted(stage_seconds.items(), key=lambda item: -item[1])},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze a JSONL or Parquet dump of per-user /analysis payloads on a process pool")
+    parser.add_argument('input', help="Payload dump: .jsonl (one payload per line) or .parquet (one row per payload)")
+    parser.add_argument('output', help="JSONL file receiving one {user_id, result | error} line per payload")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], help="Input format (default: from the file extension)")
+    parser.add_argument('--workers', type=int, help="Worker processes (default: one per CPU; 1 runs in this process)")
+    parser.add_argument('--chunk-size', type=int, default=50, help="Payloads sent to a worker at once")
+    parser.add_argument('--summary', help="Also write the run summary (throughput, per-stage seconds) to this JSON file")
+    args = parser.parse_args(argv)
+
+    summary = run_batch(args.input, args.output, args.workers, args.chunk_size, args.format, progress=sys.stderr)
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import business_logic
+import ml_models
+import serialization
+from synthetic_data import category_names, generate_expenses, generate_rows, to_payload_rows
+
+# (name, input kind, call) - "history" is closed months, "current" is one month of expenses, "categories" a priority table,
+# "users" one month of expenses of many users (about 30 rows each), "user_categories" their priority tables and "response"
+# the per-category analysis outputs of rows // 100 categories
+BENCHMARKS = [
+    ('ml_models.linear_regression', 'history', lambda frame: ml_models.linear_regression(frame, [])),
+    ('ml_models.category_linear_regression', 'history', lambda frame: ml_models.category_linear_regression(frame, {})),
+    ('ml_models.kmeans_clustering', 'current', lambda frame: ml_models.kmeans_clustering(frame, [], [])),
+    ('ml_models.spending_kmeans_clustering', 'current', lambda frame: ml_models.spending_kmeans_clustering(frame, [])),
+    ('ml_models.frequency_kmeans_clustering', 'current', lambda frame: ml_models.frequency_kmeans_clustering(frame, [])),
+    ('ml_models.get_association_rules', 'current',
+     lambda frame: ml_models.get_association_rules(frame, [], min_support=0.1, min_confidence=0.3, min_lift=1.0)),
+    ('ml_models.Rule_Based_labeling', 'history', lambda frame: ml_models.Rule_Based_labeling(frame, [])),
+    ('business_logic.assign_limits', 'categories', lambda frame: business_logic.assign_limits(frame, 10000)),
+    ('business_logic.predictive_insights', 'current', lambda frame: business_logic.predictive_insights(frame)),
+    ('business_logic.analyze_spending_variability', 'current',
+     lambda frame: business_logic.analyze_spending_variability(frame, [])),
+    ('business_logic.analyze_spending_deviations', 'history_and_current',
+     lambda frames: business_logic.analyze_spending_deviations(frames[1], frames[0], [])),
+    ('business_logic.day_of_week_analysis', 'current', lambda frame: business_logic.day_of_week_analysis(frame, [])),
+    ('business_logic.batch_predictive_insights', 'users', lambda frame: business_logic.batch_predictive_insights(frame)),
+    ('business_logic.batch_assign_limits', 'user_categories',
+     lambda frame: business_logic.batch_assign_limits(frame, pd.Series(10000.0, index=pd.unique(frame['user_id'])))),
+    ('business_logic.batch_day_of_week_analysis', 'users', lambda frame: business_logic.batch_day_of_week_analysis(frame)),
+    # Response encoding as Flask's default provider did it (to_dict records, stdlib json) against the serialization layer
+    ('serialization.stdlib_json', 'response', lambda values: json.dumps(
+        {**values, 'category_limits': values['category_limits'].to_dict(orient='records')}, sort_keys=True, separators=(',', ':'))),
+    ('serialization.dumps', 'response',
+     lambda values: serialization.dumps({**values, 'category_limits': serialization.records(values['category_limits'])})),
+]
+
+
+# Build the inputs of one benchmark size (history ends where the current month starts)
+def build_inputs(rows, months, categories, seed):
+    history = generate_rows(rows, months=months, categories=categories, seed=seed, end='2025-01-01').drop(columns='user_id')
+    current = generate_rows(rows, months=1, categories=categories, seed=seed + 1, end='2025-02-01').drop(columns='user_id')
+    priorities = pd.DataFrame({'name': category_names(rows), 'priority': np.arange(rows) % 5 + 1})
+    users = max(rows // 30, 1)
+    user_expenses = generate_expenses(users=users, months=1, categories=categories, expenses_per_day=rows / (users * 31),
+                                      seed=seed + 2, end='2025-02-01')
+    user_priorities = pd.DataFrame({
+        'user_id': np.repeat(np.arange(users), categories),
+        'name': np.tile(category_names(categories), users),
+        'priority': np.arange(users * categories) % 5 + 1,
+    })
+    return {'history': history, 'current': current, 'categories': priorities, 'history_and_current': (history, current),
+            'users': user_expenses, 'user_categories': user_priorities, 'response': build_response_values(rows, months, seed)}
+
+
+# Forecasts, limits and clusterings of rows // 100 categories (all forecasts kept), as they are before being encoded
+def build_response_values(rows, months, seed):
+    category_count = max(rows // 100, 1)
+    history = generate_rows(rows, months=months, categories=category_count, seed=seed + 3, end='2025-01-01').drop(columns='user_id')
+    category_predictions, spending_clustering, frequency_clustering = {}, [], []
+    ml_models.category_linear_regression(history, category_predictions, accuracy_threshold=0, correlation_threshold=0)
+    ml_models.spending_kmeans_clustering(history, spending_clustering)
+    ml_models.frequency_kmeans_clustering(history, frequency_clustering)
+    priorities = pd.DataFrame({'name': category_names(category_count), 'priority': np.arange(category_count) % 5 + 1})
+    return {
+        'category_predictions': category_predictions,
+        'category_limits': business_logic.assign_limits(priorities, 10000),
+        'spending_clustering': spending_clustering,
+        'frequency_clustering': frequency_clustering,
+    }
+
+
+# Fresh copy per run, since several analysis functions add columns to their inputs
+def _fresh(value):
+    return tuple(frame.copy() for frame in value) if isinstance(value, tuple) else value.copy()
+
+
+def time_call(call, value, repeat):
+    timings = []
+    for _ in range(repeat):
+        argument = _fresh(value)
+        start = time.perf_counter()
+        call(argument)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+# End-to-end /analysis through the Flask test client with the result cache switched off
+def time_analysis_route(inputs, repeat):
+    os.environ.setdefault('FLASK_PASSWORD', 'benchmark')
+    import app as app_module
+    from result_cache import ResultCache
+    original_cache, original_level = app_module.result_cache, app_module.app.logger.level
+    app_module.result_cache = ResultCache(max_entries=0)
+    app_module.app.logger.setLevel('ERROR')
+    client = app_module.app.test_client()
+
+    expenses = to_payload_rows(inputs['current'])
+    body = json.dumps({
+        'password': app_module.FLASK_PASSWORD,
+        'expenses': expenses,
+        'all_expenses': to_payload_rows(inputs['history']) + expenses,
+        'categories': [{'name': name, 'priority': i % 5 + 1}
+                       for i, name in enumerate(sorted(inputs['current']['category'].unique()))],
+        'monthly_budget': float(inputs['current']['amount'].sum()),
+        'goal_amount': 0,
+        'total_spent': float(inputs['current']['amount'].sum()),
+    })
+
+    timings = []
+    try:
+        for _ in range(repeat):
+            # Every repeat takes the cold path: no per-user state kept by an earlier repeat is reused
+            app_module.spend_indexes.invalidate()
+            app_module.analysis_states.invalidate()
+            start = time.perf_counter()
+            response = client.post('/analysis', data=body, content_type='application/json')
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f"/analysis returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    finally:
+        app_module.result_cache = original_cache
+        app_module.app.logger.setLevel(original_level)
+
+    return timings, len(body)
+
+
+def summarize(target, rows, timings, **extra):
+    return {
+        'target': target,
+        'rows': rows,
+        'repeat': len(timings),
+        'min_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'mean_seconds': statistics.fmean(timings),
+        **extra,
+    }
+
+
+# Log-log slope of median time against rows: ~1 is linear scaling, ~2 quadratic
+def scaling_exponents(results):
+    exponents = {}
+    for target in dict.fromkeys(result['target'] for result in results):
+        points = [(result['rows'], result['median_seconds']) for result in results
+                  if result['target'] == target and result['median_seconds'] > 0]
+        if len(points) >= 2:
+            rows, seconds = np.log10(np.array(points, dtype=float)).T
+            exponents[target] = round(float(np.polyfit(rows, seconds, 1)[0]), 3)
+    return exponents
+
+
+# Median-time ratio (current / baseline) for every (target, rows) present in both runs
+def compare_runs(results, baseline):
+    previous = {(result['target'], result['rows']): result['median_seconds'] for result in baseline['results']}
+    return [
+        {'target': result['target'], 'rows': result['rows'],
+         'ratio': round(result['median_seconds'] / previous[(result['target'], result['rows'])], 3)}
+        for result in results if previous.get((result['target'], result['rows']))
+    ]
+
+
+def run(sizes, repeat=3, months=24, categories=12, seed=42, only=None, max_route_rows=100000, log=print):
+    results = []
+    for rows in sizes:
+        inputs = build_inputs(rows, months, categories, seed)
+
+        for target, kind, call in BENCHMARKS:
+            if only and only not in target:
+                continue
+            timings = time_call(call, inputs[kind], repeat)
+            results.append(summarize(target, rows, timings))
+            log(f"{target:<48} {rows:>10} rows  {statistics.median(timings) * 1000:>10.2f} ms")
+
+        if (not only or only in 'app./analysis') and rows <= max_route_rows:
+            timings, payload_bytes = time_analysis_route(inputs, repeat)
+            results.append(summarize('app./analysis', rows, timings, payload_bytes=payload_bytes))
+            log(f"{'app./analysis':<48} {rows:>10} rows  {statistics.median(timings) * 1000:>10.2f} ms")
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sizes': list(sizes),
+            'repeat': repeat,
+            'months': months,
+            'categories': categories,
+            'seed': seed,
+        },
+        'results': results,
+        'scaling': scaling_exponents(results),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every ml_models/business_logic function and /analysis on synthetic expenses")
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help="Comma separated row counts (up to 10000000)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--months', type=int, default=24, help="Months of history the rows are spread over")
+    parser.add_argument('--categories', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', help="Only run targets whose name contains this text")
+    parser.add_argument('--max-route-rows', type=int, default=100000, help="Largest size sent through the /analysis route")
+    parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+    parser.add_argument('--compare', help="Previous results JSON to compare median times against")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = run(sizes, args.repeat, args.months, args.categories, args.seed, args.only, args.max_route_rows)
+
+    print("\nScaling exponents (log-log slope of time vs rows):")
+    for target, exponent in report['scaling'].items():
+        print(f"  {target:<48} {exponent}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            report['comparison'] = compare_runs(report['results'], json.load(f))
+        print("\nMedian time ratio against baseline (<1 is faster):")
+        for entry in report['comparison']:
+            print(f"  {entry['target']:<48} {entry['rows']:>10} rows  x{entry['ratio']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
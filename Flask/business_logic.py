@@ -1,4 +1,7 @@
+import numpy as np
 import pandas as pd
+from analysis_context import AnalysisContext, WEEKDAY_NAMES, NANOSECONDS_PER_DAY
+from spend_index import CumulativeSpendIndex
 
 # Assign limits to categories based on priority
 def assign_limits(categories, allowed_spending):
@@ -9,15 +12,19 @@ def assign_limits(categories, allowed_spending):
 
 
 # Predict total spending for the current month using daily average
-def predictive_insights(expenses):
-    total_days_in_month = expenses['date'].dt.daysinmonth.max()
-    days_elapsed = (expenses['date'].max() - expenses['date'].min()).days + 1
+def predictive_insights(expenses, context=None):
+    context = context or AnalysisContext(expenses)
+    if context.size == 0:
+        return None
+
+    total_days_in_month = context.days_in_month()
+    days_elapsed = context.elapsed_days() + 1
 
     if days_elapsed > 0:
-        average_daily_spending = expenses['amount'].sum() / days_elapsed
+        average_daily_spending = context.amounts.sum() / days_elapsed
         remaining_days = total_days_in_month - days_elapsed
         predicted_remaining_spending = average_daily_spending * remaining_days
-        predicted_total_spending = expenses['amount'].sum() + predicted_remaining_spending
+        predicted_total_spending = context.amounts.sum() + predicted_remaining_spending
         return round(predicted_total_spending, 2)
     return None
 
@@ -52,17 +59,13 @@ def predictive_insights(expenses):
 
 
 # Analyze category spending variability
-def analyze_spending_variability(expenses, smart_insights):
-    category_expense_counts = expenses['category'].value_counts()
+def analyze_spending_variability(expenses, smart_insights, context=None):
+    context = context or AnalysisContext(expenses)
+    category_expense_counts = context.category_counts()
     valid_categories = category_expense_counts[category_expense_counts >= 2].index
 
     if len(valid_categories) >= 2:
-        category_variability = (
-            expenses[expenses['category'].isin(valid_categories)]
-            .groupby('category')['amount']
-            .std()
-            .sort_values(ascending=False)
-        )
+        category_variability = context.category_stds()[valid_categories].sort_values(ascending=False)
 
         if not category_variability.empty:
             most_variable_category = category_variability.idxmax()
@@ -71,29 +74,16 @@ def analyze_spending_variability(expenses, smart_insights):
 
 
 # Analyze deviations in spending by comparing current trends with historical averages
-def analyze_spending_deviations(expenses, distinct_all_expenses, smart_insights):
-    distinct_all_expenses['year_month'] = distinct_all_expenses['date'].dt.to_period('M')
-    distinct_all_expenses['day_of_month'] = distinct_all_expenses['date'].dt.day
-
-    historical_spending_trend = (
-        distinct_all_expenses.groupby(['year_month', 'category', 'day_of_month'])['amount'].sum()
-        .groupby(['year_month', 'category'])
-        .cumsum()
-        .groupby(['category', 'day_of_month'])
-        .mean()
-        .unstack()
-        .ffill(axis=1)
-        .stack()
-    )
-
-    days_so_far = expenses['date'].dt.day.max()
-    historical_reference = (
-        historical_spending_trend[historical_spending_trend.index.get_level_values('day_of_month') == days_so_far]
-        .groupby('category')
-        .mean()
-    )
-
-    current_month_spending = expenses.groupby('category')['amount'].sum()
+# The historical curve comes from the user's cached spend index when given, otherwise it is built from the history
+def analyze_spending_deviations(expenses, distinct_all_expenses, smart_insights, spend_index=None, context=None):
+    context = context or AnalysisContext(expenses)
+    if spend_index is None:
+        spend_index = CumulativeSpendIndex()
+
+    days_so_far = int(context.day.max())
+    historical_reference = spend_index.lookup(distinct_all_expenses, days_so_far)
+
+    current_month_spending = context.category_sums()
     historical_reference = historical_reference.reindex(current_month_spending.index, fill_value=0)
     deviations = (current_month_spending - historical_reference).sort_values(ascending=False)
 
@@ -117,18 +107,98 @@ def analyze_spending_deviations(expenses, distinct_all_expenses, smart_insights)
 
 
 # Day-of-week spending analysis to identify peak spending days
-def day_of_week_analysis(expenses, smart_insights):
-    expenses['day_of_week'] = expenses['date'].dt.day_name()
+def day_of_week_analysis(expenses, smart_insights, context=None):
+    context = context or AnalysisContext(expenses)
 
-    weekday_counts = expenses['day_of_week'].value_counts().reindex(
-        ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday'], fill_value=0
-    )
+    weekday_counts = pd.Series(np.bincount(context.weekday, minlength=7), index=WEEKDAY_NAMES)
 
-    weekday_spending = expenses.groupby('day_of_week')['amount'].mean().reindex(
-        ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
-    )
+    weekday_spending = pd.Series(context.amounts).groupby(context.weekday).mean().reindex(range(7))
+    weekday_spending.index = WEEKDAY_NAMES
 
     if len(weekday_counts[weekday_counts > 0]) >= 2:
         peak_count_day = weekday_counts.idxmax()
         peak_spending_day = weekday_spending.idxmax()
         smart_insights.append(f"You have the highest number of expenses on {peak_count_day}s, and the highest spending on {peak_spending_day}s. Plan ahead!")
+
+
+# Rows grouped by user for the batch variants: user ids in order of appearance, the stable order that puts each
+# user's rows together (keeping their order, so reductions add the same numbers in the same order as a single call)
+# and where each user's rows start in that order
+def _user_groups(frame, user_column):
+    user_codes, user_ids = pd.factorize(frame[user_column])
+    order = np.argsort(user_codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(user_codes[order]) != 0]) if len(order) else np.empty(0, dtype=np.intp)
+    return user_ids, user_codes, order, starts
+
+
+# predictive_insights for the current month of many users at once (rows carrying a "user_id" column):
+# {user_id: predicted total}, from grouped reductions instead of one call per user
+def batch_predictive_insights(expenses, user_column='user_id'):
+    if len(expenses) == 0:
+        return {}
+    context = AnalysisContext(expenses)
+    user_ids, _, order, starts = _user_groups(expenses, user_column)
+
+    months = context.month_keys.astype('datetime64[M]')
+    month_lengths = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    timestamps = context.timestamps[order]
+
+    total_days_in_month = np.maximum.reduceat(month_lengths[order], starts)
+    days_elapsed = (np.maximum.reduceat(timestamps, starts) - np.minimum.reduceat(timestamps, starts)) // NANOSECONDS_PER_DAY + 1
+    # Sums per user slice rather than np.add.reduceat, which adds sequentially where ndarray.sum (used by
+    # predictive_insights) adds pairwise, so totals could differ in the last bit and round to another cent
+    amounts = context.amounts[order]
+    spent = np.array([amounts[start:end].sum() for start, end in zip(starts, np.r_[starts[1:], len(amounts)])])
+
+    average_daily_spending = spent / days_elapsed
+    predicted_total_spending = spent + average_daily_spending * (total_days_in_month - days_elapsed)
+    # np.round like round() on the NumPy scalar in predictive_insights (Python's round on a float can differ at .5)
+    return {user_id: float(predicted) for user_id, predicted in zip(user_ids, np.round(predicted_total_spending, 2))}
+
+
+# assign_limits for many users' priority tables (rows carrying a "user_id" column) and their allowed spending
+# ({user_id: amount} or a Series): a frame of user_id, name and limit in the input's row order
+def batch_assign_limits(categories, allowed_spending, user_column='user_id'):
+    if len(categories) == 0:
+        return pd.DataFrame({user_column: [], 'name': [], 'limit': []})
+    user_ids, user_codes, order, starts = _user_groups(categories, user_column)
+    priorities = categories['priority'].to_numpy()
+
+    max_priority = np.maximum.reduceat(priorities[order], starts)[user_codes]
+    weights = (max_priority + 1) - priorities
+    weight_sums = np.empty(len(user_ids), dtype=weights.dtype)
+    weight_sums[:] = np.add.reduceat(weights[order], starts)
+    allowed = pd.Series(allowed_spending).reindex(user_ids).to_numpy(dtype=float)
+
+    return pd.DataFrame({
+        user_column: categories[user_column].to_numpy(),
+        'name': categories['name'].to_numpy(),
+        'limit': (weights / weight_sums[user_codes]) * allowed[user_codes],
+    })
+
+
+# day_of_week_analysis for many users (rows carrying a "user_id" column): {user_id: insights}, with the weekday
+# counts and mean amounts of every user from one bincount and one grouped mean
+def batch_day_of_week_analysis(expenses, user_column='user_id'):
+    if len(expenses) == 0:
+        return {}
+    context = AnalysisContext(expenses)
+    user_ids, user_codes, _, _ = _user_groups(expenses, user_column)
+    users = len(user_ids)
+
+    cells = user_codes * 7 + context.weekday
+    weekday_counts = np.bincount(cells, minlength=users * 7).reshape(users, 7)
+    means = pd.Series(context.amounts).groupby(cells).mean()
+    weekday_spending = np.full(users * 7, -np.inf)
+    weekday_spending[means.index.to_numpy()] = means.to_numpy()
+    weekday_spending = weekday_spending.reshape(users, 7)
+
+    peak_count_days = weekday_counts.argmax(axis=1)
+    peak_spending_days = weekday_spending.argmax(axis=1)
+    active_days = (weekday_counts > 0).sum(axis=1)
+
+    return {
+        user_id: [f"You have the highest number of expenses on {WEEKDAY_NAMES[count_day]}s, and the highest spending on {WEEKDAY_NAMES[spending_day]}s. Plan ahead!"]
+        if active >= 2 else []
+        for user_id, count_day, spending_day, active in zip(user_ids, peak_count_days, peak_spending_days, active_days)
+    }
@@ -0,0 +1,198 @@
+import json
+import numpy as np
+import pandas as pd
+
+from analysis_context import AnalysisContext, dictionary_codes
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+ARROW_MIMETYPES = ('application/vnd.apache.arrow.stream',)
+
+# Default little-endian layout of binary columns: float amounts, epoch-day dates and dictionary-encoded category codes
+COLUMN_DTYPES = {'amount': '<f8', 'date': '<i4', 'category': '<i4'}
+
+# Kinds of dtype a client may send per column ("dtypes"): integers or floats for amounts, integers for the rest
+COLUMN_DTYPE_KINDS = {'amount': 'iuf', 'date': 'iu', 'category': 'iu'}
+
+
+# Raised when the request body is in a format this service can't read
+class UnsupportedPayload(ValueError):
+    pass
+
+
+# Wrap binary buffers as NumPy views without copying (lists are converted as a fallback)
+def _column(value, dtype):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype=dtype)
+    return np.asarray(value, dtype=dtype)
+
+
+# The dtype of one column: the default layout, or the client's "dtypes" entry when it is a plain integer/float type
+def _column_dtype(frame, name):
+    requested = (frame.get('dtypes') or {}).get(name, COLUMN_DTYPES[name])
+    try:
+        dtype = np.dtype(requested)
+    except TypeError:
+        raise ValueError(f"Columnar frame has an invalid dtype for {name}: {requested!r}")
+    if dtype.kind not in COLUMN_DTYPE_KINDS[name] or dtype.fields is not None or dtype.shape:
+        raise ValueError(f"Columnar frame has an unsupported dtype for {name}: {requested!r}")
+    return dtype
+
+
+# Decode one columnar frame: {"amount", "date", "category", "categories"[, "dtypes"]}
+# Malformed frames (missing or ragged columns, unsupported dtypes, category codes outside "categories") raise ValueError
+def decode_columns(frame):
+    missing = [name for name in (*COLUMN_DTYPES, 'categories') if name not in frame]
+    if missing:
+        raise ValueError(f"Columnar frame is missing {', '.join(missing)}")
+    if not isinstance(frame.get('dtypes') or {}, dict):
+        raise ValueError("Columnar frame dtypes must be an object")
+
+    try:
+        columns = {name: _column(frame[name], _column_dtype(frame, name)) for name in COLUMN_DTYPES}
+    except TypeError as e:
+        raise ValueError(f"Columnar frame has an invalid column: {e}")
+    if any(column.ndim != 1 for column in columns.values()):
+        raise ValueError("Columnar frame columns must be flat")
+
+    if not len(columns['amount']) == len(columns['date']) == len(columns['category']):
+        raise ValueError("Columnar frame has columns of different lengths")
+
+    columns['categories'] = list(frame['categories'])
+    codes = columns['category']
+    if len(codes) and (codes.min() < 0 or codes.max() >= len(columns['categories'])):
+        raise ValueError("Columnar frame has category codes outside its categories")
+    return columns
+
+
+def _decode_frames(data, frame_names):
+    if isinstance(data, dict):
+        for name in frame_names:
+            if isinstance(data.get(name), dict):
+                data[name] = decode_columns(data[name])
+    return data
+
+
+# msgpack body: a map with the usual JSON fields, where expense lists are replaced by columnar frames
+def _read_msgpack(body, frame_names):
+    try:
+        import msgpack
+    except ImportError:
+        raise UnsupportedPayload("msgpack payloads require the 'msgpack' package")
+
+    return _decode_frames(msgpack.unpackb(body, raw=False), frame_names)
+
+
+# The Arrow table has to hold numeric amounts, date32 or integer dates and a dictionary-encoded category column
+def _check_arrow_schema(pa, schema):
+    missing = [name for name in COLUMN_DTYPES if schema.get_field_index(name) < 0]
+    if missing:
+        raise ValueError(f"Arrow table is missing {', '.join(missing)}")
+    if not (pa.types.is_integer(schema.field('amount').type) or pa.types.is_floating(schema.field('amount').type)):
+        raise ValueError("Arrow amount column must be numeric")
+    if not (pa.types.is_date32(schema.field('date').type) or pa.types.is_integer(schema.field('date').type)):
+        raise ValueError("Arrow date column must be date32 or days since 1970")
+    if not pa.types.is_dictionary(schema.field('category').type):
+        raise ValueError("Arrow category column must be dictionary-encoded")
+
+
+# Arrow IPC stream body: one table (amount, date, category) holding all frames back to back
+# The schema metadata "payload" carries the other JSON fields plus "frames": {name: [offset, length]}
+def _read_arrow(body):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise UnsupportedPayload("Arrow payloads require the 'pyarrow' package")
+
+    try:
+        table = pa.ipc.open_stream(body).read_all().unify_dictionaries().combine_chunks()
+    except pa.ArrowException as e:
+        raise ValueError(f"Invalid Arrow stream: {e}")
+    _check_arrow_schema(pa, table.schema)
+    data = json.loads((table.schema.metadata or {}).get(b'payload', b'{}'))
+    if not isinstance(data, dict):
+        raise ValueError("Arrow payload metadata must be a JSON object")
+    frames = data.pop('frames', {})
+
+    if not isinstance(frames, dict) or not all(
+            isinstance(bounds, list) and len(bounds) == 2 and all(isinstance(bound, int) and bound >= 0 for bound in bounds)
+            and sum(bounds) <= table.num_rows for bounds in frames.values()):
+        raise ValueError("Arrow payload frames must map names to [offset, length] within the table")
+
+    if table.num_rows == 0:
+        amount, date, codes, categories = np.array([]), np.array([], dtype=np.int32), np.array([], dtype=np.int32), []
+    else:
+        # Columns with nulls are rejected (zero-copy to_numpy raises on them)
+        try:
+            amount = table.column('amount').chunk(0).to_numpy()
+            date = table.column('date').chunk(0)
+            date = date.view(pa.int32()) if pa.types.is_date32(date.type) else date
+            date = date.to_numpy()
+            category = table.column('category').chunk(0)
+            codes = category.indices.to_numpy()
+            categories = category.dictionary.to_pylist()
+        except pa.ArrowException as e:
+            raise ValueError(f"Invalid Arrow columns: {e}")
+
+    for name, (offset, length) in frames.items():
+        data[name] = {
+            'amount': amount[offset:offset + length],
+            'date': date[offset:offset + length],
+            'category': codes[offset:offset + length],
+            'categories': categories,
+        }
+    return data
+
+
+# Read a request body as JSON (default), msgpack or Arrow IPC depending on its Content-Type; columnar frames (objects in
+# place of expense lists) are decoded in any of them
+def read_payload(request, frame_names=('expenses', 'all_expenses', 'past_expenses')):
+    if request.mimetype in MSGPACK_MIMETYPES:
+        return _read_msgpack(request.get_data(), frame_names)
+    if request.mimetype in ARROW_MIMETYPES:
+        return _read_arrow(request.get_data())
+    if request.is_json:
+        return _decode_frames(request.get_json(), frame_names)
+    raise UnsupportedPayload(f"Unsupported content type: {request.mimetype}")
+
+
+# Build an expenses DataFrame (amount, date, category) from JSON rows or from decoded columns (whose category column
+# is looked up from the dictionary; see expenses_context for handing the codes themselves to the analysis)
+def expenses_frame(value):
+    if isinstance(value, dict):
+        categories = np.asarray(value['categories'], dtype=object)
+        return pd.DataFrame({
+            'amount': value['amount'],
+            'date': value['date'].astype('datetime64[D]').astype('datetime64[ns]'),
+            'category': categories[value['category']],
+        })
+
+    if len(value) == 0:
+        return pd.DataFrame({'amount': [], 'date': pd.to_datetime([]), 'category': []})
+
+    frame = pd.DataFrame(value)
+    frame['date'] = pd.to_datetime(frame['date'])
+    return frame
+
+
+# AnalysisContext of expenses_frame(value), or of its rows selected by the boolean mask "rows": decoded columns hand
+# their dictionary codes over, so the category column is never factorized again
+def expenses_context(frame, value, rows=None):
+    if not isinstance(value, dict):
+        return AnalysisContext(frame)
+    codes = np.asarray(value['category'])
+    category_codes, categories = dictionary_codes(codes if rows is None else codes[rows], value['categories'])
+    return AnalysisContext(frame, category_codes=category_codes, categories=categories)
+
+
+# Encode expense rows as a columnar frame (used by clients and tests to build binary payloads)
+def encode_columns(rows):
+    categories = sorted({row['category'] for row in rows})
+    codes = {category: code for code, category in enumerate(categories)}
+    epoch = np.datetime64('1970-01-01', 'D')
+
+    return {
+        'amount': np.array([row['amount'] for row in rows], dtype=COLUMN_DTYPES['amount']).tobytes(),
+        'date': np.array([(np.datetime64(row['date'][:10], 'D') - epoch).astype(int) for row in rows], dtype=COLUMN_DTYPES['date']).tobytes(),
+        'category': np.array([codes[row['category']] for row in rows], dtype=COLUMN_DTYPES['category']).tobytes(),
+        'categories': categories,
+    }
@@ -0,0 +1,228 @@
+import argparse
+import json
+import sys
+from datetime import date
+import numpy as np
+import pandas as pd
+
+from rollup_store import connect as connect_rollups, load_history
+from ml_models import STAT_COLUMNS, fold_month, sufficient_stats, stats_linear_forecast
+from analysis_context import AnalysisContext
+
+
+# Open the rollup database with the forecast state tables next to the rollups they are derived from
+def connect(db_path=None):
+    conn = connect_rollups(db_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS forecast_stats (
+            user_id TEXT NOT NULL,
+            is_total INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            mean_x REAL NOT NULL,
+            mean_y REAL NOT NULL,
+            sxx REAL NOT NULL,
+            sxy REAL NOT NULL,
+            syy REAL NOT NULL,
+            PRIMARY KEY (user_id, is_total, category)
+        );
+        CREATE TABLE IF NOT EXISTS forecast_progress (
+            user_id TEXT PRIMARY KEY,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL
+        );
+    """)
+    return conn
+
+
+# A user's trend statistics over every closed month up to (last_year, last_month): the total and one row per category
+class ForecastState:
+    def __init__(self, last_year, last_month, total_stats, categories, category_stats):
+        self.last_year = last_year
+        self.last_month = last_month
+        self.total_stats = total_stats
+        self.categories = categories
+        self.category_stats = category_stats
+
+
+# Add one month's value to a series' statistics (x is the series' next month index), like sufficient_stats does
+def _fold(stats, y):
+    return fold_month(stats, [y])[0].tolist()
+
+
+def _read_progress(conn, user_id):
+    row = conn.execute("SELECT year, month FROM forecast_progress WHERE user_id = ?", (user_id,)).fetchone()
+    return (0, 0) if row is None else row
+
+
+# Fold the closed months after the last folded one and before (before_year, before_month) into a user's statistics,
+# one month at a time; returns the number of months folded (None when months from before_month on were already folded)
+def fold_closed_months(user_id, before_year, before_month, db_path=None):
+    user_id = str(user_id)
+    conn = connect(db_path)
+    try:
+        with conn:
+            # Take the write lock first so that concurrent requests can't fold the same month twice
+            conn.execute("BEGIN IMMEDIATE")
+            last_year, last_month = _read_progress(conn, user_id)
+            if last_year * 12 + last_month >= before_year * 12 + before_month:
+                return None
+
+            rows = conn.execute("""
+                SELECT year, month, category, amount FROM monthly_rollups
+                WHERE user_id = ? AND (year * 12 + month) > ? AND (year * 12 + month) < ?
+                ORDER BY year, month, category
+            """, (user_id, last_year * 12 + last_month, before_year * 12 + before_month)).fetchall()
+            if not rows:
+                return 0
+
+            stats = {
+                (is_total, category): list(values)
+                for is_total, category, *values in conn.execute(f"""
+                    SELECT is_total, category, {', '.join(STAT_COLUMNS)} FROM forecast_stats WHERE user_id = ?
+                """, (user_id,))
+            }
+            empty = [0.0] * len(STAT_COLUMNS)
+
+            months = pd.DataFrame(rows, columns=['year', 'month', 'category', 'amount']).groupby(['year', 'month'], sort=True)
+            for _, month in months:
+                amounts = month['amount'].astype(float)
+                stats[(1, '')] = _fold(stats.get((1, ''), empty), float(amounts.sum()))
+                for category, amount in zip(month['category'], amounts):
+                    stats[(0, category)] = _fold(stats.get((0, category), empty), float(amount))
+
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO forecast_stats (user_id, is_total, category, {', '.join(STAT_COLUMNS)})
+                VALUES (?, ?, ?, {', '.join('?' for _ in STAT_COLUMNS)})
+            """, [(user_id, is_total, category, *values) for (is_total, category), values in stats.items()])
+            conn.execute("INSERT OR REPLACE INTO forecast_progress (user_id, year, month) VALUES (?, ?, ?)",
+                         (user_id, int(rows[-1][0]), int(rows[-1][1])))
+            return months.ngroups
+    finally:
+        conn.close()
+
+
+# A user's stored statistics, or None when nothing was folded yet
+def load_forecast_state(user_id, db_path=None):
+    user_id = str(user_id)
+    conn = connect(db_path)
+    try:
+        progress = conn.execute("SELECT year, month FROM forecast_progress WHERE user_id = ?", (user_id,)).fetchone()
+        rows = conn.execute(f"""
+            SELECT is_total, category, {', '.join(STAT_COLUMNS)} FROM forecast_stats
+            WHERE user_id = ? ORDER BY is_total, category
+        """, (user_id,)).fetchall()
+    finally:
+        conn.close()
+
+    if progress is None:
+        return None
+
+    stats = pd.DataFrame(rows, columns=['is_total', 'category'] + STAT_COLUMNS)
+    total = stats[stats['is_total'] == 1]
+    categories = stats[stats['is_total'] == 0]
+    return ForecastState(
+        int(progress[0]), int(progress[1]),
+        total[STAT_COLUMNS].to_numpy(dtype=float).reshape(-1, len(STAT_COLUMNS)),
+        pd.Index(categories['category'].to_numpy(), name='category'),
+        categories[STAT_COLUMNS].to_numpy(dtype=float).reshape(-1, len(STAT_COLUMNS)),
+    )
+
+
+# The statistics of every closed month before (before_year, before_month), folding in the ones that closed since the
+# last call; None when the state can't answer for that month (an older month was requested, or there is no history)
+def update_forecast_state(user_id, before_year, before_month, db_path=None):
+    if fold_closed_months(user_id, before_year, before_month, db_path) is None:
+        return None
+    return load_forecast_state(user_id, db_path)
+
+
+# Forget a user's statistics when expenses of an already folded month changed (since=None forgets them in any case);
+# they are folded again from the rollups on the next update
+def invalidate_forecast_state(user_id, since_year=None, since_month=None, db_path=None):
+    user_id = str(user_id)
+    conn = connect(db_path)
+    try:
+        with conn:
+            last_year, last_month = _read_progress(conn, user_id)
+            if since_year is not None and since_year * 12 + since_month > last_year * 12 + last_month:
+                return False
+            conn.execute("DELETE FROM forecast_stats WHERE user_id = ?", (user_id,))
+            removed = conn.execute("DELETE FROM forecast_progress WHERE user_id = ?", (user_id,)).rowcount
+            return removed > 0
+    finally:
+        conn.close()
+
+
+def _user_ids(user_ids, db_path):
+    if user_ids:
+        return [str(user_id) for user_id in user_ids]
+    conn = connect(db_path)
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM monthly_rollups ORDER BY user_id")]
+    finally:
+        conn.close()
+
+
+# Re-derive the statistics of every (or the given) user from their rollups, folding all months before "before"
+# (year, month; the current calendar month by default)
+def rebuild_forecast_states(user_ids=None, before=None, db_path=None):
+    before_year, before_month = before or (date.today().year, date.today().month)
+    rebuilt = {}
+    for user_id in _user_ids(user_ids, db_path):
+        invalidate_forecast_state(user_id, db_path=db_path)
+        rebuilt[user_id] = fold_closed_months(user_id, before_year, before_month, db_path) or 0
+    return rebuilt
+
+
+# Compare every (or the given) user's stored statistics and forecasts with a full refit of their rollup history
+def verify_forecast_states(user_ids=None, month_num=12, rtol=1e-9, db_path=None):
+    mismatches = []
+    users = _user_ids(user_ids, db_path)
+    for user_id in users:
+        state = load_forecast_state(user_id, db_path)
+        if state is None:
+            continue
+
+        next_year, next_month = (state.last_year, state.last_month + 1) if state.last_month < 12 else (state.last_year + 1, 1)
+        context = AnalysisContext(load_history(user_id, next_year, next_month, db_path))
+        monthly_spending = context.category_monthly_sums()
+        expected = {
+            'total': (sufficient_stats(context.monthly_sums().to_numpy()[None, :]), state.total_stats),
+            'categories': (sufficient_stats(monthly_spending.to_numpy()), state.category_stats),
+        }
+        if list(monthly_spending.index) != list(state.categories):
+            mismatches.append({'user_id': user_id, 'series': 'categories', 'reason': 'different categories'})
+            continue
+
+        for series, (refit, stored) in expected.items():
+            refit_forecast = stats_linear_forecast(refit, month_num)
+            stored_forecast = stats_linear_forecast(stored, month_num)
+            if refit.shape != stored.shape or not np.allclose(refit, stored, rtol=rtol, atol=0) or not all(
+                np.allclose(a, b, rtol=rtol, atol=0, equal_nan=True) for a, b in zip(refit_forecast, stored_forecast)
+            ):
+                mismatches.append({'user_id': user_id, 'series': series, 'reason': 'statistics differ from a refit'})
+
+    return {'users': len(users), 'mismatches': mismatches}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the per-user forecast statistics from the stored rollups and verify them against a full refit")
+    parser.add_argument('--user-id', action='append', help="Only this user (repeatable; default: every user with rollups)")
+    parser.add_argument('--before', help="First month that is not folded, as YYYY-MM (default: the current month)")
+    parser.add_argument('--verify-only', action='store_true', help="Check the stored statistics without rebuilding them")
+    parser.add_argument('--db-path', help="Rollup database (default: ROLLUP_DB_PATH)")
+    args = parser.parse_args(argv)
+
+    report = {}
+    if not args.verify_only:
+        before = tuple(int(part) for part in args.before.split('-')) if args.before else None
+        report['rebuilt_months'] = rebuild_forecast_states(args.user_id, before, args.db_path)
+    report.update(verify_forecast_states(args.user_id, db_path=args.db_path))
+
+    print(json.dumps(report, indent=2))
+    return 1 if report['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
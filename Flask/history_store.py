@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import uuid
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+from analysis_context import AnalysisContext, NANOSECONDS_PER_DAY, dictionary_codes
+from columnar import expenses_frame
+
+# Writer locks use fcntl.flock on POSIX and msvcrt.locking on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+DEFAULT_HISTORY_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history_store')
+
+# Columns of a segment, one .npy file each: days since 1970, amount and the code of the category in the user's dictionary
+# (amounts stay float64 so that analyses of stored history match the same history sent as JSON to the cent)
+SEGMENT_DTYPES = {'date': np.dtype('<i4'), 'amount': np.dtype('<f8'), 'category': np.dtype('<i2')}
+
+# Appends after which the user's segments are compacted into one
+COMPACT_AFTER_SEGMENTS = int(os.getenv("HISTORY_COMPACT_SEGMENTS", 16))
+
+
+def store_path(path=None):
+    return path or os.getenv('HISTORY_STORE_PATH', DEFAULT_HISTORY_STORE_PATH)
+
+
+# One directory per user, named after a hash of the id so any id is a safe file name
+def _user_dir(user_id, path=None):
+    return os.path.join(store_path(path), hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()[:32])
+
+
+def _read_manifest(user_dir):
+    try:
+        with open(os.path.join(user_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'categories': [], 'segments': []}
+
+
+# The manifest is replaced atomically, so a reader sees either the old or the new list of segments
+def _write_manifest(user_dir, manifest):
+    temporary = os.path.join(user_dir, f'manifest.{uuid.uuid4().hex}.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temporary, os.path.join(user_dir, 'manifest.json'))
+
+
+def _lock_file(lock):
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return
+    # LK_LOCK gives up after about 10 seconds of retries, so keep waiting like flock does
+    while True:
+        try:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(lock):
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    else:
+        lock.seek(0)
+        msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Writers (appends, compaction) of one user take an exclusive file lock; readers never lock
+@contextmanager
+def _locked(user_dir):
+    os.makedirs(user_dir, exist_ok=True)
+    with open(os.path.join(user_dir, '.lock'), 'w') as lock:
+        _lock_file(lock)
+        try:
+            yield
+        finally:
+            _unlock_file(lock)
+
+
+# Encode expenses (JSON rows or a columnar frame) as segment columns, adding new categories to the user's dictionary
+def _encode(expenses, manifest):
+    frame = expenses_frame(expenses)
+    categories = manifest['categories']
+    codes = {category: code for code, category in enumerate(categories)}
+    for category in pd.unique(frame['category']) if len(frame) else []:
+        if category not in codes:
+            codes[category] = len(categories)
+            categories.append(category)
+    if len(categories) > np.iinfo(SEGMENT_DTYPES['category']).max:
+        raise ValueError(f"A user can't have more than {np.iinfo(SEGMENT_DTYPES['category']).max} categories")
+
+    return {
+        'date': frame['date'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(SEGMENT_DTYPES['date']),
+        'amount': frame['amount'].to_numpy(dtype=SEGMENT_DTYPES['amount']),
+        'category': np.array([codes[category] for category in frame['category']], dtype=SEGMENT_DTYPES['category']),
+    }
+
+
+def _write_segment(user_dir, kind, columns):
+    name = f'{kind}-{uuid.uuid4().hex[:12]}'
+    for column, values in columns.items():
+        np.save(os.path.join(user_dir, f'{name}.{column}.npy'), values)
+    dates = columns['date']
+    return {
+        'name': name,
+        'kind': kind,
+        'rows': len(dates),
+        'first_day': int(dates.min()),
+        'last_day': int(dates.max()),
+        'sorted': bool(np.all(dates[1:] >= dates[:-1])),
+    }
+
+
+def _remove_segment_files(user_dir, segments):
+    for segment in segments:
+        for column in SEGMENT_DTYPES:
+            try:
+                os.unlink(os.path.join(user_dir, f"{segment['name']}.{column}.npy"))
+            except FileNotFoundError:
+                pass
+
+
+# Append added and deleted expenses to a user's history as new segments (replace=True drops the stored history first);
+# returns the number of rows appended. Deleted expenses are matched on (date, amount, category) when the history is read
+def append_expenses(user_id, expenses=None, deleted_expenses=None, replace=False, path=None):
+    user_dir = _user_dir(user_id, path)
+    with _locked(user_dir):
+        manifest = _read_manifest(user_dir)
+        removed = []
+        if replace:
+            removed, manifest = manifest['segments'], {'categories': [], 'segments': []}
+
+        appended = 0
+        for kind, rows in [('added', expenses), ('deleted', deleted_expenses)]:
+            if rows is None or len(rows) == 0:
+                continue
+            columns = _encode(rows, manifest)
+            if len(columns['date']) > 0:
+                manifest['segments'].append(_write_segment(user_dir, kind, columns))
+                appended += len(columns['date'])
+
+        _write_manifest(user_dir, manifest)
+        _remove_segment_files(user_dir, removed)
+        compact = len(manifest['segments']) > COMPACT_AFTER_SEGMENTS
+
+    if compact:
+        compact_history(user_id, path)
+    return appended
+
+
+# Rows of the segments with first_day <= day < end_day, read through memory maps: only the pages of those days
+# are touched in date-sorted segments, and segments entirely outside the range are not opened at all
+def _read_segments(user_dir, segments, first_day, end_day):
+    parts = []
+    for segment in segments:
+        if segment['last_day'] < first_day or segment['first_day'] >= end_day:
+            continue
+        dates = np.load(os.path.join(user_dir, f"{segment['name']}.date.npy"), mmap_mode='r')
+        if segment['sorted']:
+            rows = slice(*np.searchsorted(dates, [first_day, end_day]))
+        else:
+            rows = np.flatnonzero((dates >= first_day) & (dates < end_day))
+        parts.append({
+            column: np.array(np.load(os.path.join(user_dir, f"{segment['name']}.{column}.npy"), mmap_mode='r')[rows])
+            for column in SEGMENT_DTYPES
+        })
+    return {column: np.concatenate([part[column] for part in parts]) if parts else np.empty(0, dtype=dtype)
+            for column, dtype in SEGMENT_DTYPES.items()}
+
+
+# Drop one added row per deleted row with the same (date, amount, category), keeping the other rows' order
+def _apply_deletions(added, deleted):
+    if len(deleted['date']) == 0:
+        return added
+
+    def occurrences(columns):
+        keys = pd.DataFrame(columns)
+        return keys.assign(occurrence=keys.groupby(list(SEGMENT_DTYPES)).cumcount())
+
+    kept = occurrences(added).merge(occurrences(deleted), how='left', indicator=True)['_merge'].to_numpy() == 'left_only'
+    return {column: values[kept] for column, values in added.items()}
+
+
+def _day(year, month):
+    return int((np.datetime64(f'{year:04d}-{month:02d}', 'M').astype('datetime64[D]') - np.datetime64('1970-01-01', 'D')).astype(int))
+
+
+# The stored expenses of first_day <= day < end_day in append order: the columns, then the category names of the codes
+def _read_columns(user_dir, first_day=np.iinfo(np.int32).min, end_day=np.iinfo(np.int32).max):
+    # Compaction may remove the segments of the manifest that was read, in which case it is read again
+    for attempt in range(3):
+        manifest = _read_manifest(user_dir)
+        try:
+            added = _read_segments(user_dir, [s for s in manifest['segments'] if s['kind'] == 'added'], first_day, end_day)
+            deleted = _read_segments(user_dir, [s for s in manifest['segments'] if s['kind'] == 'deleted'], first_day, end_day)
+            return _apply_deletions(added, deleted), manifest['categories']
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
+
+
+# A user's history before (before_year, before_month), optionally only from (since_year, since_month) on, as an
+# expense frame plus its AnalysisContext; the category codes come from the store, so nothing is factorized again
+def load_history(user_id, before_year=None, before_month=None, since_year=None, since_month=None, path=None):
+    first_day = _day(since_year, since_month) if since_year is not None else np.iinfo(np.int32).min
+    end_day = _day(before_year, before_month) if before_year is not None else np.iinfo(np.int32).max
+    columns, categories = _read_columns(_user_dir(user_id, path), first_day, end_day)
+    category_codes, names = dictionary_codes(columns['category'], categories)
+
+    history = pd.DataFrame({
+        'amount': columns['amount'],
+        'date': (columns['date'].astype(np.int64) * NANOSECONDS_PER_DAY).view('datetime64[ns]'),
+        'category': np.asarray(categories, dtype=object)[columns['category']] if len(categories) else np.empty(0, dtype=object),
+    })
+    context = AnalysisContext(history, category_codes=category_codes, categories=names)
+    return history, context
+
+
+# Rewrite a user's segments as one date-sorted segment without the deleted expenses (sorting is stable, so expenses
+# of the same day keep their append order); returns the number of segments replaced
+def compact_history(user_id, path=None):
+    return _compact(_user_dir(user_id, path))
+
+
+def _compact(user_dir):
+    with _locked(user_dir):
+        manifest = _read_manifest(user_dir)
+        segments = manifest['segments']
+        if len(segments) <= 1 and all(segment['kind'] == 'added' and segment['sorted'] for segment in segments):
+            return 0
+
+        columns, _ = _read_columns(user_dir)
+        order = np.argsort(columns['date'], kind='stable')
+        manifest['segments'] = [_write_segment(user_dir, 'added', {column: values[order] for column, values in columns.items()})] \
+            if len(order) else []
+        _write_manifest(user_dir, manifest)
+        # Readers that already mapped the old files keep reading them; the others retry with the new manifest
+        _remove_segment_files(user_dir, segments)
+        return len(segments)
+
+
+# Segment count, rows and bytes on disk of a user's history
+def history_stats(user_id, path=None):
+    user_dir = _user_dir(user_id, path)
+    manifest = _read_manifest(user_dir)
+    segments = manifest['segments']
+    return {
+        'segments': len(segments),
+        'rows': sum(segment['rows'] for segment in segments if segment['kind'] == 'added'),
+        'deleted_rows': sum(segment['rows'] for segment in segments if segment['kind'] == 'deleted'),
+        'categories': len(manifest['categories']),
+        'bytes': sum(os.path.getsize(os.path.join(user_dir, name)) for name in os.listdir(user_dir) if name.endswith('.npy'))
+        if os.path.isdir(user_dir) else 0,
+    }
+
+
+def has_history(user_id, path=None):
+    return len(_read_manifest(_user_dir(user_id, path))['segments']) > 0
+
+
+def _user_dirs(path):
+    root = store_path(path)
+    return sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))) if os.path.isdir(root) else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact the per-user columnar expense histories")
+    parser.add_argument('--user-id', action='append', help="Only this user (repeatable; default: every stored user)")
+    parser.add_argument('--path', help="History store directory (default: HISTORY_STORE_PATH)")
+    args = parser.parse_args(argv)
+
+    report = {}
+    if args.user_id:
+        for user_id in args.user_id:
+            report[user_id] = compact_history(user_id, args.path)
+    else:
+        # Directories are named after hashed ids
+        for name in _user_dirs(args.path):
+            report[name] = _compact(os.path.join(store_path(args.path), name))
+    print(json.dumps({'compacted_segments': report}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
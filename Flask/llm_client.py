@@ -0,0 +1,86 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_LLM_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+# Raised when every upstream slot stays busy for longer than the queue timeout
+class LLMBusy(Exception):
+    pass
+
+
+# Long-lived keep-alive client for the chat completion API with timeouts, bounded concurrency and retries on 429/5xx
+class LLMClient:
+    def __init__(self, url=DEFAULT_LLM_URL, connect_timeout=5, read_timeout=60, max_concurrency=8,
+                 max_retries=2, retry_backoff=0.5, queue_timeout=10):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _acquire(self):
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise LLMBusy("Too many chat requests in progress, try again later")
+
+    # Blocking completion: returns the upstream response
+    def complete(self, headers, payload):
+        self._acquire()
+        try:
+            return self.session.post(self.url, headers=headers, json=payload, timeout=self.timeout)
+        finally:
+            self.slots.release()
+
+    # Streaming completion: returns (upstream response, generator of the upstream event-stream bytes, release), or
+    # (response, None, None) on an upstream error. The slot is held until release() is called, which consuming or
+    # closing the generator does; callers that may never start the generator (a client that disconnects first) must
+    # call release() themselves
+    def stream(self, headers, payload):
+        self._acquire()
+        try:
+            response = self.session.post(self.url, headers=headers, json={**payload, 'stream': True},
+                                         timeout=self.timeout, stream=True)
+        except Exception:
+            self.slots.release()
+            raise
+
+        if response.status_code != 200:
+            # Read the error body before the connection goes back to the pool (the caller still reads response.text)
+            _ = response.content
+            response.close()
+            self.slots.release()
+            return response, None, None
+
+        # Gives the connection and the slot back exactly once, whichever of the generator and the caller gets there first
+        released = threading.Lock()
+
+        def release():
+            if released.acquire(blocking=False):
+                response.close()
+                self.slots.release()
+
+        # Bytes are relayed as they arrive and unchanged, so multi-line events (event:, id:, several data: lines) stay whole
+        def events():
+            try:
+                for chunk in response.iter_content(chunk_size=None):
+                    if chunk:
+                        yield chunk
+            finally:
+                release()
+
+        return response, events(), release
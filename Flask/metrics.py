@@ -0,0 +1,97 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+# Prometheus-style histogram with one label; observing is a bisect plus two additions under a lock
+class Histogram:
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['buckets'][bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], series['buckets']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series["count"]}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('analysis_request_seconds', 'End-to-end request latency in seconds.', 'endpoint', DURATION_BUCKETS)
+STAGE_SECONDS = Histogram('analysis_stage_seconds', 'Latency of each analysis pipeline stage in seconds.', 'stage', DURATION_BUCKETS)
+STAGE_ROWS = Histogram('analysis_stage_input_rows', 'Input rows handed to each analysis pipeline stage.', 'stage', SIZE_BUCKETS)
+STAGE_CATEGORIES = Histogram('analysis_stage_input_categories', 'Distinct categories handed to each analysis pipeline stage.', 'stage', SIZE_BUCKETS)
+STAGE_MONTHS = Histogram('analysis_stage_input_months', 'Months of history handed to each analysis pipeline stage.', 'stage', SIZE_BUCKETS)
+JOB_SECONDS = Histogram('analysis_job_seconds', 'Seconds asynchronous analysis jobs spent queued and running.', 'phase', DURATION_BUCKETS)
+COMPRESSION_SAVED_BYTES = Histogram('http_compression_saved_bytes', 'Bytes a compressed request or response body saved on the wire.', 'codec', SIZE_BUCKETS)
+COMPRESSION_CPU_SECONDS = Histogram('http_compression_cpu_seconds', 'CPU seconds spent decompressing a request or compressing a response body.', 'codec', DURATION_BUCKETS)
+SIZE_HISTOGRAMS = {'rows': STAGE_ROWS, 'categories': STAGE_CATEGORIES, 'months': STAGE_MONTHS}
+
+
+# Per-request record of stage timings and input sizes, feeding the global histograms
+class RequestTrace:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **sizes):
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - stage_start
+            self.stages.append({'stage': name, 'seconds': round(seconds, 6), **sizes})
+            STAGE_SECONDS.observe(name, seconds)
+            for size_name, value in sizes.items():
+                if size_name in SIZE_HISTOGRAMS:
+                    SIZE_HISTOGRAMS[size_name].observe(name, value)
+
+    # Record the request latency and log the stage breakdown when the request was slow
+    def finish(self, logger=None, slow_seconds=None):
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(self.endpoint, total)
+
+        if logger is not None and slow_seconds is not None and total >= slow_seconds:
+            breakdown = ', '.join(
+                f"{stage['stage']}={stage['seconds'] * 1000:.1f}ms"
+                + ''.join(f" {key}={value}" for key, value in stage.items() if key not in ('stage', 'seconds'))
+                for stage in sorted(self.stages, key=lambda stage: stage['seconds'], reverse=True)
+            )
+            logger.warning("Slow /%s request took %.3fs: %s", self.endpoint, total, breakdown)
+
+        return total
+
+
+# Prometheus text exposition of every histogram plus any extra counters/gauges ({name: (type, value)})
+def render_metrics(extra=None):
+    lines = []
+    for histogram in [REQUEST_SECONDS, STAGE_SECONDS, STAGE_ROWS, STAGE_CATEGORIES, STAGE_MONTHS, JOB_SECONDS,
+                      COMPRESSION_SAVED_BYTES, COMPRESSION_CPU_SECONDS]:
+        lines.extend(histogram.render())
+    for name, (metric_type, value) in (extra or {}).items():
+        lines.extend([f"# TYPE {name} {metric_type}", f"{name} {value}"])
+    return '\n'.join(lines) + '\n'
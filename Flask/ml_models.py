@@ -1,148 +1,300 @@
+import os
 import pandas as pd
 import numpy as np
 import calendar
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score
-from sklearn.cluster import KMeans
-from mlxtend.frequent_patterns import apriori
 from itertools import combinations
-from sklearn.preprocessing import StandardScaler
+from analysis_context import AnalysisContext
+
+
+# Centred statistics of a least-squares trend line, one row per series: n, the means of x and y and the sums of
+# squared/cross deviations from them (Sxx, Sxy, Syy). Unlike raw sums (Σx², Σy², ...), they don't cancel out when
+# the amounts are large
+STAT_COLUMNS = ['n', 'mean_x', 'mean_y', 'sxx', 'sxy', 'syy']
+
+
+# Statistics of the union of two sets of points (Chan et al.'s pairwise update), row by row; either side can be empty
+def merge_stats(a, b):
+    n_a, mean_x_a, mean_y_a, sxx_a, sxy_a, syy_a = np.asarray(a, dtype=float).reshape(-1, len(STAT_COLUMNS)).T
+    n_b, mean_x_b, mean_y_b, sxx_b, sxy_b, syy_b = np.asarray(b, dtype=float).reshape(-1, len(STAT_COLUMNS)).T
+
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share_b = np.where(n > 0, n_b / n, 0.0)
+    dx = mean_x_b - mean_x_a
+    dy = mean_y_b - mean_y_a
+    weight = n_a * share_b
+
+    return np.stack([
+        n,
+        mean_x_a + dx * share_b,
+        mean_y_a + dy * share_b,
+        sxx_a + sxx_b + dx * dx * weight,
+        sxy_a + sxy_b + dx * dy * weight,
+        syy_a + syy_b + dy * dy * weight,
+    ], axis=1)
+
+
+# Statistics of one point (x, y) per row; rows where "present" is False are empty
+def _point_stats(x, y, present):
+    present = np.asarray(present, dtype=bool)
+    zeros = np.zeros(len(present))
+    return np.stack([present.astype(float), np.where(present, x, 0.0), np.where(present, y, 0.0), zeros, zeros, zeros], axis=1)
+
+
+# Fold one more month into every series' statistics (x is each series' next month index); rows where "present" is
+# False (no spending that month) are left as they are
+def fold_month(stats, y, present=True):
+    stats = np.asarray(stats, dtype=float).reshape(-1, len(STAT_COLUMNS))
+    present = np.broadcast_to(present, len(stats))
+    return merge_stats(stats, _point_stats(stats[:, 0] + 1, y, present))
+
+
+# Statistics of every row of a (series x months) matrix, folded one month at a time
+# Each series is indexed 1..n over the months it actually has spending in (missing months are skipped), so they are
+# exactly what folding one closed month at a time into a stored state gives
+def sufficient_stats(monthly_matrix):
+    y = np.asarray(monthly_matrix, dtype=float)
+    stats = np.zeros((len(y), len(STAT_COLUMNS)))
+    for month in range(y.shape[1]):
+        present = ~np.isnan(y[:, month])
+        stats = fold_month(stats, np.where(present, y[:, month], 0.0), present)
+    return stats
+
+
+# Statistics of every row of a (series x months) matrix from a two-pass centred computation (deviations from the
+# exact means), the most accurate form when all the months are at hand
+def centred_stats(monthly_matrix):
+    y = np.ascontiguousarray(monthly_matrix, dtype=float)  # Row-major, so the row sums don't depend on the caller's layout
+    mask = ~np.isnan(y)
+    counts = mask.sum(axis=1)
+    x = np.cumsum(mask, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = (counts + 1) / 2
+        mean_y = np.where(mask, y, 0).sum(axis=1) / counts
+        dx = np.where(mask, x - mean_x[:, None], 0)
+        dy = np.where(mask, y - mean_y[:, None], 0)
+
+    return np.stack([counts, mean_x, mean_y, (dx ** 2).sum(axis=1), (dx * dy).sum(axis=1), (dy ** 2).sum(axis=1)], axis=1)
+
+
+# Trend line fit, R², correlation and the next x months' forecast of every series from its statistics
+def stats_linear_forecast(stats, month_num=12):
+    n, mean_x, mean_y, sxx, sxy, syy = np.asarray(stats, dtype=float).reshape(-1, len(STAT_COLUMNS)).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        intercept = mean_y - slope * mean_x
+        r2 = sxy ** 2 / (sxx * syy)
+        correlation = np.abs(sxy) / np.sqrt(sxx * syy)
+
+    counts = n.astype(int)
+    horizon = counts[:, None] + np.arange(1, month_num + 1)
+    forecasts = np.maximum(0, intercept[:, None] + slope[:, None] * horizon)
+
+    return counts, r2, correlation, forecasts
+
+
+# Fit a least-squares trend line to every row of a (series x months) matrix at once and forecast the next x months
+def batched_linear_forecast(monthly_matrix, month_num=12):
+    return stats_linear_forecast(centred_stats(monthly_matrix), month_num)
+
+
+# Calendar (year, month name) pairs for the x months following the last recorded month
+def _forecast_months(last_year, last_month, month_num):
+    months = []
+    next_year, next_month = (last_year, last_month + 1) if last_month < 12 else (last_year + 1, 1)
+
+    for _ in range(month_num):
+        months.append((int(next_year), calendar.month_name[next_month]))
+
+        next_month += 1
+        if next_month > 12:
+            next_month = 1
+            next_year += 1
+
+    return months
+
+
+# Monthly prediction rows of one series, from Python floats (forecasts as a list) so no NumPy scalar is converted per row
+def _prediction_rows(months, forecasts, r2, correlation):
+    return [
+        {
+            'year': year,
+            'month': month,
+            'predicted_spending': round(prediction, 2),
+            'accuracy': r2,
+            'correlation': correlation
+        }
+        for (year, month), prediction in zip(months, forecasts)
+    ]
+
+
+# Keep the categories whose trend is reliable enough and add their monthly prediction rows
+def _add_category_predictions(category_predictions, categories, counts, r2, correlation, forecasts, months, accuracy_threshold, correlation_threshold):
+    selected = (counts >= 3) & (r2 >= accuracy_threshold) & (correlation >= correlation_threshold)
+
+    for category, category_r2, category_correlation, category_forecasts in zip(
+        categories[selected].tolist(), r2[selected].tolist(), correlation[selected].tolist(), forecasts[selected].tolist()
+    ):
+        category_predictions[category] = _prediction_rows(months, category_forecasts, category_r2, category_correlation)
 
 
 # Predict next x months "Total" spending using Linear Regression
-def linear_regression(distinct_all_expenses, predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5):
-    distinct_all_expenses['month'] = distinct_all_expenses['date'].dt.month
-    distinct_all_expenses['year'] = distinct_all_expenses['date'].dt.year
-    
-    last_year = distinct_all_expenses['date'].max().year
-    last_month = distinct_all_expenses['date'].max().month
-    
-    monthly_spending = distinct_all_expenses.groupby(['year', 'month'])['amount'].sum().reset_index()
+def linear_regression(distinct_all_expenses, predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5, context=None):
+    context = context or AnalysisContext(distinct_all_expenses)
+    last_year, last_month = context.last_month()
+    monthly_spending = context.monthly_sums()
 
     if len(monthly_spending) >= 3:
-            monthly_spending['time_index'] = range(1, len(monthly_spending) + 1)
-            X = monthly_spending[['time_index']]
-            y = monthly_spending['amount']
-
-            scaler = StandardScaler()
-            X_scaled = scaler.fit_transform(X)
-
-            model = LinearRegression()
-            model.fit(X_scaled, y)
-
-            y_pred = model.predict(X_scaled)
-            r2 = r2_score(y, y_pred)
-            correlation = np.corrcoef(y, y_pred)[0, 1]
-
-            if r2 >= accuracy_threshold and correlation >= correlation_threshold:
-                next_year, next_month = (last_year, last_month + 1) if last_month < 12 else (last_year + 1, 1)
-
-                next_time_index = X['time_index'].max() + 1
-                for _ in range(month_num):
-                    next_time_index_df = pd.DataFrame([[next_time_index]], columns=['time_index'])
-                    next_time_index_scaled = scaler.transform(next_time_index_df)
-                    prediction = model.predict(next_time_index_scaled)[0]
-                    prediction = max(0, prediction)
-                    
-                    predictions.append({
-                        'year': next_year,
-                        'month': calendar.month_name[next_month],
-                        'predicted_spending': round(float(prediction), 2),
-                        'accuracy': r2,
-                        'correlation': correlation
-                    })
-
-                    next_month += 1
-                    if next_month > 12:
-                        next_month = 1
-                        next_year += 1
+        _, r2, correlation, forecasts = batched_linear_forecast(monthly_spending.to_numpy()[None, :], month_num)
 
-                    next_time_index += 1
+        if r2[0] >= accuracy_threshold and correlation[0] >= correlation_threshold:
+            predictions.extend(_prediction_rows(_forecast_months(last_year, last_month, month_num), forecasts[0].tolist(), float(r2[0]), float(correlation[0])))
 
 
 # Predict next x months "Category" spending using Linear Regression
-def category_linear_regression(distinct_all_expenses, category_predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5):
-    distinct_all_expenses['year'] = distinct_all_expenses['date'].dt.year
-    distinct_all_expenses['month'] = distinct_all_expenses['date'].dt.month
+def category_linear_regression(distinct_all_expenses, category_predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5, context=None):
+    context = context or AnalysisContext(distinct_all_expenses)
+    last_year, last_month = context.last_month()
 
-    last_year = distinct_all_expenses['date'].max().year
-    last_month = distinct_all_expenses['date'].max().month
+    # One row per category, one column per month, NaN where the category had no spending
+    monthly_spending = context.category_monthly_sums()
 
-    for category, group in distinct_all_expenses.groupby('category'):
-        monthly_spending = group.groupby(['year', 'month'])['amount'].sum().reset_index()
+    counts, r2, correlation, forecasts = batched_linear_forecast(monthly_spending.to_numpy(), month_num)
+    _add_category_predictions(category_predictions, monthly_spending.index, counts, r2, correlation, forecasts,
+                              _forecast_months(last_year, last_month, month_num), accuracy_threshold, correlation_threshold)
 
-        if len(monthly_spending) >= 3:
-            monthly_spending['time_index'] = range(1, len(monthly_spending) + 1)
-            X = monthly_spending[['time_index']]
-            y = monthly_spending['amount']
 
-            scaler = StandardScaler()
-            X_scaled = scaler.fit_transform(X)
+# Same as linear_regression, from a user's persisted trend statistics ("state" from forecast_store) instead of a fit
+def state_linear_regression(state, predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5):
+    counts, r2, correlation, forecasts = stats_linear_forecast(state.total_stats, month_num)
 
-            model = LinearRegression()
-            model.fit(X_scaled, y)
+    if counts[0] >= 3 and r2[0] >= accuracy_threshold and correlation[0] >= correlation_threshold:
+        predictions.extend(_prediction_rows(_forecast_months(state.last_year, state.last_month, month_num), forecasts[0].tolist(), float(r2[0]), float(correlation[0])))
 
-            y_pred = model.predict(X_scaled)
-            r2 = r2_score(y, y_pred)
-            correlation = np.corrcoef(y, y_pred)[0, 1]
 
-            if r2 >= accuracy_threshold and correlation >= correlation_threshold:
-                next_year, next_month = (last_year, last_month + 1) if last_month < 12 else (last_year + 1, 1)
+# Same as category_linear_regression, from a user's persisted per-category trend statistics
+def state_category_linear_regression(state, category_predictions, month_num=12, accuracy_threshold=0.5, correlation_threshold=0.5):
+    counts, r2, correlation, forecasts = stats_linear_forecast(state.category_stats, month_num)
+    _add_category_predictions(category_predictions, state.categories, counts, r2, correlation, forecasts,
+                              _forecast_months(state.last_year, state.last_month, month_num), accuracy_threshold, correlation_threshold)
 
-                next_time_index = X['time_index'].max() + 1
-                category_predictions[category] = []
 
-                for _ in range(month_num):
-                    next_time_index_df = pd.DataFrame([[next_time_index]], columns=['time_index'])
-                    next_time_index_scaled = scaler.transform(next_time_index_df)
-                    prediction = model.predict(next_time_index_scaled)[0]
-                    prediction = max(0, prediction)
+# Best split point for every prefix length b in [first_b, n] of one Ckmeans.1d.dp layer, using divide and conquer over the
+# monotone split points (all sub-problems of one recursion depth are evaluated together as flat NumPy arrays)
+def _optimal_1d_layer(previous, segment_cost, first_b, n):
+    best = np.full(n + 1, np.inf)
+    split = np.zeros(n + 1, dtype=int)
 
-                    category_predictions[category].append({
-                        'year': int(next_year),
-                        'month': calendar.month_name[next_month],
-                        'predicted_spending': round(float(prediction), 2),
-                        'accuracy': float(r2),
-                        'correlation': float(correlation)
-                    })
+    b_low, b_high = np.array([first_b]), np.array([n])
+    a_low, a_high = np.array([first_b - 1]), np.array([n - 1])
 
-                    next_month += 1
-                    if next_month > 12:
-                        next_month = 1
-                        next_year += 1
+    while len(b_low) > 0:
+        mid = (b_low + b_high) // 2
+        lengths = np.minimum(a_high, mid - 1) - a_low + 1
+        starts = np.cumsum(lengths) - lengths
 
-                    next_time_index += 1
+        task = np.repeat(np.arange(len(mid)), lengths)
+        a = a_low[task] + np.arange(len(task)) - starts[task]
+        total = previous[a] + segment_cost(a, mid[task])
 
+        task_min = np.minimum.reduceat(total, starts)
+        first_min = np.flatnonzero(total == task_min[task])
+        _, first_per_task = np.unique(task[first_min], return_index=True)
+        best_a = a[first_min[first_per_task]]
 
-# KMenas clustering to group "expenses" based on amount spent
-def kmeans_clustering(expenses, smart_insights, expenses_clustering=[]):
-    scaler = StandardScaler()
+        best[mid] = task_min
+        split[mid] = best_a
 
-    unique_values = expenses['amount'].nunique()
+        left = b_low <= mid - 1
+        right = mid + 1 <= b_high
+        b_low, b_high = np.concatenate([b_low[left], mid[right] + 1]), np.concatenate([mid[left] - 1, b_high[right]])
+        a_low, a_high = np.concatenate([a_low[left], best_a[right]]), np.concatenate([best_a[left], a_high[right]])
 
-    if unique_values == 1:
-        expenses['cluster'] = 0
-        expenses['cluster_label'] = 'Moderate'
-    else:
-        expenses['normalized_amount'] = scaler.fit_transform(expenses[['amount']])
+    return best, split
+
+
+# Exact 1-D k-means clustering (Ckmeans.1d.dp): returns each value's cluster rank, 0 being the lowest cluster
+def optimal_1d_clusters(values, n_clusters):
+    values = np.asarray(values, dtype=float)
+    uniques, inverse, weights = np.unique(values - values.mean(), return_inverse=True, return_counts=True)
+    n = len(uniques)
+    n_clusters = min(n_clusters, n)
+
+    count_sums = np.concatenate([[0], np.cumsum(weights)])
+    value_sums = np.concatenate([[0], np.cumsum(weights * uniques)])
+    square_sums = np.concatenate([[0], np.cumsum(weights * uniques ** 2)])
+
+    # Within-cluster sum of squares of uniques[a:b]
+    def segment_cost(a, b):
+        return (square_sums[b] - square_sums[a]) - (value_sums[b] - value_sums[a]) ** 2 / (count_sums[b] - count_sums[a])
+
+    costs = np.zeros(n + 1)
+    costs[1:] = segment_cost(np.zeros(n, dtype=int), np.arange(1, n + 1))
+
+    splits = []
+    for layer in range(2, n_clusters + 1):
+        costs, split = _optimal_1d_layer(costs, segment_cost, layer, n)
+        splits.append(split)
+
+    boundaries = []
+    b = n
+    for split in reversed(splits):
+        b = split[b]
+        boundaries.append(b)
+
+    ranks = np.searchsorted(np.sort(boundaries), np.arange(n), side='right')
+    return ranks[inverse]
+
+
+# Group a single feature into High/Moderate/Low clusters, returning (cluster ids, labels)
+# The backend comes from "CLUSTERING_BACKEND": "exact" (default, deterministic) or "sklearn" (KMeans reference)
+def cluster_labels_1d(values, backend=None):
+    backend = backend or os.getenv('CLUSTERING_BACKEND', 'exact')
+    values = np.asarray(values, dtype=float)
+    n_clusters = min(3, len(np.unique(values)))
+    labels = np.array(['High', 'Moderate', 'Low'][:n_clusters])
+
+    if backend == 'exact':
+        ranks = optimal_1d_clusters(values, n_clusters)
+        return ranks, labels[n_clusters - 1 - ranks]
+
+    if backend == 'sklearn':
+        # sklearn takes over a second to import, so it is only loaded when the reference backend is used
+        from sklearn.cluster import KMeans
+        from sklearn.preprocessing import StandardScaler
+
+        scaler = StandardScaler()
+        normalized = scaler.fit_transform(values.reshape(-1, 1))[:, 0]
 
-        n_clusters = min(3, unique_values)
         kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        expenses['cluster'] = kmeans.fit_predict(expenses[['normalized_amount']])
+        clusters = kmeans.fit_predict(normalized.reshape(-1, 1))
+
+        cluster_averages = pd.Series(normalized).groupby(clusters).mean().sort_values(ascending=False)
+        cluster_labels = {cluster: label for cluster, label in zip(cluster_averages.index, labels)}
+
+        return clusters, np.array([cluster_labels[cluster] for cluster in clusters])
 
-        cluster_averages = expenses.groupby('cluster')['normalized_amount'].mean().sort_values(ascending=False)
+    raise ValueError(f"Unknown clustering backend: {backend}")
 
-        cluster_labels = {cluster: label for cluster, label in 
-                          zip(cluster_averages.index, ['High', 'Moderate', 'Low'][:n_clusters])}
 
-        expenses['cluster_label'] = expenses['cluster'].map(cluster_labels)
+# KMenas clustering to group "expenses" based on amount spent
+def kmeans_clustering(expenses, smart_insights, expenses_clustering=[], context=None):
+    context = context or AnalysisContext(expenses)
+    unique_values = len(np.unique(context.amounts))
+
+    if unique_values == 1:
+        cluster_labels = np.full(context.size, 'Moderate')
+    else:
+        _, cluster_labels = cluster_labels_1d(context.amounts)
 
     for cluster_label in ['High', 'Moderate', 'Low']:
-        cluster_data = expenses[expenses['cluster_label'] == cluster_label]
-        if not cluster_data.empty:
-            min_expenses = cluster_data['amount'].min()
-            max_expenses = cluster_data['amount'].max()
-            count_expenses = cluster_data.shape[0]
+        cluster_amounts = context.amounts[cluster_labels == cluster_label]
+        if len(cluster_amounts) > 0:
+            min_expenses = cluster_amounts.min()
+            max_expenses = cluster_amounts.max()
+            count_expenses = len(cluster_amounts)
             expenses_clustering.append({
                 'cluster': cluster_label,
                 'count_of_expenses': count_expenses,
@@ -150,157 +302,218 @@ def kmeans_clustering(expenses, smart_insights, expenses_clustering=[]):
                 'max_expenses': float(max_expenses),
             })
 
-    highest_spending_cluster = expenses[expenses['cluster_label'] == 'High']
-    category_counts = highest_spending_cluster['category'].value_counts()
-    top_categories = category_counts.head(4).index.tolist()
+    highest_spending_codes = context.category_codes[(cluster_labels == 'High') & (context.category_codes >= 0)]
+    category_counts = pd.Series(highest_spending_codes).value_counts()
+    top_categories = context.categories[category_counts.head(4).index].tolist()
 
     if top_categories:
         combined_categories = "', '".join(top_categories)
         smart_insights.append(f"Consider monitoring expenses in '{combined_categories}', as they have the most expenses that are considered 'High'.")
 
 
+# {"category", group_column} rows in High, Moderate, Low order, the order sort_values(kind='quicksort') gave them,
+# built from plain lists rather than iterrows()
+def _grouped_categories(categories, groups, group_column):
+    groups = np.asarray(groups, dtype=object)
+    order = np.argsort((groups == 'Moderate') + 2 * (groups == 'Low'), kind='quicksort')
+    return [{'category': category, group_column: group} for category, group in zip(categories[order].tolist(), groups[order].tolist())]
+
+
 # KMeans clustering to group "categories" based on total spending
-def spending_kmeans_clustering(expenses, spending_clustering):
-    total_spent = expenses.groupby('category')['amount'].sum().reset_index(name='total_spent')
+def spending_kmeans_clustering(expenses, spending_clustering, context=None):
+    context = context or AnalysisContext(expenses)
+    total_spent = context.category_sums()
 
-    if total_spent['total_spent'].nunique() == 1:
-        total_spent['spending_group'] = 'Moderate'
+    if total_spent.nunique() == 1:
+        spending_groups = np.full(len(total_spent), 'Moderate', dtype=object)
     else:
-        scaler = StandardScaler()
-        total_spent['normalized_total_spent'] = scaler.fit_transform(total_spent[['total_spent']])
+        _, spending_groups = cluster_labels_1d(total_spent)
 
-        n_clusters = min(3, total_spent['normalized_total_spent'].nunique())
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        total_spent['cluster'] = kmeans.fit_predict(total_spent[['normalized_total_spent']])
+    spending_clustering.append({'spending_group': _grouped_categories(total_spent.index, spending_groups, 'spending_group')})
 
-        cluster_averages = total_spent.groupby('cluster')['normalized_total_spent'].mean().sort_values(ascending=False)
-        cluster_labels = {cluster: label for cluster, label in 
-                          zip(cluster_averages.index, ['High', 'Moderate', 'Low'][:n_clusters])}
 
-        total_spent['spending_group'] = total_spent['cluster'].map(cluster_labels)
+# KMeans clustering to group "categories" based on frequency
+def frequency_kmeans_clustering(expenses, frequency_clustering, context=None):
+    context = context or AnalysisContext(expenses)
+    frequency = context.category_counts()
 
-    sorted_spending = total_spent.sort_values(by='spending_group', key=lambda x: x.map({'High': 1, 'Moderate': 2, 'Low': 3}))
+    if frequency.nunique() == 1:
+        frequency_groups = np.full(len(frequency), 'Moderate', dtype=object)
+    else:
+        _, frequency_groups = cluster_labels_1d(frequency)
 
-    spending_clustering.append({
-        'spending_group': [
-            {'category': row['category'], 'spending_group': row['spending_group']}
-            for _, row in sorted_spending.iterrows()
-        ]
-    })
+    frequency_clustering.append({'frequency_group': _grouped_categories(frequency.index, frequency_groups, 'frequency_group')})
 
 
-# KMeans clustering to group "categories" based on frequency
-def frequency_kmeans_clustering(expenses, frequency_clustering):
-    frequency = expenses.groupby('category').size().reset_index(name='count')
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
 
-    if frequency['count'].nunique() == 1:
-        frequency['frequency_group'] = 'Moderate'
-    else:
-        scaler = StandardScaler()
-        frequency['normalized_count'] = scaler.fit_transform(frequency[['count']])
 
-        n_clusters = min(3, frequency['normalized_count'].nunique())
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-        frequency['cluster'] = kmeans.fit_predict(frequency[['normalized_count']])
+# Mine every itemset with support >= min_support from a (transactions x items) boolean matrix
+# Eclat-style depth-first search where each item's transactions are a packed bitset and support is the popcount of ANDed bitsets
+def frequent_itemsets(basket, min_support):
+    n_transactions = basket.shape[0]
+    bitsets = np.packbits(basket, axis=0).T
+    itemsets = {}
 
-        cluster_averages = frequency.groupby('cluster')['normalized_count'].mean().sort_values(ascending=False)
-        cluster_labels = {cluster: label for cluster, label in 
-                          zip(cluster_averages.index, ['High', 'Moderate', 'Low'][:n_clusters])}
-        
-        frequency['frequency_group'] = frequency['cluster'].map(cluster_labels)
+    def extend(prefix, prefix_bits, candidates):
+        candidate_bits = bitsets[candidates] if prefix_bits is None else bitsets[candidates] & prefix_bits
+        supports = POPCOUNT_TABLE[candidate_bits].sum(axis=1) / n_transactions
+        frequent = [index for index in range(len(candidates)) if supports[index] >= min_support]
 
-    sorted_frequency = frequency.sort_values(by='frequency_group', key=lambda x: x.map({'High': 1, 'Moderate': 2, 'Low': 3}))
+        for position, index in enumerate(frequent):
+            itemset = prefix + (candidates[index],)
+            itemsets[itemset] = float(supports[index])
+            if position + 1 < len(frequent):
+                extend(itemset, candidate_bits[index], [candidates[later] for later in frequent[position + 1:]])
 
-    frequency_clustering.append({
-        'frequency_group': [
-            {'category': row['category'], 'frequency_group': row['frequency_group']}
-            for _, row in sorted_frequency.iterrows()
-        ]
-    })
+    if basket.shape[1] > 0:
+        extend((), None, list(range(basket.shape[1])))
+
+    # Same order as apriori: by itemset size, then by item position
+    return dict(sorted(itemsets.items(), key=lambda entry: (len(entry[0]), entry[0])))
 
 
 # Generate association rules to identify category relationships
-def get_association_rules(expenses, association_rules, min_support=0.5, min_confidence=0.8, min_lift=1.5):
-    basket = expenses.groupby(['date', 'category'])['category'].count().unstack().fillna(0)
-    basket = basket.map(lambda x: 1 if x > 0 else 0)
-    basket = basket.astype(bool)
+def get_association_rules(expenses, association_rules, min_support=0.5, min_confidence=0.8, min_lift=1.5, context=None):
+    context = context or AnalysisContext(expenses)
+    valid = (context.category_codes >= 0) & (context.timestamps != np.datetime64('NaT').astype(np.int64))
+    date_codes, _ = pd.factorize(context.timestamps[valid], sort=True)
+    category_codes, categories = pd.factorize(context.category_codes[valid], sort=True)
+    categories = context.categories[categories].tolist()  # Plain list: indexing a pandas Index per rule item is slow
 
-    frequent_itemsets = apriori(basket, min_support=min_support, use_colnames=True)
-    support_dict = frequent_itemsets.set_index('itemsets')['support'].to_dict()
+    # One transaction per date, marking which categories were spent on that day
+    basket = np.zeros((date_codes.max() + 1 if len(date_codes) else 0, len(categories)), dtype=bool)
+    basket[date_codes, category_codes] = True
 
-    for itemset in frequent_itemsets['itemsets']:
+    support_dict = frequent_itemsets(basket, min_support)
+
+    for itemset, support in support_dict.items():
         if len(itemset) >= 2:
             for antecedent in combinations(itemset, len(itemset) - 1):
-                antecedent = frozenset(antecedent)
-                consequent = itemset - antecedent
+                consequent = tuple(item for item in itemset if item not in antecedent)
+
+                confidence = support / support_dict[antecedent]
+                lift = confidence / support_dict[consequent]
+
+                if confidence >= min_confidence and lift >= min_lift:
+                    association_rules.append({
+                        'antecedents': [categories[item] for item in antecedent],
+                        'consequents': [categories[item] for item in consequent],
+                        'support': support,
+                        'confidence': confidence,
+                        'lift': lift
+                    })
 
-                if antecedent in support_dict and itemset in support_dict:
-                    confidence = support_dict[itemset] / support_dict[antecedent]
-                    lift = confidence / support_dict[consequent] if consequent in support_dict else None
 
-                    if confidence >= min_confidence and (lift is None or lift >= min_lift):
-                        association_rules.append({
-                            'antecedents': list(antecedent),
-                            'consequents': list(consequent),
-                            'support': support_dict[itemset],
-                            'confidence': confidence,
-                            'lift': lift
-                        })
+IMPORTANCE_LABELS = np.array(['Essential', 'Moderate', 'Non-Essential'], dtype=object)
 
 
-# Label category importance based on rules
-def Rule_Based_labeling(past_expenses, labeled_categories):
-    past_expenses['year_month'] = past_expenses['date'].dt.strftime('%Y-%m')
-    
-    monthly_sums = past_expenses.groupby(['year_month', 'category'])['amount'].sum()
-    category_average = monthly_sums.groupby('category').mean()
-
-    monthly_frequency = past_expenses.groupby(['year_month', 'category']).size()
-    category_frequency = monthly_frequency.groupby('category').mean()
-
-    monthly_std = past_expenses.groupby(['year_month', 'category'])['amount'].std()
-    category_consistency = monthly_std.groupby('category').mean()
-
-    category_stats = pd.DataFrame({
-        'total_spent': category_average,
-        'frequency': category_frequency,
-        'consistency': category_consistency
+# Monthly-average spending, frequency and consistency (std) per (user, category) from one grouped reduction:
+# rows are keyed by integer (user, category, month) codes and summed with bincount instead of grouping on strings
+def labeling_stats(past_expenses, user_column=None, context=None):
+    context = context or AnalysisContext(past_expenses)
+    amounts, month_keys = context.amounts, context.month_keys
+    category_codes, category_names = context.category_codes, context.categories
+    if user_column is None:
+        user_codes, user_ids = np.zeros(len(amounts), dtype=np.int64), pd.Index([None])
+    else:
+        user_codes, user_ids = pd.factorize(past_expenses[user_column], sort=True)
+
+    first_month = month_keys.min() if len(month_keys) else 0
+    month_span = int(month_keys.max() - first_month + 1) if len(month_keys) else 1
+    pair_keys = user_codes.astype(np.int64) * len(category_names) + category_codes
+    group_codes, group_keys = pd.factorize(pair_keys * month_span + (month_keys - first_month))
+
+    # Per (user, category, month): sum, count and the centred sum of squares for the sample standard deviation
+    counts = np.bincount(group_codes)
+    sums = np.bincount(group_codes, weights=amounts)
+    centred = amounts - (sums / counts)[group_codes]
+    squares = np.bincount(group_codes, weights=centred * centred)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stds = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+
+    # Per (user, category): averages over the months the category was used in (months without a std are skipped)
+    pairs, pair_codes = np.unique(group_keys // month_span, return_inverse=True)
+    months = np.bincount(pair_codes)
+    has_std = ~np.isnan(stds)
+    std_months = np.bincount(pair_codes[has_std], minlength=len(pairs))
+    std_totals = np.bincount(pair_codes[has_std], weights=stds[has_std], minlength=len(pairs))
+
+    return pd.DataFrame({
+        'user': user_ids[pairs // len(category_names)],
+        'user_code': pairs // len(category_names),
+        'category': category_names[pairs % len(category_names)],
+        'total_spent': np.bincount(pair_codes, weights=sums) / months,
+        'frequency': np.bincount(pair_codes, weights=counts) / months,
+        'consistency': np.divide(std_totals, std_months, out=np.full(len(pairs), np.nan), where=std_months > 0),
     })
 
+
+# Label every (user, category) row of labeling_stats, comparing each category against its own user's quantiles
+def label_importance(category_stats):
+    metrics = ['total_spent', 'frequency', 'consistency']
+    quantiles = category_stats.groupby('user_code')[metrics].quantile([0.25, 0.75, 0.90]).unstack()
+    thresholds = quantiles.reindex(category_stats['user_code'])
+
+    def column(metric):
+        return category_stats[metric].to_numpy()
+
+    def threshold(metric, q):
+        return thresholds[(metric, q)].to_numpy()
+
+    spent, frequency, consistency = column('total_spent'), column('frequency'), column('consistency')
     conditions = [
         # Category is considered "Essential" if total spending is in the top 25% (high spending)
-        (category_stats['total_spent'] > category_stats['total_spent'].quantile(0.75)),
+        spent > threshold('total_spent', 0.75),
 
         # Category is considered "Essential" if frequency of spending is in the top 25% (high usage)
-        (category_stats['frequency'] > category_stats['frequency'].quantile(0.75)),
+        frequency > threshold('frequency', 0.75),
 
         # Category is considered "Moderate" if spending and frequency are both in the middle 50% range
-        (category_stats['total_spent'].between(category_stats['total_spent'].quantile(0.25), category_stats['total_spent'].quantile(0.75))) &  
-        (category_stats['frequency'].between(category_stats['frequency'].quantile(0.25), category_stats['frequency'].quantile(0.75))),
+        (spent >= threshold('total_spent', 0.25)) & (spent <= threshold('total_spent', 0.75)) &
+        (frequency >= threshold('frequency', 0.25)) & (frequency <= threshold('frequency', 0.75)),
 
         # Category is considered "Non-Essential" if spending consistency is low (low standard deviation)
-        (category_stats['consistency'] < category_stats['consistency'].quantile(0.25)),
+        consistency < threshold('consistency', 0.25),
 
         # Category is considered "Essential" if total spending is extremely high (top 10%) but rarely spent on (low frequency)
-        (category_stats['total_spent'] > category_stats['total_spent'].quantile(0.90)) &  
-        (category_stats['frequency'] <= category_stats['frequency'].quantile(0.25))
+        (spent > threshold('total_spent', 0.90)) & (frequency <= threshold('frequency', 0.25))
     ]
+    labels = [0, 0, 1, 2, 0]  # Indexes into IMPORTANCE_LABELS
+
+    # Later rules take precedence over earlier ones, so select from the last rule backwards
+    importance = np.select(conditions[::-1], labels[::-1], default=2)
+    return category_stats.assign(importance=importance, predicted_importance=IMPORTANCE_LABELS[importance])
+
+
+# Sorted [{'category', 'predicted_importance'}] list per user, Essential first
+# (same quicksort as DataFrame.sort_values, so categories with equal importance keep their established order)
+def _importance_lists(labeled):
+    lists = {}
+    for user, rows in labeled.groupby('user_code', sort=False):
+        order = np.argsort(rows['importance'].to_numpy(), kind='quicksort')
+        lists[user] = [
+            {'category': category, 'predicted_importance': importance}
+            for category, importance in zip(rows['category'].to_numpy()[order], rows['predicted_importance'].to_numpy()[order])
+        ]
+    return lists
 
-    labels = ['Essential', 'Essential', 'Moderate', 'Non-Essential', 'Essential']
-
-    category_stats['predicted_importance'] = 'Non-Essential'
-    for i in range(len(conditions)):
-        category_stats.loc[conditions[i], 'predicted_importance'] = labels[i]
-
-    category_importance = category_stats[['predicted_importance']].reset_index()
-
-    importance_order = {'Essential': 0, 'Moderate': 1, 'Non-Essential': 2}
-    category_importance['importance_order'] = category_importance['predicted_importance'].map(importance_order)
-    category_importance = category_importance.sort_values('importance_order').drop(columns=['importance_order'])
 
-    labeled_categories.append({
-        'predicted_importance': [
-            {'category': row[0], 'predicted_importance': row[1]}
-            for row in category_importance[['category', 'predicted_importance']].values.tolist()
-        ]
-    })
\ No newline at end of file
+# Label category importance based on rules
+def Rule_Based_labeling(past_expenses, labeled_categories, context=None):
+    predicted_importance = _importance_lists(label_importance(labeling_stats(past_expenses, context=context)))
+    labeled_categories.append({'predicted_importance': predicted_importance.get(0, [])})
+
+
+# Label many users' histories (rows carrying a "user_id" column) in one call: {user_id: predicted_importance}
+# Users with fewer than "min_expenses" expenses are skipped, as the single-user endpoint does
+def batch_rule_based_labeling(past_expenses, user_column='user_id', min_expenses=5):
+    expense_counts = past_expenses[user_column].value_counts()
+    past_expenses = past_expenses[past_expenses[user_column].isin(expense_counts.index[expense_counts >= min_expenses])]
+    if len(past_expenses) == 0:
+        return {}
+
+    labeled = label_importance(labeling_stats(past_expenses, user_column))
+    first_rows = labeled.drop_duplicates('user_code')
+    user_ids = dict(zip(first_rows['user_code'].tolist(), first_rows['user'].tolist()))
+    return {user_ids[code]: importance for code, importance in _importance_lists(labeled).items()}
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+# Binary (NumPy) columns are hashed by content instead of their truncated repr
+def _canonical_default(value):
+    if isinstance(value, np.ndarray):
+        return {'dtype': str(value.dtype), 'sha256': hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    return str(value)
+
+
+# Canonical SHA-256 of the given payload fields (missing fields are skipped, key order and whitespace don't matter)
+def payload_hash(namespace, data, fields):
+    relevant = {field: data[field] for field in fields if field in data}
+    canonical = json.dumps([namespace, relevant], sort_keys=True, separators=(',', ':'), default=_canonical_default)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Short stable fingerprint of the user a payload belongs to ("_" when the payload carries no "user_id")
+def user_fingerprint(data):
+    if data.get('user_id') is None:
+        return '_'
+    return hashlib.sha256(str(data['user_id']).encode('utf-8')).hexdigest()[:16]
+
+
+# Names of what the on-disk tier creates: one directory per user fingerprint (user_fingerprint) holding one
+# "<key>.json" per result, plus the temporary files they are written through; nothing else in disk_dir is ever touched
+USER_DIR_PATTERN = re.compile(r'^(_|[0-9a-f]{16})$')
+ENTRY_FILE_PATTERN = re.compile(r'^[^.].*\.json$')
+TEMPORARY_FILE_PATTERN = re.compile(r'^.+\.tmp$')
+
+
+# Bounded in-memory LRU of computed results with TTL, backed by an optional on-disk JSON tier
+# On disk, an entry's modification time is set to its expiry, so expired files can be pruned without reading them
+class ResultCache:
+    def __init__(self, max_entries=256, ttl=300, disk_dir=None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.last_prune = clock()
+
+    def _disk_path(self, key, user):
+        return os.path.join(self.disk_dir, user, f"{key}.json")
+
+    def get(self, key, user='_'):
+        now = self.clock()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                del self.entries[key]
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key, user), 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+            except (OSError, ValueError):
+                stored = None
+
+            if stored is not None and stored['expires_at'] > now:
+                self._remember(key, user, stored['value'], stored['expires_at'])
+                with self.lock:
+                    self.disk_hits += 1
+                return stored['value']
+            if stored is not None:
+                self._remove(self._disk_path(key, user))
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, user, value, expires_at):
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (expires_at, user, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set(self, key, value, user='_'):
+        now = self.clock()
+        expires_at = now + self.ttl
+        self._remember(key, user, value, expires_at)
+
+        if self.disk_dir:
+            path = self._disk_path(key, user)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a file of this writer's own, then rename, so concurrent readers never see a partial file and
+            # concurrent writers of the same key don't interleave
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{key}.", suffix='.tmp')
+            try:
+                with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+                    json.dump({'expires_at': expires_at, 'value': value}, f)
+                os.utime(temporary, (expires_at, expires_at))
+                os.replace(temporary, path)
+            except BaseException:
+                self._remove(temporary)
+                raise
+
+            # Expired entries are pruned at most once per TTL
+            if now - self.last_prune >= self.ttl:
+                self.last_prune = now
+                self.prune_disk(now)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    # The cache's own user directories under disk_dir (only this user's one when user is given)
+    def _user_dirs(self, user=None):
+        if user is not None:
+            return [os.path.join(self.disk_dir, user)] if os.path.basename(user) == user and user not in ('', '.', '..') else []
+        try:
+            names = os.listdir(self.disk_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.disk_dir, name) for name in names
+                if USER_DIR_PATTERN.match(name) and os.path.isdir(os.path.join(self.disk_dir, name))]
+
+    # Delete the cache's entry files in the given user directories (those that expired by "expired_before", or all of
+    # them) and temporary files older than "stale_before" (left by a writer that died; None keeps them, since a writer
+    # may still be renaming them), then the directories left empty; returns the number of files deleted
+    def _remove_entries(self, user_dirs, expired_before=None, stale_before=None):
+        removed = 0
+        for user_dir in user_dirs:
+            try:
+                entries = list(os.scandir(user_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if ENTRY_FILE_PATTERN.match(entry.name):
+                        if expired_before is not None and entry.stat().st_mtime > expired_before:
+                            continue
+                    elif not (TEMPORARY_FILE_PATTERN.match(entry.name) and stale_before is not None
+                              and entry.stat().st_mtime < stale_before):
+                        continue
+                    os.unlink(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+            try:
+                os.rmdir(user_dir)
+            except OSError:
+                pass
+        return removed
+
+    # Delete expired entries from the on-disk tier; returns the number of files deleted
+    def prune_disk(self, now=None):
+        if not self.disk_dir:
+            return 0
+        now = self.clock() if now is None else now
+        return self._remove_entries(self._user_dirs(), now, time.time() - max(self.ttl, 60))
+
+    # Drop every cached result of one user (or everything when user is None); on disk only the cache's own
+    # directories and entry files are deleted, never anything else in disk_dir
+    def invalidate(self, user=None):
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if user is None or entry[1] == user]
+            for key in keys:
+                del self.entries[key]
+
+        if self.disk_dir:
+            self._remove_entries(self._user_dirs(user))
+
+        return len(keys)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
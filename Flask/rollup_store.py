@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import pandas as pd
+
+DEFAULT_ROLLUP_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rollups.db')
+
+
+# Open the rollup database (path can be overridden with "ROLLUP_DB_PATH") and make sure the tables exist
+def connect(db_path=None):
+    conn = sqlite3.connect(db_path or os.getenv('ROLLUP_DB_PATH', DEFAULT_ROLLUP_DB_PATH))
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS monthly_rollups (
+            user_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, year, month, category)
+        );
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            user_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, year, month, category, day)
+        );
+    """)
+    return conn
+
+
+# Aggregate signed expenses into (year, month, category, day) amount and count deltas
+def _daily_deltas(expenses):
+    dates = pd.to_datetime(expenses['date'])
+    return (
+        pd.DataFrame({
+            'year': dates.dt.year,
+            'month': dates.dt.month,
+            'category': expenses['category'].values,
+            'day': dates.dt.day,
+            'amount': expenses['amount'].astype(float).values * expenses['sign'].values,
+            'count': expenses['sign'].values,
+        })
+        .groupby(['year', 'month', 'category', 'day'])[['amount', 'count']]
+        .sum()
+        .reset_index()
+    )
+
+
+# Append added/deleted expenses to a user's rollups (replace=True rebuilds the user's rollups from scratch)
+def ingest_expenses(user_id, expenses, deleted_expenses=None, replace=False, db_path=None):
+    added = pd.DataFrame(expenses, columns=['amount', 'date', 'category']).assign(sign=1)
+    deleted = pd.DataFrame(deleted_expenses or [], columns=['amount', 'date', 'category']).assign(sign=-1)
+    deltas = _daily_deltas(pd.concat([frame for frame in [added, deleted] if len(frame) > 0] or [added], ignore_index=True))
+
+    user_id = str(user_id)
+    daily_rows = [
+        (user_id, int(row.year), int(row.month), row.category, int(row.day), float(row.amount), int(row.count))
+        for row in deltas.itertuples(index=False)
+    ]
+    monthly = deltas.groupby(['year', 'month', 'category'])[['amount', 'count']].sum().reset_index()
+    monthly_rows = [
+        (user_id, int(row.year), int(row.month), row.category, float(row.amount), int(row.count))
+        for row in monthly.itertuples(index=False)
+    ]
+
+    with connect(db_path) as conn:
+        if replace:
+            conn.execute("DELETE FROM daily_rollups WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM monthly_rollups WHERE user_id = ?", (user_id,))
+
+        conn.executemany("""
+            INSERT INTO daily_rollups (user_id, year, month, category, day, amount, count) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, year, month, category, day)
+            DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count
+        """, daily_rows)
+        conn.executemany("""
+            INSERT INTO monthly_rollups (user_id, year, month, category, amount, count) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, year, month, category)
+            DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count
+        """, monthly_rows)
+
+        # Drop buckets whose expenses were all deleted
+        conn.execute("DELETE FROM daily_rollups WHERE user_id = ? AND count <= 0", (user_id,))
+        conn.execute("DELETE FROM monthly_rollups WHERE user_id = ? AND count <= 0", (user_id,))
+    conn.close()
+
+    return len(daily_rows)
+
+
+# Load a user's history before (year, month) as one row per (date, category) with the summed amount
+def load_history(user_id, before_year, before_month, db_path=None):
+    with connect(db_path) as conn:
+        rows = conn.execute("""
+            SELECT year, month, day, category, amount, count FROM daily_rollups
+            WHERE user_id = ? AND (year * 12 + month) < ?
+            ORDER BY year, month, day, category
+        """, (str(user_id), before_year * 12 + before_month)).fetchall()
+    conn.close()
+
+    history = pd.DataFrame(rows, columns=['year', 'month', 'day', 'category', 'amount', 'count']).astype({'amount': float, 'count': int})
+    history['date'] = pd.to_datetime(history[['year', 'month', 'day']])
+    return history[['date', 'amount', 'category', 'count']]
+
+
+# Load a user's closed-month totals per category before (year, month)
+def load_monthly_rollups(user_id, before_year, before_month, db_path=None):
+    with connect(db_path) as conn:
+        rows = conn.execute("""
+            SELECT year, month, category, amount, count FROM monthly_rollups
+            WHERE user_id = ? AND (year * 12 + month) < ?
+            ORDER BY year, month, category
+        """, (str(user_id), before_year * 12 + before_month)).fetchall()
+    conn.close()
+
+    return pd.DataFrame(rows, columns=['year', 'month', 'category', 'amount', 'count'])
@@ -0,0 +1,57 @@
+import dataclasses
+import decimal
+import json
+from datetime import date
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+# Responses are encoded with orjson when it is installed, and with the standard library otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+
+# Values neither encoder handles natively, converted the way Flask's own provider does; NumPy scalars and arrays become
+# Python numbers and lists (orjson encodes those itself)
+def _default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Compact UTF-8 JSON bytes; NaN and infinities are encoded as null by orjson (the standard library writes NaN)
+def dumps(value, sort_keys=True):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=ORJSON_OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+    return json.dumps(value, default=_default, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# Rows of a frame as dicts, built from one Python list per column (what to_dict(orient='records') gives, in one pass)
+def records(frame):
+    columns = list(frame.columns)
+    return [dict(zip(columns, row)) for row in zip(*(frame[column].tolist() for column in columns))]
+
+
+# Flask JSON provider encoding jsonify() responses with dumps(): the response body is written straight from the bytes
+# and keys stay sorted like Flask's default provider; requests are still parsed by the default provider
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, kwargs.get('sort_keys', self.sort_keys)).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, self.sort_keys), mimetype=self.mimetype)
@@ -0,0 +1,216 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from analysis_context import AnalysisContext
+from ml_models import category_linear_regression, Rule_Based_labeling
+from business_logic import analyze_spending_deviations
+from spend_index import SpendIndexCache
+
+logger = logging.getLogger(__name__)
+
+# Segment names carry the owner's pid, so segments left behind by a crashed process can be told apart
+SEGMENT_PREFIX = 'fa_'
+SHM_DIR = '/dev/shm'
+
+_owned = {}
+_attached = {}
+_registry_lock = threading.Lock()
+
+
+# Smallest signed code dtype pandas itself would use for this many categories, so Categorical.from_codes doesn't copy
+def _code_dtype(category_count):
+    for dtype in (np.int8, np.int16, np.int32):
+        if category_count < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+# Expense columns (amounts, nanosecond timestamps, category codes) copied once into one shared memory segment;
+# the picklable "descriptor" is all a worker needs to attach to them. The creating process owns the segment and
+# must close() it (or use it as a context manager); segments still open at exit are reported and released
+class SharedExpenses:
+    def __init__(self, context, label=None):
+        codes = context.category_codes.astype(_code_dtype(len(context.categories)))
+        columns = {'amount': context.amounts, 'timestamp': context.timestamps, 'category_code': codes}
+
+        layout, offset = {}, 0
+        for name, values in columns.items():
+            layout[name] = (offset, values.dtype.str)
+            offset += -(-values.nbytes // 8) * 8  # 8-byte aligned columns
+
+        self.name = f"{SEGMENT_PREFIX}{os.getpid()}_{uuid.uuid4().hex[:12]}"
+        self.segment = shared_memory.SharedMemory(name=self.name, create=True, size=max(offset, 1))
+        for name, values in columns.items():
+            start, dtype = layout[name]
+            np.ndarray(len(values), dtype=dtype, buffer=self.segment.buf, offset=start)[:] = values
+
+        self.descriptor = {
+            'name': self.name,
+            'rows': context.size,
+            'layout': layout,
+            'categories': list(context.categories),
+        }
+        with _registry_lock:
+            _owned[self.name] = {'bytes': self.segment.size, 'label': label, 'created_at': time.time(), 'segment': self}
+
+    def close(self):
+        with _registry_lock:
+            if _owned.pop(self.name, None) is None:
+                return
+        self.segment.close()
+        try:
+            self.segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Worker side of a SharedExpenses segment: NumPy views over the shared columns, an expense frame built on those views
+# (date, amount and a categorical category column, none of them copied) and the matching AnalysisContext
+# Use it as a context manager and don't keep the frame or any view past it, since the segment is closed on exit
+class AttachedExpenses:
+    def __init__(self, descriptor):
+        self.name = descriptor['name']
+        self.segment = shared_memory.SharedMemory(name=self.name)
+        with _registry_lock:
+            _attached[self.name] = _attached.get(self.name, 0) + 1
+
+        rows = descriptor['rows']
+        views = {
+            name: np.ndarray(rows, dtype=np.dtype(dtype), buffer=self.segment.buf, offset=offset)
+            for name, (offset, dtype) in descriptor['layout'].items()
+        }
+        categories = pd.Index(descriptor['categories'], dtype=object)
+        self.frame = pd.DataFrame({
+            'date': views['timestamp'].view('datetime64[ns]'),
+            'amount': views['amount'],
+            'category': pd.Categorical.from_codes(views['category_code'], categories=categories),
+        }, copy=False)
+        self.context = AnalysisContext(self.frame, category_codes=views['category_code'], categories=categories)
+
+    def close(self):
+        # Every view has to be gone before the mapping can be closed; one that escaped keeps the attachment open,
+        # and it is reported by attached_segments()
+        self.frame = self.context = None
+        try:
+            self.segment.close()
+        except BufferError:
+            logger.warning("Shared memory segment %s is still referenced by a NumPy view and stays attached", self.name)
+            return
+        with _registry_lock:
+            _attached[self.name] -= 1
+            if _attached[self.name] == 0:
+                del _attached[self.name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Segments this process created and hasn't closed yet: {name: {"bytes", "label", "age_seconds"}}
+def live_segments():
+    now = time.time()
+    with _registry_lock:
+        return {name: {'bytes': entry['bytes'], 'label': entry['label'], 'age_seconds': round(now - entry['created_at'], 3)}
+                for name, entry in _owned.items()}
+
+
+# Segments this process is attached to right now: {name: number of open attachments}
+def attached_segments():
+    with _registry_lock:
+        return dict(_attached)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Segments in /dev/shm whose creating process is gone (left behind by a crash or a kill)
+def orphaned_segments():
+    if not os.path.isdir(SHM_DIR):
+        return []
+    orphans = []
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(SEGMENT_PREFIX):
+            continue
+        pid = name[len(SEGMENT_PREFIX):].split('_', 1)[0]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            orphans.append(name)
+    return sorted(orphans)
+
+
+def remove_orphaned_segments():
+    removed = []
+    for name in orphaned_segments():
+        try:
+            os.unlink(os.path.join(SHM_DIR, name))
+            removed.append(name)
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+# Leak check at exit: segments nobody closed are logged and released so they don't outlive the process
+@atexit.register
+def _release_leaked_segments():
+    leaked = live_segments()
+    if leaked:
+        logger.warning("Releasing %d leaked shared memory segment(s): %s", len(leaked), leaked)
+    with _registry_lock:
+        segments = [entry['segment'] for entry in _owned.values()]
+    for segment in segments:
+        segment.close()
+
+
+# Worker tasks of the shared-memory execution mode: each one attaches to the segments it is given (descriptors),
+# runs one analysis function on the shared views and returns plain Python results
+
+def category_predictions_task(history, month_num=12):
+    with AttachedExpenses(history) as shared:
+        category_predictions = {}
+        category_linear_regression(shared.frame, category_predictions, month_num=month_num, context=shared.context)
+        return category_predictions
+
+
+def importance_labels_task(past_expenses):
+    with AttachedExpenses(past_expenses) as shared:
+        labeled_categories = []
+        Rule_Based_labeling(shared.frame, labeled_categories, context=shared.context)
+        return labeled_categories
+
+
+# Trivial task that starts a worker process
+def worker_pid(_=None):
+    return os.getpid()
+
+
+# Each worker process keeps its own per-user spend indexes
+_worker_spend_indexes = SpendIndexCache(max_entries=int(os.getenv("SPEND_INDEX_CACHE_SIZE", 1024)))
+
+
+def deviation_insights_task(expenses, history, user=None):
+    with AttachedExpenses(expenses) as current, AttachedExpenses(history) as past:
+        smart_insights = []
+        spend_index = _worker_spend_indexes.get(user) if user is not None else None
+        analyze_spending_deviations(current.frame, past.frame, smart_insights, spend_index=spend_index, context=current.context)
+        return smart_insights
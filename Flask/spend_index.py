@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+DAYS_IN_MONTH = 31
+
+
+# Months since 1970 of every expense date
+def _month_keys(dates):
+    return dates.to_numpy().astype('datetime64[M]').astype(np.int64)
+
+
+# (row count, amount total) of every month in a history frame: a cheap freshness key made of numeric reductions only,
+# so a warm lookup costs no more than reading the date and amount columns. Edits keeping both the same (an expense moved
+# to another category or day) aren't seen here; the stores drop the user's index when they are written instead
+def month_fingerprints(history):
+    if len(history) == 0:
+        return {}
+
+    month_keys = _month_keys(history['date'])
+    first = month_keys.min()
+    counts = np.bincount(month_keys - first)
+    totals = np.bincount(month_keys - first, weights=history['amount'].to_numpy(dtype=float))
+    present = np.flatnonzero(counts)
+    return {int(first + offset): (int(counts[offset]), float(totals[offset])) for offset in present}
+
+
+# Cumulative spend per (month, category, day) for the days a category had expenses in that month
+def month_contributions(history):
+    dates = history['date']
+    daily = (
+        pd.DataFrame({
+            'month_key': _month_keys(dates),
+            'category': history['category'].to_numpy(),
+            'day': dates.dt.day.to_numpy(),
+            'amount': history['amount'].to_numpy(dtype=float),
+        })
+        .groupby(['month_key', 'category', 'day'])['amount'].sum()
+    )
+    cumulative = daily.groupby(level=['month_key', 'category']).cumsum().rename('cumulative').reset_index()
+    return {int(key): month.drop(columns='month_key') for key, month in cumulative.groupby('month_key')}
+
+
+# Historical cumulative-spend curve of one user: the average spend so far on each day of the month per category,
+# as a category x 31 array that is only recomputed for months whose expenses changed (i.e. once a month closes)
+class CumulativeSpendIndex:
+    def __init__(self):
+        self.fingerprints = {}
+        self.contributions = {}
+        self.categories = pd.Index([])
+        self.curve = np.empty((0, DAYS_IN_MONTH))
+        self.lock = threading.Lock()
+
+    # Bring the index in line with a history frame, rebuilding only the months that were added or changed
+    def update(self, history):
+        fingerprints = month_fingerprints(history)
+        if fingerprints == self.fingerprints:
+            return self
+
+        changed = [key for key, fingerprint in fingerprints.items() if self.fingerprints.get(key) != fingerprint]
+        for key in set(self.contributions) - set(fingerprints):
+            del self.contributions[key]
+        if changed:
+            self.contributions.update(month_contributions(history[np.isin(_month_keys(history['date']), changed)]))
+
+        self.fingerprints = fingerprints
+        self._rebuild_curve()
+        return self
+
+    # Average the stored month contributions (in month order) and forward-fill over the days seen in any month
+    def _rebuild_curve(self):
+        if not self.contributions:
+            self.categories = pd.Index([])
+            self.curve = np.empty((0, DAYS_IN_MONTH))
+            return
+
+        averages = (
+            pd.concat([self.contributions[key] for key in sorted(self.contributions)], ignore_index=True)
+            .groupby(['category', 'day'])['cumulative'].mean()
+            .unstack()
+        )
+        seen_days = averages.columns.to_numpy()
+        curve = averages.reindex(columns=range(1, DAYS_IN_MONTH + 1)).ffill(axis=1).to_numpy()
+        curve[:, ~np.isin(np.arange(1, DAYS_IN_MONTH + 1), seen_days)] = np.nan
+
+        self.categories = averages.index
+        self.curve = curve
+
+    # Historical spend by "day" of the month per category (categories without a reference are left out)
+    def reference(self, day):
+        if not 1 <= day <= DAYS_IN_MONTH:
+            return pd.Series(dtype=float)
+        return pd.Series(self.curve[:, day - 1], index=self.categories).dropna()
+
+    def lookup(self, history, day):
+        with self.lock:
+            return self.update(history).reference(day)
+
+
+# A user's spend index as it is, for callers that only have the current month: lookups ignore the history frame
+# (the curve only depends on closed months, which adding a current-month expense doesn't change)
+class FrozenSpendIndex:
+    def __init__(self, index):
+        self.index = index
+
+    def lookup(self, history, day):
+        with self.index.lock:
+            return self.index.reference(day)
+
+
+# Bounded LRU of per-user spend indexes
+class SpendIndexCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user='_'):
+        with self.lock:
+            index = self.indexes.get(user)
+            if index is None:
+                index = self.indexes[user] = CumulativeSpendIndex()
+            self.indexes.move_to_end(user)
+            while len(self.indexes) > max(self.max_entries, 1):
+                self.indexes.popitem(last=False)
+            return index
+
+    def invalidate(self, user=None):
+        with self.lock:
+            if user is None:
+                removed = len(self.indexes)
+                self.indexes.clear()
+                return removed
+            return 1 if self.indexes.pop(user, None) is not None else 0
@@ -0,0 +1,169 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+
+# Exponentially weighted seconds per input row of every stage (and of its reduced mode), learned from past runs
+# and used to predict whether a stage still fits in a request's latency budget
+class StageCosts:
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.per_row = {}
+        self.lock = threading.Lock()
+
+    def observe(self, key, rows, seconds):
+        with self.lock:
+            previous = self.per_row.get(key)
+            current = seconds / max(rows, 1)
+            self.per_row[key] = current if previous is None else previous + self.smoothing * (current - previous)
+
+    # Predicted seconds, or None when the stage has never run
+    def estimate(self, key, rows):
+        with self.lock:
+            per_row = self.per_row.get(key)
+        return None if per_row is None else per_row * max(rows, 1)
+
+
+# One side-effect-free pipeline step: reads the named "inputs", returns the named "outputs" (a tuple when there are several)
+# "optional" stages may be skipped when the latency budget runs out (their outputs keep their initial values), and
+# "reduced" is a cheaper function with the same signature that is used instead of "func" when the budget is at risk
+class Stage:
+    def __init__(self, name, func, inputs, outputs, sizes=None, optional=False, reduced=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.sizes = sizes or {}
+        self.optional = optional
+        self.reduced = reduced
+
+    def arguments(self, values):
+        return [values[name] for name in self.inputs]
+
+    def cost_key(self, mode):
+        return self.name if mode == 'full' else f"{self.name}_{mode}"
+
+    def run(self, arguments, trace=None, mode='full', costs=None):
+        func = self.reduced if mode == 'reduced' else self.func
+        start = time.perf_counter()
+        with trace.stage(self.cost_key(mode), **self.sizes) if trace is not None else nullcontext():
+            result = func(*arguments)
+        if costs is not None:
+            costs.observe(self.cost_key(mode), self.sizes.get('rows', 1), time.perf_counter() - start)
+        return dict(zip(self.outputs, result if len(self.outputs) > 1 else (result,)))
+
+
+# Stages whose inputs are missing or that form a cycle would never run
+def _check_graph(stages, values):
+    produced = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in produced:
+                raise ValueError(f"'{output}' is produced by both '{produced[output]}' and '{stage.name}'")
+            produced[output] = stage.name
+
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in values and name not in produced]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' needs unknown inputs: {', '.join(missing)}")
+        if stage.optional and any(output not in values for output in stage.outputs):
+            raise ValueError(f"Optional stage '{stage.name}' needs initial values for its outputs")
+
+    # Kahn's topological sort: whatever can't be ordered waits on itself, so it's rejected before any stage runs
+    depends_on = {stage.name: {produced[name] for name in stage.inputs if name in produced} for stage in stages}
+    ordered = [name for name, producers in depends_on.items() if not producers]
+    for name in ordered:
+        for stage, producers in depends_on.items():
+            if name in producers:
+                producers.discard(name)
+                if not producers:
+                    ordered.append(stage)
+    if len(ordered) < len(stages):
+        raise ValueError(f"Stages form a cycle: {', '.join(stage.name for stage in stages if stage.name not in ordered)}")
+
+
+# How to run a stage given what is left of the budget: "full", "reduced" or "skipped"
+def _plan(stage, deadline, costs):
+    if deadline is None or not (stage.optional or stage.reduced):
+        return 'full'
+
+    remaining = deadline - time.perf_counter()
+    rows = stage.sizes.get('rows', 1)
+
+    def fits(mode):
+        estimate = costs.estimate(stage.cost_key(mode), rows) if costs is not None else None
+        return remaining > 0 and (estimate is None or estimate <= remaining)
+
+    if fits('full'):
+        return 'full'
+    if stage.reduced is not None and (fits('reduced') or not stage.optional):
+        return 'reduced'
+    return 'skipped' if stage.optional else 'full'
+
+
+# Run a DAG of stages, each as soon as every stage producing one of its inputs has finished
+# Independent stages run concurrently on a thread pool (max_workers <= 1 runs them in order on the calling thread);
+# every intermediate is computed once and shared. Returns the initial values updated with every stage's outputs
+# With a "deadline" (time.perf_counter() value), optional stages that are predicted not to fit are reduced or skipped,
+# and optional stages still running at the deadline are abandoned; each of those is appended to "degraded_stages"
+def run_stages(stages, values, max_workers=4, trace=None, deadline=None, costs=None, degraded_stages=None):
+    values = dict(values)
+    _check_graph(stages, values)
+    pending = list(stages)
+    degraded_stages = [] if degraded_stages is None else degraded_stages
+
+    def take_ready(unfinished):
+        waiting = {output for stage in unfinished for output in stage.outputs}
+        ready = [stage for stage in pending if not waiting.intersection(stage.inputs)]
+        if not ready and unfinished == pending:
+            raise ValueError(f"Stages form a cycle: {', '.join(stage.name for stage in pending)}")
+        for stage in ready:
+            pending.remove(stage)
+        return ready
+
+    def planned(ready):
+        for stage in ready:
+            mode = _plan(stage, deadline, costs)
+            if mode != 'full':
+                degraded_stages.append({'stage': stage.name, 'mode': mode})
+            if mode != 'skipped':
+                yield stage, mode
+
+    if max_workers <= 1:
+        while pending:
+            for stage, mode in planned(take_ready(pending)):
+                values.update(stage.run(stage.arguments(values), trace, mode, costs))
+        return values
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    abandoned = False
+    try:
+        running = {}
+        while pending or running:
+            for stage, mode in planned(take_ready(pending + list(running.values()))):
+                running[pool.submit(stage.run, stage.arguments(values), trace, mode, costs)] = stage
+            if not running:
+                continue
+
+            timeout = None
+            if deadline is not None and any(stage.optional for stage in running.values()):
+                timeout = max(deadline - time.perf_counter(), 0)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            # Out of time: stop waiting for optional stages (their threads finish in the background, results unused)
+            if not done:
+                for future, stage in list(running.items()):
+                    if stage.optional:
+                        future.cancel()
+                        del running[future]
+                        degraded_stages.append({'stage': stage.name, 'mode': 'timed_out'})
+                        abandoned = True
+
+            for future in done:
+                del running[future]
+                values.update(future.result())
+    finally:
+        pool.shutdown(wait=not abandoned, cancel_futures=True)
+
+    return values
@@ -0,0 +1,105 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+startup_timings = {}
+warmup_state = {'status': 'disabled', 'seconds': None, 'error': None}
+# Synthetic user the warm-up requests run as, so whatever they leave behind can be dropped by user afterwards
+WARMUP_USER_ID = '__warmup__'
+_process_start = time.perf_counter()
+
+
+# Time one phase of process startup (imports, warm-up) for the startup report
+@contextmanager
+def startup_phase(name):
+    phase_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - phase_start) * 1000, 2)
+
+
+# Startup-time breakdown in milliseconds, plus the warm-up status
+def startup_report():
+    return {
+        'phases_ms': dict(startup_timings),
+        'total_ms': round(sum(startup_timings.values()), 2),
+        'uptime_seconds': round(time.perf_counter() - _process_start, 2),
+        'warmup': dict(warmup_state),
+    }
+
+
+# The service is ready once warm-up finished (or when warm-up is not enabled at all)
+def is_ready():
+    return warmup_state['status'] in ('disabled', 'done')
+
+
+# Deterministic synthetic /analysis and /label_categories payloads large enough to switch on every pipeline stage
+def synthetic_payloads(password, today=None):
+    today = today or date.today()
+    month_start = today.replace(day=1)
+    categories = ['Food', 'Transport', 'Bills', 'Entertainment', 'Healthcare']
+
+    expenses = [
+        {
+            'date': (month_start + timedelta(days=i % 20)).isoformat(),
+            'amount': 20 + (i * 37) % 300,
+            'category': categories[(i * 7) % len(categories)],
+        }
+        for i in range(40)
+    ]
+
+    history = []
+    for months_back in range(1, 7):
+        year, month = divmod(today.year * 12 + today.month - 1 - months_back, 12)
+        first_day = date(year, month + 1, 1)
+        history.extend(
+            {
+                'date': (first_day + timedelta(days=i % 28)).isoformat(),
+                'amount': 30 + months_back * 5 + (i * 53) % 250,
+                'category': categories[i % len(categories)],
+            }
+            for i in range(30)
+        )
+
+    analysis = {
+        'password': password,
+        'user_id': WARMUP_USER_ID,
+        'expenses': expenses,
+        'all_expenses': history + expenses,
+        'categories': [{'name': name, 'priority': priority} for priority, name in enumerate(categories, start=1)],
+        'monthly_budget': 10000,
+        'goal_amount': 1000,
+        'total_spent': sum(expense['amount'] for expense in expenses),
+    }
+    labeling = {'password': password, 'user_id': WARMUP_USER_ID, 'past_expenses': history}
+
+    return analysis, labeling
+
+
+# Run the full pipeline once through the Flask test client, so lazy imports and first-call overheads are paid up front
+def run_warmup(app, password, on_done=None):
+    warmup_state.update(status='running', error=None)
+    try:
+        with startup_phase('warmup'):
+            analysis, labeling = synthetic_payloads(password)
+            client = app.test_client()
+            for route, payload in [('/analysis', analysis), ('/label_categories', labeling)]:
+                response = client.post(route, json=payload)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{route} returned {response.status_code} during warm-up")
+
+        if on_done is not None:
+            on_done()
+        warmup_state.update(status='done', seconds=round(startup_timings['warmup'] / 1000, 3))
+    except Exception as e:
+        warmup_state.update(status='failed', error=str(e))
+
+
+# Start warm-up on a background thread so the server can accept connections (and answer /ready) meanwhile
+def start_warmup(app, password, on_done=None):
+    warmup_state.update(status='pending')
+    thread = threading.Thread(target=run_warmup, args=(app, password, on_done), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+CATEGORY_NAMES = [
+    'Food', 'Transport', 'Bills', 'Entertainment', 'Healthcare', 'Shopping', 'Education', 'Travel',
+    'Groceries', 'Rent', 'Insurance', 'Gifts', 'Subscriptions', 'Fitness', 'Pets', 'Charity'
+]
+
+
+# Category names: the realistic ones first, then numbered ones for larger counts
+def category_names(count):
+    return [CATEGORY_NAMES[i] if i < len(CATEGORY_NAMES) else f'Category {i + 1}' for i in range(count)]
+
+
+# Seeded synthetic expense histories (user_id, date, amount, category) ending the day before "end"
+# Daily expense counts are Poisson with a yearly seasonal swing, categories follow a Zipf-like popularity and
+# amounts are log-normal around a per-category typical price with a slow upward trend
+def generate_expenses(users=1, months=12, categories=10, expenses_per_day=3.0, seasonality=0.25, trend=0.01,
+                      seed=42, end='2025-01-01'):
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end)
+    start = end - pd.DateOffset(months=months)
+    days = pd.date_range(start, end - pd.Timedelta(days=1), freq='D')
+
+    day_of_year = days.dayofyear.to_numpy()
+    seasonal = 1 + seasonality * np.sin(2 * np.pi * (day_of_year - 80) / 365.25)
+
+    counts = rng.poisson(expenses_per_day * np.tile(seasonal, users))
+    user_ids = np.repeat(np.repeat(np.arange(1, users + 1), len(days)), counts)
+    day_index = np.repeat(np.tile(np.arange(len(days)), users), counts)
+    rows = len(day_index)
+
+    popularity = 1 / np.arange(1, categories + 1)
+    category_codes = rng.choice(categories, size=rows, p=popularity / popularity.sum())
+    typical_price = np.exp(rng.uniform(np.log(20), np.log(800), categories))
+
+    months_elapsed = day_index / 30.44
+    amounts = typical_price[category_codes] * rng.lognormal(0, 0.5, rows) * (1 + trend) ** months_elapsed
+
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'date': days.to_numpy()[day_index],
+        'amount': np.round(amounts, 2),
+        'category': np.asarray(category_names(categories), dtype=object)[category_codes],
+    })
+
+
+# Same generator, tuned so a single user's history has roughly the requested number of rows
+def generate_rows(rows, months=24, categories=10, seed=42, **kwargs):
+    expenses_per_day = max(rows, 1) / (months * 30.44)
+    return generate_expenses(months=months, categories=categories, expenses_per_day=expenses_per_day, seed=seed, **kwargs)
+
+
+# JSON-ready rows ({amount, date, category}) as Laravel sends them
+def to_payload_rows(expenses):
+    return [
+        {'amount': float(amount), 'date': date, 'category': category}
+        for amount, date, category in zip(expenses['amount'], expenses['date'].dt.strftime('%Y-%m-%d'), expenses['category'])
+    ]
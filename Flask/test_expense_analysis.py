@@ -1,26 +1,96 @@
 import unittest
 import pandas as pd
 import numpy as np
+import importlib.util
 import json
+import logging
 import os
+import tempfile
+import threading
+import io
+import contextlib
+import gzip
+import time
+import subprocess
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime, timedelta
+from werkzeug.test import EnvironBuilder
 
 from business_logic import (
     assign_limits, 
     predictive_insights, 
     analyze_spending_variability,
     analyze_spending_deviations,
-    day_of_week_analysis
+    day_of_week_analysis,
+    batch_predictive_insights,
+    batch_assign_limits,
+    batch_day_of_week_analysis
 )
 from ml_models import (
+    batched_linear_forecast,
+    sufficient_stats,
+    merge_stats,
+    stats_linear_forecast,
+    state_category_linear_regression,
+    cluster_labels_1d,
+    frequent_itemsets,
+    optimal_1d_clusters,
     linear_regression,
     category_linear_regression,
     kmeans_clustering,
     spending_kmeans_clustering,
     frequency_kmeans_clustering,
     get_association_rules,
-    Rule_Based_labeling
+    labeling_stats,
+    Rule_Based_labeling,
+    batch_rule_based_labeling
 )
+from rollup_store import ingest_expenses, load_history
+from history_store import (
+    append_expenses,
+    compact_history,
+    history_stats,
+    load_history as load_stored_history,
+    main as history_store_main
+)
+from anomaly_scoring import AnomalyScorer, QuantileSketch, RunningStats, build_anomaly_state, load_anomaly_state
+from forecast_store import (
+    connect as connect_forecasts,
+    fold_closed_months,
+    load_forecast_state,
+    update_forecast_state,
+    verify_forecast_states,
+    main as forecast_store_main
+)
+from result_cache import ResultCache, payload_hash, user_fingerprint
+from spend_index import CumulativeSpendIndex, SpendIndexCache
+from analysis_context import AnalysisContext, WEEKDAY_NAMES
+from stage_scheduler import Stage, StageCosts, run_stages
+import startup
+from columnar import COLUMN_DTYPES, decode_columns, encode_columns, expenses_frame, expenses_context
+from llm_client import LLMClient
+from metrics import Histogram, RequestTrace
+from synthetic_data import generate_expenses, generate_rows, to_payload_rows
+import benchmark
+import analysis_service
+import batch_analysis
+import shared_frames
+from shared_frames import SharedExpenses, AttachedExpenses
+from analysis_jobs import AnalysisJobs, JobQueueFull
+import serialization
+import ml_models
+import transport
+
+
+# Job function for the AnalysisJobs tests (module level, so worker processes can import it)
+def square_after(payload):
+    time.sleep(payload.get('sleep', 0))
+    if payload['value'] < 0:
+        raise ValueError("negative value")
+    return payload['value'] ** 2
 
 class TestBusinessLogicMeaningful(unittest.TestCase):
     
@@ -328,6 +398,29 @@ class TestMLModelsAccuracy(unittest.TestCase):
         # Should not generate predictions for random data with high thresholds
         self.assertEqual(len(category_predictions), 0)
     
+    def test_batched_linear_forecast_matches_per_series_fit(self):
+        # Every row is fitted on its own months only, so gaps must not shift the time index
+        monthly_matrix = np.array([
+            [100, 120, 140, 160, 180],
+            [np.nan, 300, np.nan, 250, 200],
+            [50, 50, 50, np.nan, np.nan]
+        ])
+        counts, r2, correlation, forecasts = batched_linear_forecast(monthly_matrix, month_num=3)
+
+        np.testing.assert_array_equal(counts, [5, 3, 3])
+
+        for row in range(2):
+            y = monthly_matrix[row][~np.isnan(monthly_matrix[row])]
+            x = np.arange(1, len(y) + 1)
+            slope, intercept = np.polyfit(x, y, 1)
+            expected = np.maximum(0, intercept + slope * np.arange(len(y) + 1, len(y) + 4))
+            np.testing.assert_allclose(forecasts[row], expected)
+            self.assertAlmostEqual(r2[row], np.corrcoef(x, y)[0, 1] ** 2)
+            self.assertAlmostEqual(correlation[row], abs(np.corrcoef(x, y)[0, 1]))
+
+        # A flat series has no trend to report
+        self.assertTrue(np.isnan(correlation[2]))
+
     def test_kmeans_clustering_meaningful_groups(self):
         # Test if K-means correctly identifies spending groups
         smart_insights = []
@@ -350,6 +443,27 @@ class TestMLModelsAccuracy(unittest.TestCase):
         
         self.assertGreater(high_cluster['min_expenses'], low_cluster['max_expenses'])
     
+    def test_exact_clustering_is_optimal_and_matches_sklearn_labels(self):
+        amounts = self.clustering_expenses['amount']
+        ranks = optimal_1d_clusters(amounts, 3)
+
+        # The three well separated groups are recovered in order, lowest group first
+        np.testing.assert_array_equal(ranks, [0] * 5 + [1] * 5 + [2] * 5)
+
+        exact_ids, exact_labels = cluster_labels_1d(amounts, backend='exact')
+        _, sklearn_labels = cluster_labels_1d(amounts, backend='sklearn')
+        np.testing.assert_array_equal(exact_labels, sklearn_labels)
+
+        # Repeated runs give the same answer
+        np.testing.assert_array_equal(cluster_labels_1d(amounts, backend='exact')[0], exact_ids)
+
+    def test_exact_clustering_with_fewer_values_than_clusters(self):
+        _, labels = cluster_labels_1d([10, 10, 500, 500], backend='exact')
+        np.testing.assert_array_equal(labels, ['Moderate', 'Moderate', 'High', 'High'])
+
+        with self.assertRaises(ValueError):
+            cluster_labels_1d([1, 2, 3], backend='unknown')
+
     def test_spending_clustering_category_grouping(self):
         # Test if spending clustering groups categories correctly by total spending
         spending_clustering = []
@@ -460,6 +574,23 @@ class TestMLModelsAccuracy(unittest.TestCase):
                 all_items = rule['antecedents'] + rule['consequents']
                 self.assertTrue('Food' in all_items or 'Bills' in all_items)
     
+    def test_frequent_itemsets_supports_from_bitsets(self):
+        # 4 transactions (days) x 3 items: item 0 and 1 always appear together, item 2 only once
+        basket = np.array([
+            [True, True, False],
+            [True, True, True],
+            [True, True, False],
+            [False, False, False]
+        ])
+        itemsets = frequent_itemsets(basket, min_support=0.25)
+
+        self.assertEqual(itemsets, {
+            (0,): 0.75, (1,): 0.75, (2,): 0.25,
+            (0, 1): 0.75, (0, 2): 0.25, (1, 2): 0.25,
+            (0, 1, 2): 0.25
+        })
+        self.assertEqual(list(frequent_itemsets(basket, min_support=0.5)), [(0,), (1,), (0, 1)])
+
     def test_rule_based_labeling_importance_classification(self):
         # Create historical data with clear spending patterns for importance labeling
         high_essential_expenses = pd.DataFrame({
@@ -483,6 +614,30 @@ class TestMLModelsAccuracy(unittest.TestCase):
         # Entertainment (low spending) should be Non-Essential or Moderate
         self.assertIn(entertainment_importance, ['Non-Essential', 'Moderate'])
 
+    def test_labeling_stats_match_grouped_pandas(self):
+        history = generate_rows(2000, months=8, categories=6, seed=5).drop(columns='user_id')
+        stats = labeling_stats(history).set_index('category')
+
+        monthly = history.groupby([history['date'].dt.to_period('M'), 'category'])['amount']
+        np.testing.assert_allclose(stats['total_spent'], monthly.sum().groupby('category').mean())
+        np.testing.assert_allclose(stats['frequency'], monthly.size().groupby('category').mean())
+        np.testing.assert_allclose(stats['consistency'], monthly.std().groupby('category').mean())
+
+    def test_batch_labeling_matches_per_user_labeling(self):
+        expenses = generate_expenses(users=4, months=6, categories=6, expenses_per_day=2, seed=9)
+        expenses = pd.concat([expenses, pd.DataFrame({
+            'user_id': [5] * 3, 'date': pd.to_datetime(['2024-12-01'] * 3), 'amount': [1.0] * 3, 'category': ['Food'] * 3
+        })], ignore_index=True)
+
+        labeled = batch_rule_based_labeling(expenses)
+
+        # User 5 has too few expenses to be labeled
+        self.assertEqual(sorted(labeled), [1, 2, 3, 4])
+        for user_id, user_expenses in expenses[expenses['user_id'] < 5].groupby('user_id'):
+            single = []
+            Rule_Based_labeling(user_expenses.drop(columns='user_id'), single)
+            self.assertEqual(labeled[user_id], single[0]['predicted_importance'])
+
 
 class TestFlaskEndpointsRealWorld(unittest.TestCase):
     
@@ -609,6 +764,40 @@ class TestFlaskEndpointsRealWorld(unittest.TestCase):
             del os.environ['FLASK_PASSWORD']
 
 
+class TestBatchLabelingEndpoint(unittest.TestCase):
+    # Test the nightly multi-user /label_categories/batch endpoint
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        self.client = app_module.app.test_client()
+
+    def test_labels_every_user(self):
+        expenses = generate_expenses(users=2, months=3, categories=4, expenses_per_day=2, seed=2)
+        rows = [dict(row, user_id=int(user_id)) for row, user_id in zip(to_payload_rows(expenses), expenses['user_id'])]
+
+        response = self.client.post('/label_categories/batch', json={'password': 'test_password', 'past_expenses': rows})
+
+        self.assertEqual(response.status_code, 200)
+        users = response.get_json()['labaled_users']
+        self.assertEqual([user['user_id'] for user in users], [1, 2])
+        self.assertEqual(len(users[0]['predicted_importance']), 4)
+
+    def test_rows_without_user_id_are_rejected(self):
+        response = self.client.post('/label_categories/batch', json={
+            'password': 'test_password',
+            'past_expenses': [{'date': '2024-01-01', 'amount': 10, 'category': 'Food'}]
+        })
+        self.assertEqual(response.status_code, 400)
+
+        for past_expenses in ({'amount': [10], 'date': [0], 'category': [0], 'categories': ['Food']}, [{'amount': 10, 'user_id': 1}]):
+            response = self.client.post('/label_categories/batch', json={'password': 'test_password', 'past_expenses': past_expenses})
+            self.assertEqual(response.status_code, 400)
+
+    def tearDown(self):
+        del os.environ['FLASK_PASSWORD']
+
+
 class TestEdgeCasesAndValidation(unittest.TestCase):
     # Test realistic edge cases that users might encounter
     
@@ -679,6 +868,1759 @@ class TestEdgeCasesAndValidation(unittest.TestCase):
             self.assertIn('varies', insight_text)
 
 
+class TestRollupStore(unittest.TestCase):
+    # Test that stored monthly rollups can stand in for the full "all_expenses" history
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        self.db_dir = tempfile.TemporaryDirectory()
+        os.environ['ROLLUP_DB_PATH'] = os.path.join(self.db_dir.name, 'rollups.db')
+
+        from app import app
+        self.client = app.test_client()
+
+        # Six closed months with a steady upward trend in Food and a flat Transport spend
+        self.history = []
+        for i, month in enumerate(range(7, 13)):
+            self.history.append({'date': f'2024-{month:02d}-03', 'amount': 100 + i * 20, 'category': 'Food'})
+            self.history.append({'date': f'2024-{month:02d}-03', 'amount': 50 + i * 20, 'category': 'Food'})
+            self.history.append({'date': f'2024-{month:02d}-10', 'amount': 40, 'category': 'Transport'})
+
+        self.payload = {
+            'password': 'test_password',
+            'expenses': [
+                {'date': '2025-01-01', 'amount': 120, 'category': 'Food'},
+                {'date': '2025-01-02', 'amount': 45, 'category': 'Transport'},
+                {'date': '2025-01-03', 'amount': 90, 'category': 'Bills'},
+                {'date': '2025-01-04', 'amount': 85, 'category': 'Food'},
+                {'date': '2025-01-05', 'amount': 60, 'category': 'Transport'}
+            ],
+            'categories': [
+                {'name': 'Food', 'priority': 1},
+                {'name': 'Transport', 'priority': 2},
+                {'name': 'Bills', 'priority': 1}
+            ],
+            'monthly_budget': 2000,
+            'goal_amount': 200,
+            'total_spent': 400
+        }
+
+    def test_history_is_aggregated_per_day_and_category(self):
+        ingest_expenses(1, self.history)
+        history = load_history(1, 2025, 1)
+
+        # Two Food expenses on the same day collapse into one row, but the count is kept
+        self.assertEqual(len(history), 12)
+        self.assertEqual(history['count'].sum(), 18)
+        self.assertAlmostEqual(history['amount'].sum(), sum(e['amount'] for e in self.history))
+
+        # Months from the requested one onwards are excluded
+        self.assertEqual(len(load_history(1, 2024, 12)), 10)
+
+    def test_deleted_expenses_are_subtracted(self):
+        ingest_expenses(1, self.history)
+        ingest_expenses(1, [], deleted_expenses=[{'date': '2024-12-10', 'amount': 40, 'category': 'Transport'}])
+
+        history = load_history(1, 2025, 1)
+        self.assertEqual(history['count'].sum(), 17)
+        self.assertFalse(((history['category'] == 'Transport') & (history['date'] == '2024-12-10')).any())
+
+    def test_analysis_from_rollups_matches_full_history(self):
+        full_payload = dict(self.payload, all_expenses=self.history + self.payload['expenses'])
+        full_result = json.loads(self.client.post('/analysis', data=json.dumps(full_payload),
+                                                  content_type='application/json').data)
+
+        response = self.client.post('/rollups/ingest', data=json.dumps({
+            'password': 'test_password', 'user_id': 7, 'expenses': self.history, 'replace': True
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        rollup_payload = dict(self.payload, user_id=7)
+        rollup_result = json.loads(self.client.post('/analysis', data=json.dumps(rollup_payload),
+                                                    content_type='application/json').data)
+
+        self.assertGreater(len(full_result['predictions']), 0)
+        self.assertEqual(rollup_result['predictions'], full_result['predictions'])
+        self.assertEqual(rollup_result['category_predictions'], full_result['category_predictions'])
+        self.assertEqual(rollup_result['smart_insights'], full_result['smart_insights'])
+
+    def test_analysis_requires_history_source(self):
+        response = self.client.post('/analysis', data=json.dumps(self.payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_rows_are_rejected_before_anything_is_written(self):
+        malformed = [
+            {'expenses': [{'amount': 10, 'category': 'Food'}]},
+            {'expenses': [{'amount': 10, 'date': 'not a date', 'category': 'Food'}]},
+            {'expenses': [{'amount': 'ten', 'date': '2024-12-01', 'category': 'Food'}]},
+            {'expenses': self.history[:3] + ['row']},
+            {'deleted_expenses': {'amount': [10]}},
+        ]
+        for changes in malformed:
+            response = self.client.post('/rollups/ingest', json={'password': 'test_password', 'user_id': 8, **changes})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(load_history(8, 2025, 1)), 0)
+
+        response = self.client.post('/rollups/ingest', data=b'date,amount', content_type='text/csv')
+        self.assertEqual(response.status_code, 415)
+
+    def tearDown(self):
+        del os.environ['ROLLUP_DB_PATH']
+        if 'FLASK_PASSWORD' in os.environ:
+            del os.environ['FLASK_PASSWORD']
+        self.db_dir.cleanup()
+
+
+class TestForecastStore(unittest.TestCase):
+    # Test the persisted per-user trend statistics behind the rollup-based forecasts
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.db_dir.name, 'rollups.db')
+        os.environ['ROLLUP_DB_PATH'] = self.db_path
+        self.history = generate_rows(1500, months=10, categories=5, seed=41, end='2025-01-01').drop(columns='user_id')
+        ingest_expenses(1, to_payload_rows(self.history))
+
+    def test_folding_month_by_month_matches_a_refit(self):
+        months = sorted(self.history['date'].dt.to_period('M').unique())
+        for period in months[3:] + [months[-1] + 1]:
+            # The first call folds the first three months, later ones the month that just closed
+            self.assertEqual(fold_closed_months(1, period.year, period.month), 3 if period == months[3] else 1)
+            state = load_forecast_state(1)
+
+            context = AnalysisContext(load_history(1, period.year, period.month))
+            np.testing.assert_allclose(state.total_stats, sufficient_stats(context.monthly_sums().to_numpy()[None, :]), rtol=1e-12)
+            np.testing.assert_allclose(state.category_stats, sufficient_stats(context.category_monthly_sums().to_numpy()), rtol=1e-12)
+
+            expected, predictions = {}, {}
+            category_linear_regression(None, expected, accuracy_threshold=0, correlation_threshold=0, context=context)
+            state_category_linear_regression(state, predictions, accuracy_threshold=0, correlation_threshold=0)
+            self.assertEqual(list(predictions), list(expected))
+            for category in expected:
+                self.assertEqual([row['month'] for row in predictions[category]], [row['month'] for row in expected[category]])
+                np.testing.assert_allclose([row['accuracy'] for row in predictions[category]],
+                                           [row['accuracy'] for row in expected[category]], rtol=1e-9)
+
+        # Nothing new to fold, and an older month can't be answered from statistics that already include later months
+        self.assertEqual(fold_closed_months(1, 2025, 1), 0)
+        self.assertIsNone(update_forecast_state(1, 2024, 8))
+        self.assertEqual(verify_forecast_states(db_path=self.db_path)['mismatches'], [])
+
+    def test_changed_closed_month_resets_the_state(self):
+        from app import app
+        client = app.test_client()
+        current = generate_rows(40, months=1, categories=5, seed=42, end='2025-02-01').drop(columns='user_id')
+        payload = {
+            'password': 'test_password',
+            'expenses': to_payload_rows(current),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 0,
+            'total_spent': float(current['amount'].sum())
+        }
+
+        client.post('/analysis', json=dict(payload, user_id=1))
+        self.assertEqual((load_forecast_state(1).last_year, load_forecast_state(1).last_month), (2024, 12))
+
+        deleted_rows = self.history[self.history['date'].dt.month == 6].index[:20]
+        deleted = to_payload_rows(self.history.loc[deleted_rows])
+        response = client.post('/rollups/ingest', json={'password': 'test_password', 'user_id': 1, 'deleted_expenses': deleted})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(load_forecast_state(1))
+
+        # The state is folded again from the updated rollups and agrees with a refit of the full history
+        remaining = self.history.drop(deleted_rows)
+        from_state = client.post('/analysis', json=dict(payload, user_id=1)).get_json()
+        full = client.post('/analysis', json=dict(payload, all_expenses=to_payload_rows(remaining))).get_json()
+        self.assertIsNotNone(load_forecast_state(1))
+        self.assertEqual([row['predicted_spending'] for row in from_state['predictions']], [row['predicted_spending'] for row in full['predictions']])
+        self.assertEqual(list(from_state['category_predictions']), list(full['category_predictions']))
+
+    def test_large_amounts_keep_r2_accurate(self):
+        # Raw sums (Σy², Σxy) of amounts this large cancel out; the centred statistics must match a direct fit
+        for series in ([1e8 + 1, 1e8 + 2.5, 1e8 + 3, 1e8 + 5, 1e8 + 4.2], [5e9 + 1, 5e9 + 3, 5e9 + 2, 5e9 + 4]):
+            x = np.arange(1, len(series) + 1)
+            expected_r2 = np.corrcoef(x, np.array(series) - series[0])[0, 1] ** 2
+            for stats in (sufficient_stats([series]), ml_models.centred_stats([series])):
+                _, r2, correlation, _ = stats_linear_forecast(stats)
+                self.assertAlmostEqual(r2[0], expected_r2, places=9)
+                self.assertAlmostEqual(correlation[0], np.sqrt(expected_r2), places=9)
+
+        # Merging two halves gives the statistics of the whole series
+        rng = np.random.default_rng(3)
+        series = 1e7 + rng.normal(0, 50, 24) + np.arange(24) * 10
+        halves = merge_stats(sufficient_stats([series[:10]]), sufficient_stats([series[10:]]) + [[0, 10, 0, 0, 0, 0]])
+        np.testing.assert_allclose(halves, ml_models.centred_stats([series]), rtol=1e-9)
+
+        # The stored statistics of a high-spending user agree with a refit of their history
+        ingest_expenses(2, to_payload_rows(self.history.assign(amount=self.history['amount'] * 1e5)))
+        fold_closed_months(2, 2025, 1)
+        self.assertEqual(verify_forecast_states([2], db_path=self.db_path)['mismatches'], [])
+
+    def test_rebuild_command_repairs_corrupted_state(self):
+        fold_closed_months(1, 2025, 1)
+        conn = connect_forecasts(self.db_path)
+        with conn:
+            conn.execute("UPDATE forecast_stats SET mean_y = mean_y * 2 WHERE is_total = 1")
+        conn.close()
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(forecast_store_main(['--verify-only', '--db-path', self.db_path]), 1)
+        self.assertEqual(json.loads(output.getvalue())['mismatches'][0]['series'], 'total')
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(forecast_store_main(['--before', '2025-01', '--db-path', self.db_path]), 0)
+        self.assertEqual(json.loads(output.getvalue())['rebuilt_months'], {'1': 10})
+
+    def tearDown(self):
+        del os.environ['ROLLUP_DB_PATH']
+        if 'FLASK_PASSWORD' in os.environ:
+            del os.environ['FLASK_PASSWORD']
+        self.db_dir.cleanup()
+
+
+class TestHistoryStore(unittest.TestCase):
+    # Test the per-user columnar history read by /analysis and /label_categories with "history_source": "store"
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        self.store_dir = tempfile.TemporaryDirectory()
+        os.environ['HISTORY_STORE_PATH'] = self.store_dir.name
+        self.history = generate_rows(2000, months=9, categories=6, seed=51, end='2025-01-01').drop(columns='user_id')
+        self.history = self.history.sort_values('date', kind='stable').reset_index(drop=True)
+        self.current = generate_rows(50, months=1, categories=6, seed=52, end='2025-02-01').drop(columns='user_id')
+        self.payload = {
+            'password': 'test_password',
+            'expenses': to_payload_rows(self.current),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(self.current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 0,
+            'total_spent': float(self.current['amount'].sum())
+        }
+
+    def ingest_in_batches(self, client, user_id, rows, batch_size=500):
+        for start in range(0, len(rows), batch_size):
+            response = client.post('/history/ingest', json={'password': 'test_password', 'user_id': user_id, 'expenses': rows[start:start + batch_size]})
+            self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_stored_history_gives_the_same_analysis_as_the_payload(self):
+        from app import app
+        client = app.test_client()
+        rows = to_payload_rows(self.history)
+        stats = self.ingest_in_batches(client, 'store-user', rows)
+        batches = -(-len(rows) // 500)
+        self.assertEqual((stats['rows'], stats['segments']), (len(rows), batches))
+
+        # A deleted expense cancels one stored expense with the same date, amount and category
+        client.post('/history/ingest', json={'password': 'test_password', 'user_id': 'store-user', 'deleted_expenses': rows[:10]})
+
+        expected = client.post('/analysis', json=dict(self.payload, all_expenses=rows[10:])).get_json()
+        from_store = client.post('/analysis', json=dict(self.payload, user_id='store-user', history_source='store')).get_json()
+        self.assertEqual(from_store, expected)
+
+        # Compaction rewrites everything as one date-sorted segment without the deleted rows and changes no result
+        self.assertEqual(compact_history('store-user'), batches + 1)
+        self.assertEqual(history_stats('store-user')['segments'], 1)
+        self.assertEqual(history_stats('store-user')['rows'], len(rows) - 10)
+        client.post('/history/ingest', json={'password': 'test_password', 'user_id': 'store-user', 'expenses': []})
+        self.assertEqual(client.post('/analysis', json=dict(self.payload, user_id='store-user', history_source='store')).get_json(), expected)
+
+        expected_labels = client.post('/label_categories', json={'password': 'test_password', 'past_expenses': rows[10:]}).get_json()
+        stored_labels = client.post('/label_categories', json={'password': 'test_password', 'user_id': 'store-user', 'history_source': 'store'}).get_json()
+        self.assertEqual(stored_labels, expected_labels)
+
+    def test_only_the_requested_months_are_read(self):
+        append_expenses(2, to_payload_rows(self.history))
+        history, context = load_stored_history(2, 2025, 1, since_year=2024, since_month=10)
+        expected = self.history[(self.history['date'] >= '2024-10-01') & (self.history['date'] < '2025-01-01')]
+
+        self.assertEqual(len(history), len(expected))
+        self.assertEqual(context.month_span(), 3)
+        self.assertEqual(list(context.categories), sorted(expected['category'].unique()))
+        np.testing.assert_array_equal(context.category_codes, pd.factorize(expected['category'], sort=True)[0])
+        pd.testing.assert_series_equal(context.category_sums(), AnalysisContext(expected).category_sums())
+
+        from app import app
+        response = app.test_client().post('/analysis', json=dict(self.payload, user_id=2, history_source='store', history_months=0))
+        self.assertEqual(response.status_code, 400)
+
+    def test_appends_are_compacted_and_replace_starts_over(self):
+        import history_store
+        compact_after = history_store.COMPACT_AFTER_SEGMENTS
+        history_store.COMPACT_AFTER_SEGMENTS = 3
+        try:
+            rows = to_payload_rows(self.history)
+            for start in range(0, 1000, 200):
+                append_expenses(3, rows[start:start + 200])
+            self.assertLessEqual(history_stats(3)['segments'], 3)
+            self.assertEqual(history_stats(3)['rows'], 1000)
+
+            append_expenses(3, rows[:50], replace=True)
+            self.assertEqual((history_stats(3)['rows'], history_stats(3)['segments']), (50, 1))
+        finally:
+            history_store.COMPACT_AFTER_SEGMENTS = compact_after
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(history_store_main(['--path', self.store_dir.name]), 0)
+        self.assertEqual(list(json.loads(output.getvalue())['compacted_segments'].values()), [0])
+
+    def test_ingest_requires_password_and_expenses(self):
+        from app import app
+        client = app.test_client()
+        self.assertEqual(client.post('/history/ingest', json={'password': 'wrong', 'user_id': 1, 'expenses': []}).status_code, 401)
+        self.assertEqual(client.post('/history/ingest', json={'password': 'test_password', 'user_id': 1}).status_code, 400)
+
+    def tearDown(self):
+        del os.environ['HISTORY_STORE_PATH']
+        if 'FLASK_PASSWORD' in os.environ:
+            del os.environ['FLASK_PASSWORD']
+        self.store_dir.cleanup()
+
+
+class TestAnomalyScoring(unittest.TestCase):
+    # Test the streaming per-category statistics behind /anomaly/score
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        self.work_dir = tempfile.TemporaryDirectory()
+        os.environ['ROLLUP_DB_PATH'] = os.path.join(self.work_dir.name, 'rollups.db')
+        os.environ['HISTORY_STORE_PATH'] = os.path.join(self.work_dir.name, 'history')
+        self.history = generate_rows(2000, months=6, categories=4, seed=95, end='2025-01-01').drop(columns='user_id')
+
+    def test_running_statistics_match_batch_ones(self):
+        amounts = self.history['amount'].to_numpy()
+        stats = RunningStats()
+        for amount in amounts:
+            stats.add(float(amount), alpha=0.1)
+
+        self.assertAlmostEqual(stats.mean, amounts.mean(), places=6)
+        self.assertAlmostEqual(stats.std(), amounts.std(ddof=1), places=6)
+        self.assertAlmostEqual(stats.ewma, pd.Series(amounts).ewm(alpha=0.1, adjust=False).mean().iloc[-1], places=6)
+
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for amount in amounts:
+            sketch.add(float(amount))
+        for q in [0.5, 0.9, 0.99]:
+            self.assertLessEqual(abs(sketch.quantile(q) - np.quantile(amounts, q, method='lower')), 0.011 * np.quantile(amounts, q, method='lower'))
+        self.assertAlmostEqual(sketch.rank(np.median(amounts)), 0.5, delta=0.02)
+        self.assertEqual(QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict()))).quantile(0.9), sketch.quantile(0.9))
+
+    def test_score_endpoint_flags_unusual_expenses(self):
+        from app import app, anomaly_scorer
+        client = app.test_client()
+        client.post('/history/ingest', json={'password': 'test_password', 'user_id': 'anomaly-user', 'expenses': to_payload_rows(self.history)})
+        category = self.history['category'].iloc[0]
+        typical = float(self.history.loc[self.history['category'] == category, 'amount'].median())
+
+        def score(amount, **options):
+            return client.post('/anomaly/score', json={
+                'password': 'test_password', 'user_id': 'anomaly-user', 'expense': {'amount': amount, 'category': category}, **options
+            }).get_json()
+
+        # The first score builds the statistics from the stored history
+        normal = score(typical, record=False)
+        self.assertFalse(normal['unusual'])
+        self.assertEqual(normal['scope'], 'category')
+        count = normal['count']
+        self.assertTrue(score(typical * 20)['unusual'])
+        self.assertEqual(score(typical, record=False)['count'], count + 1)
+        self.assertEqual(client.post('/anomaly/score', json={
+            'password': 'test_password', 'user_id': 'anomaly-user', 'expense': {'amount': 5, 'category': 'New category'}
+        }).get_json()['scope'], 'all_categories')
+
+        # Recorded expenses reach the database on flush
+        anomaly_scorer.flush()
+        self.assertEqual(load_anomaly_state('anomaly-user').categories[category].n, count + 1)
+
+        rebuilt = client.post('/anomaly/rebuild', json={'password': 'test_password', 'user_id': 'anomaly-user'}).get_json()
+        self.assertEqual(rebuilt['categories'][category], count)
+        self.assertEqual(client.post('/anomaly/score', json={'password': 'wrong', 'user_id': 1, 'expense': {}}).status_code, 401)
+        self.assertEqual(client.post('/anomaly/score', json={'password': 'test_password', 'user_id': 1}).status_code, 400)
+
+        # Amounts that parse as floats but aren't finite don't reach the statistics
+        for amount in ('nan', 'inf', '-Infinity', '1e400'):
+            response = client.post('/anomaly/score', json={
+                'password': 'test_password', 'user_id': 'anomaly-user', 'expense': {'amount': amount, 'category': category}
+            })
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(score(typical, record=False)['count'], count)
+        anomaly_scorer.forget('anomaly-user')
+
+    def test_scorer_writes_back_evicted_and_flushed_users(self):
+        scorer = AnomalyScorer(max_users=1, flush_seconds=3600)
+        state = build_anomaly_state(self.history)
+        scorer.replace('a', state)
+        scorer.score('a', 10.0, 'Food')
+        self.assertEqual(load_anomaly_state('a').categories[''].n, len(self.history))
+
+        # Another user evicts "a": scoring doesn't write, and "a" is still scored from its unwritten state
+        scorer.score('b', 10.0, 'Food')
+        self.assertEqual(load_anomaly_state('a').categories[''].n, len(self.history))
+        self.assertEqual(scorer.state('a').categories[''].n, len(self.history) + 1)
+        scorer.score('b', 12.0, 'Food')
+        self.assertEqual(scorer.flush(), 2)
+        self.assertEqual(load_anomaly_state('a').categories[''].n, len(self.history) + 1)
+        self.assertEqual(load_anomaly_state('b').categories['Food'].n, 2)
+        scorer.close()
+
+    def test_background_thread_writes_back_recorded_expenses(self):
+        scorer = AnomalyScorer(flush_seconds=0.05)
+        scorer.score('c', 10.0, 'Food')
+        deadline = time.time() + 5
+        while load_anomaly_state('c') is None and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(load_anomaly_state('c').categories['Food'].n, 1)
+        scorer.close()
+        self.assertFalse(scorer.flusher.is_alive())
+
+    def tearDown(self):
+        del os.environ['ROLLUP_DB_PATH']
+        del os.environ['HISTORY_STORE_PATH']
+        if 'FLASK_PASSWORD' in os.environ:
+            del os.environ['FLASK_PASSWORD']
+        self.work_dir.cleanup()
+
+
+class TestResultCache(unittest.TestCase):
+    # Test the content-addressed result cache used by /analysis and /label_categories
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ResultCache(max_entries=2, ttl=60, clock=lambda: self.now)
+
+    def test_key_ignores_password_and_field_order(self):
+        first = payload_hash('analysis', {'password': 'a', 'expenses': [1, 2], 'goal_amount': 5}, ['expenses', 'goal_amount'])
+        second = payload_hash('analysis', {'goal_amount': 5, 'expenses': [1, 2], 'password': 'b'}, ['expenses', 'goal_amount'])
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, payload_hash('label_categories', {'expenses': [1, 2], 'goal_amount': 5}, ['expenses', 'goal_amount']))
+
+    def test_lru_eviction_and_ttl(self):
+        self.cache.set('a', {'value': 1})
+        self.cache.set('b', {'value': 2})
+        self.cache.get('a')
+        self.cache.set('c', {'value': 3})
+
+        # "b" was the least recently used entry
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), {'value': 1})
+
+        self.now += 61
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_invalidate_by_user_and_disk_tier(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = ResultCache(max_entries=10, ttl=60, disk_dir=disk_dir, clock=lambda: self.now)
+            cache.set('a', {'value': 1}, user='u1')
+            cache.set('b', {'value': 2}, user='u2')
+
+            # A fresh process only has the disk tier
+            restarted = ResultCache(max_entries=10, ttl=60, disk_dir=disk_dir, clock=lambda: self.now)
+            self.assertEqual(restarted.get('a', 'u1'), {'value': 1})
+            self.assertEqual(restarted.stats()['disk_hits'], 1)
+
+            restarted.invalidate('u1')
+            self.assertIsNone(restarted.get('a', 'u1'))
+            self.assertEqual(restarted.get('b', 'u2'), {'value': 2})
+
+    def test_disk_tier_only_deletes_its_own_files(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            # RESULT_CACHE_DIR may be shared with unrelated files
+            unrelated = [os.path.join(disk_dir, 'notes.txt'), os.path.join(disk_dir, 'other', 'data.json')]
+            os.makedirs(os.path.join(disk_dir, 'other'))
+            for path in unrelated:
+                with open(path, 'w') as f:
+                    f.write('keep')
+
+            cache = ResultCache(max_entries=0, ttl=60, disk_dir=disk_dir, clock=lambda: self.now)
+            first, second = user_fingerprint({'user_id': 1}), user_fingerprint({})
+            cache.set('a' * 64, {'value': 1}, user=first)
+            cache.set('b' * 64, {'value': 2}, user=second)
+            self.assertEqual(sorted(os.listdir(os.path.join(disk_dir, first))), ['a' * 64 + '.json'])
+
+            cache.invalidate()
+            self.assertIsNone(cache.get('a' * 64, first))
+            self.assertIsNone(cache.get('b' * 64, second))
+            self.assertEqual(sorted(os.listdir(disk_dir)), ['notes.txt', 'other'])
+            self.assertTrue(all(os.path.exists(path) for path in unrelated))
+
+    def test_expired_disk_entries_are_pruned(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = ResultCache(max_entries=0, ttl=60, disk_dir=disk_dir, clock=lambda: self.now)
+            user = user_fingerprint({'user_id': 1})
+            cache.set('a' * 64, {'value': 1}, user=user)
+            cache.set('b' * 64, {'value': 2}, user=user)
+
+            # Read after expiry: the file is deleted
+            self.now += 61
+            self.assertIsNone(cache.get('a' * 64, user))
+            self.assertFalse(os.path.exists(os.path.join(disk_dir, user, 'a' * 64 + '.json')))
+
+            # The next write prunes the other expired entries
+            cache.set('c' * 64, {'value': 3}, user=user)
+            self.assertEqual(os.listdir(os.path.join(disk_dir, user)), ['c' * 64 + '.json'])
+            self.assertEqual(cache.get('c' * 64, user), {'value': 3})
+
+    def test_concurrent_writers_of_one_key(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = ResultCache(max_entries=0, ttl=60, disk_dir=disk_dir)
+            errors = []
+
+            def write(value):
+                try:
+                    for _ in range(50):
+                        cache.set('d' * 64, {'value': value}, user='_')
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=write, args=(value,)) for value in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertIn(cache.get('d' * 64, '_')['value'], range(4))
+            self.assertEqual(os.listdir(os.path.join(disk_dir, '_')), ['d' * 64 + '.json'])
+
+    def test_repeated_analysis_is_served_from_cache(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        app_module.result_cache.invalidate()
+        client = app_module.app.test_client()
+
+        payload = {
+            'password': 'test_password',
+            'expenses': [{'date': f'2025-01-0{day}', 'amount': 10 * day, 'category': 'Food'} for day in range(1, 6)],
+            'all_expenses': [{'date': '2024-12-01', 'amount': 100, 'category': 'Food'}],
+            'categories': [{'name': 'Food', 'priority': 1}],
+            'monthly_budget': 1000,
+            'goal_amount': 100,
+            'total_spent': 150
+        }
+        first = client.post('/analysis', data=json.dumps(payload), content_type='application/json')
+        second = client.post('/analysis', data=json.dumps(payload), content_type='application/json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(app_module.result_cache.stats()['hits'], 1)
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestStartupReadiness(unittest.TestCase):
+    # Test the opt-in warm-up and the /ready probe
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+
+    def test_ready_only_after_warmup(self):
+        startup.warmup_state.update(status='pending', seconds=None, error=None)
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['ready'])
+
+        startup.run_warmup(self.app_module.app, 'test_password', on_done=self.app_module.forget_warmup_user)
+
+        # Nothing of the synthetic user is left behind
+        user = user_fingerprint({'user_id': startup.WARMUP_USER_ID})
+        self.assertIsNone(analysis_service.analysis_states.get(user))
+        self.assertEqual(analysis_service.spend_indexes.invalidate(user), 0)
+        self.assertEqual(self.app_module.result_cache.invalidate(user), 0)
+
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual(report['warmup']['status'], 'done')
+        self.assertIn('analysis_modules', report['phases_ms'])
+        self.assertIn('warmup', report['phases_ms'])
+
+    def test_failed_warmup_is_reported(self):
+        startup.run_warmup(self.app_module.app, 'wrong_password')
+
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('401', response.get_json()['warmup']['error'])
+
+    def tearDown(self):
+        startup.warmup_state.update(status='disabled', seconds=None, error=None)
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestColumnarPayloads(unittest.TestCase):
+    # Test that msgpack and Arrow columnar bodies give the same analysis as the JSON contract
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        app_module.result_cache.invalidate()
+        self.client = app_module.app.test_client()
+
+        categories = ['Food', 'Transport', 'Bills', 'Entertainment']
+        self.expenses = [
+            {'date': f'2025-01-{day % 20 + 1:02d}', 'amount': 15.5 + (day * 37) % 200, 'category': categories[day % 4]}
+            for day in range(25)
+        ]
+        self.history = [
+            {'date': f'2024-{month:02d}-{day + 1:02d}', 'amount': 40.0 + month * 10 + day, 'category': categories[day % 4]}
+            for month in range(7, 13) for day in range(8)
+        ]
+        self.fields = {
+            'password': 'test_password',
+            'categories': [{'name': name, 'priority': priority} for priority, name in enumerate(categories, start=1)],
+            'monthly_budget': 5000,
+            'goal_amount': 500,
+            'total_spent': sum(expense['amount'] for expense in self.expenses)
+        }
+        json_payload = dict(self.fields, expenses=self.expenses, all_expenses=self.history + self.expenses)
+        self.expected = self.client.post('/analysis', json=json_payload).get_json()
+
+    def test_expenses_frame_from_columns_matches_rows(self):
+        from_columns = expenses_frame(decode_columns(encode_columns(self.expenses)))
+        from_rows = expenses_frame(self.expenses)
+        pd.testing.assert_frame_equal(from_columns, from_rows[['amount', 'date', 'category']])
+
+    def test_context_takes_the_dictionary_codes(self):
+        # Unsorted dictionary with an unused and a repeated name
+        frame = decode_columns(dict(encode_columns(self.expenses[:8]), categories=['Transport', 'Food', 'Unused', 'Bills', 'Entertainment']))
+        frame['category'] = np.array([0, 1, 3, 4, 0, 1, 3, 4], dtype='<i4')
+        frame['categories'] = ['Transport', 'Food', 'Unused', 'Bills', 'Food']
+        rows = np.arange(8) != 2
+        expenses = expenses_frame(frame)
+
+        for mask in (None, rows):
+            selected = expenses if mask is None else expenses[mask]
+            context = expenses_context(selected, frame, mask)
+            codes, categories = pd.factorize(selected['category'], sort=True)
+            np.testing.assert_array_equal(context.category_codes, codes)
+            pd.testing.assert_index_equal(context.categories, categories)
+
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack not installed')
+    def test_msgpack_analysis_matches_json(self):
+        import msgpack
+        body = msgpack.packb(dict(
+            self.fields,
+            expenses=encode_columns(self.expenses),
+            all_expenses=encode_columns(self.history + self.expenses)
+        ))
+        response = self.client.post('/analysis', data=body, content_type='application/msgpack')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), self.expected)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow not installed')
+    def test_arrow_analysis_matches_json(self):
+        import pyarrow as pa
+        rows = self.expenses + self.history + self.expenses
+        table = pa.table({
+            'amount': pa.array([row['amount'] for row in rows], pa.float64()),
+            'date': pa.array([datetime.strptime(row['date'], '%Y-%m-%d').date() for row in rows], pa.date32()),
+            'category': pa.array([row['category'] for row in rows]).dictionary_encode(),
+        })
+        metadata = dict(self.fields, frames={
+            'expenses': [0, len(self.expenses)],
+            'all_expenses': [len(self.expenses), len(rows) - len(self.expenses)]
+        })
+        table = table.replace_schema_metadata({'payload': json.dumps(metadata)})
+
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+        response = self.client.post('/analysis', data=sink.getvalue().to_pybytes(),
+                                    content_type='application/vnd.apache.arrow.stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), self.expected)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow not installed')
+    def test_malformed_arrow_tables_are_rejected(self):
+        import pyarrow as pa
+        amount = pa.array([10.0, 20.0])
+        date = pa.array([datetime(2025, 1, 1).date(), datetime(2025, 1, 2).date()], pa.date32())
+        category = pa.array(['Food', 'Bills']).dictionary_encode()
+        tables = [
+            pa.table({'amount': amount, 'date': date}),
+            pa.table({'amount': amount, 'date': date, 'category': pa.array(['Food', 'Bills'])}),
+            pa.table({'amount': pa.array(['10', '20']), 'date': date, 'category': category}),
+            pa.table({'amount': pa.array([10.0, None]), 'date': date, 'category': category}),
+            pa.table({'amount': amount, 'date': date, 'category': category}),
+        ]
+        frames = [{'expenses': [0, 2]}] * 4 + [{'expenses': [1, 2]}]
+        for table, frame in zip(tables, frames):
+            table = table.replace_schema_metadata({'payload': json.dumps(dict(self.fields, frames=frame))})
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            response = self.client.post('/analysis', data=sink.getvalue().to_pybytes(), content_type='application/vnd.apache.arrow.stream')
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/analysis', data=b'not arrow', content_type='application/vnd.apache.arrow.stream')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_content_type_is_rejected(self):
+        response = self.client.post('/analysis', data=b'amount,date', content_type='text/csv')
+        self.assertEqual(response.status_code, 415)
+
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack not installed')
+    def test_small_endpoints_read_msgpack_bodies(self):
+        import msgpack
+        body = msgpack.packb({'password': 'test_password'})
+        response = self.client.post('/cache/stats', data=body, content_type='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', response.get_json())
+        response = self.client.post('/cache/invalidate', data=body, content_type='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+
+    def json_frame(self, rows):
+        frame = encode_columns(rows)
+        return dict(frame, **{name: np.frombuffer(frame[name], dtype=COLUMN_DTYPES[name]).tolist() for name in COLUMN_DTYPES})
+
+    def test_json_columnar_analysis_matches_json(self):
+        response = self.client.post('/analysis', json=dict(
+            self.fields,
+            expenses=self.json_frame(self.expenses),
+            all_expenses=self.json_frame(self.history + self.expenses)
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), self.expected)
+
+    def test_malformed_frames_are_rejected(self):
+        frame = self.json_frame(self.expenses)
+        malformed = [
+            dict(frame, category=[-1] + frame['category'][1:]),
+            dict(frame, category=[99] + frame['category'][1:]),
+            dict(frame, dtypes={'amount': 'O'}),
+            dict(frame, dtypes={'category': '<f8'}),
+            dict(frame, dtypes={'date': 'not a dtype'}),
+            dict(frame, amount=frame['amount'][1:]),
+            dict(frame, amount=[[1.0]] * len(self.expenses)),
+            {name: value for name, value in frame.items() if name != 'categories'},
+        ]
+        for bad in malformed:
+            with self.assertRaises(ValueError):
+                decode_columns(bad)
+            response = self.client.post('/analysis', json=dict(self.fields, expenses=bad, all_expenses=self.history))
+            self.assertEqual(response.status_code, 400)
+
+        # Binary columns are checked the same way
+        binary = dict(encode_columns(self.expenses), category=np.full(len(self.expenses), 99, dtype='<i4').tobytes())
+        with self.assertRaises(ValueError):
+            decode_columns(binary)
+
+    def tearDown(self):
+        del os.environ['FLASK_PASSWORD']
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    # Minimal OpenAI-style chat completion server; fails the first "failures" requests with 503
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests_seen += 1
+
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self._send(503, 'application/json', b'{"error": "overloaded"}')
+        elif payload.get('stream') and self.server.stream_body is not None:
+            self._send(200, 'text/event-stream', self.server.stream_body)
+        elif payload.get('stream'):
+            events = b''.join(
+                b'data: ' + json.dumps({'choices': [{'delta': {'content': token}}]}).encode() + b'\n\n'
+                for token in ['Save ', 'more.']
+            ) + b'data: [DONE]\n\n'
+            self._send(200, 'text/event-stream', events)
+        else:
+            body = json.dumps({'choices': [{'message': {'content': 'Save more.'}}], 'model': payload['model']})
+            self._send(200, 'application/json', body.encode())
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestChatLLMClient(unittest.TestCase):
+    # Test the pooled /chat client against a local stub LLM server
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubLLMHandler)
+        self.server.failures = 0
+        self.server.requests_seen = 0
+        self.server.stream_body = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        import app as app_module
+        self.app_module = app_module
+        self.original_client = app_module.llm_client
+        app_module.llm_client = LLMClient(url=f'http://127.0.0.1:{self.server.server_port}/v1/chat/completions',
+                                          retry_backoff=0, max_concurrency=2)
+        self.client = app_module.app.test_client()
+        self.payload = {'password': 'test_password', 'message': 'How do I save?', 'api_key': 'key'}
+
+    def test_completion_retries_on_503(self):
+        self.server.failures = 1
+        response = self.client.post('/chat', json=self.payload)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['choices'][0]['message']['content'], 'Save more.')
+        self.assertEqual(self.server.requests_seen, 2)
+
+    def test_streaming_relays_server_sent_events(self):
+        response = self.client.post('/chat', json=dict(self.payload, stream=True))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [line for line in response.get_data(as_text=True).split('\n\n') if line]
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[-1], 'data: [DONE]')
+
+        # The upstream slot is given back once the stream is consumed
+        self.assertEqual(self.app_module.llm_client.slots._value, 2)
+
+    def test_multi_line_events_are_relayed_unchanged(self):
+        self.server.stream_body = (b': keep-alive\n\n'
+                                   b'event: delta\nid: 1\ndata: {"content": "Save"}\ndata: {"content": " more."}\n\n'
+                                   b'data: [DONE]\n\n')
+        response = self.client.post('/chat', json=dict(self.payload, stream=True))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), self.server.stream_body)
+
+    def test_unread_stream_gives_its_slot_back_on_close(self):
+        # A client that goes away before the first event: the server closes the body without iterating it
+        slots = self.app_module.llm_client.slots
+        environ = EnvironBuilder('/chat', method='POST', json=dict(self.payload, stream=True)).get_environ()
+        body = self.app_module.app.wsgi_app(environ, lambda status, headers, exc_info=None: None)
+        self.assertEqual(slots._value, 1)
+        body.close()
+        self.assertEqual(slots._value, 2)
+
+        # Releasing is idempotent: a generator that was never started and is closed later doesn't release twice
+        _, events, release = self.app_module.llm_client.stream({}, {})
+        release()
+        release()
+        events.close()
+        self.assertEqual(slots._value, 2)
+
+    def test_upstream_errors_are_returned(self):
+        self.server.failures = 10
+        response = self.client.post('/chat', json=self.payload)
+        self.assertEqual(response.status_code, 503)
+
+    def test_busy_client_rejects_new_requests(self):
+        self.app_module.llm_client = LLMClient(url='http://127.0.0.1:9/', max_concurrency=1, queue_timeout=0)
+        self.app_module.llm_client.slots.acquire()
+
+        response = self.client.post('/chat', json=self.payload)
+        self.assertEqual(response.status_code, 503)
+
+    def tearDown(self):
+        self.app_module.llm_client = self.original_client
+        self.server.shutdown()
+        self.server.server_close()
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestStageMetrics(unittest.TestCase):
+    # Test per-stage latency instrumentation and the Prometheus /metrics endpoint
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', 'stage', (0.1, 1.0))
+        for value in [0.05, 0.5, 0.7, 3.0]:
+            histogram.observe('fit', value)
+
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="fit",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="fit",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="fit",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{stage="fit"} 4', lines)
+
+    def test_slow_requests_are_logged_with_stage_breakdown(self):
+        trace = RequestTrace('analysis')
+        with trace.stage('category_linear_regression', rows=1200, months=24):
+            pass
+
+        with self.assertLogs('test_metrics', level='WARNING') as logs:
+            trace.finish(logging.getLogger('test_metrics'), slow_seconds=0)
+        self.assertIn('category_linear_regression=', logs.output[0])
+        self.assertIn('rows=1200', logs.output[0])
+
+    def test_analysis_stages_are_exported(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        app_module.result_cache.invalidate()
+        client = app_module.app.test_client()
+
+        payload = {
+            'password': 'test_password',
+            'expenses': [{'date': f'2025-01-{day:02d}', 'amount': 10 * day, 'category': ['Food', 'Bills', 'Fun'][day % 3]}
+                         for day in range(1, 13)],
+            'all_expenses': [{'date': f'2024-{month:02d}-05', 'amount': 100 + month, 'category': 'Food'} for month in range(1, 13)],
+            'categories': [{'name': 'Food', 'priority': 1}, {'name': 'Bills', 'priority': 1}, {'name': 'Fun', 'priority': 2}],
+            'monthly_budget': 2000,
+            'goal_amount': 100,
+            'total_spent': 780
+        }
+        self.assertEqual(client.post('/analysis', json=payload).status_code, 200)
+
+        body = client.get('/metrics').get_data(as_text=True)
+        for stage in ['linear_regression', 'category_linear_regression', 'kmeans_clustering', 'get_association_rules',
+                      'analyze_spending_deviations', 'day_of_week_analysis']:
+            self.assertIn(f'analysis_stage_seconds_count{{stage="{stage}"}}', body)
+        self.assertIn('analysis_stage_input_months_count{stage="linear_regression"}', body)
+        self.assertIn('analysis_request_seconds_count{endpoint="analysis"}', body)
+        self.assertIn('result_cache_misses_total', body)
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    # Test the seeded synthetic generator and a tiny benchmark run
+
+    def test_generator_is_seeded_and_sized(self):
+        first = generate_rows(5000, months=12, categories=6, seed=7)
+        second = generate_rows(5000, months=12, categories=6, seed=7)
+
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(list(first.columns), ['user_id', 'date', 'amount', 'category'])
+        self.assertAlmostEqual(len(first), 5000, delta=500)
+        self.assertEqual(first['category'].nunique(), 6)
+        self.assertTrue((first['amount'] > 0).all())
+        self.assertLess(first['date'].max(), pd.Timestamp('2025-01-01'))
+
+        # Categories follow a Zipf-like popularity, so the first one is the most common
+        self.assertEqual(first['category'].value_counts().index[0], 'Food')
+
+    def test_multi_user_generation(self):
+        expenses = generate_expenses(users=3, months=2, expenses_per_day=2, seed=1)
+        self.assertEqual(sorted(expenses['user_id'].unique()), [1, 2, 3])
+
+    def test_benchmark_run_reports_every_target(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        # Per-user state left by earlier requests doesn't warm the timed route
+        analysis_service.spend_indexes.get('earlier-user')
+        report = benchmark.run([200, 400], repeat=1, months=6, categories=5, log=lambda line: None)
+
+        targets = {result['target'] for result in report['results']}
+        self.assertEqual(targets, {name for name, _, _ in benchmark.BENCHMARKS} | {'app./analysis'})
+        self.assertIn('ml_models.category_linear_regression', report['scaling'])
+
+        comparison = benchmark.compare_runs(report['results'], report)
+        self.assertTrue(all(entry['ratio'] == 1.0 for entry in comparison))
+        self.assertEqual(analysis_service.spend_indexes.invalidate('earlier-user'), 0)
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestSpendIndex(unittest.TestCase):
+    # Test the cached historical cumulative-spend curve behind the deviation insight
+
+    def setUp(self):
+        self.history = pd.DataFrame({
+            'date': pd.to_datetime(['2024-11-01', '2024-11-05', '2024-12-03', '2024-12-05']),
+            'amount': [10.0, 20.0, 40.0, 50.0],
+            'category': ['Food', 'Food', 'Food', 'Transport']
+        })
+
+    def test_curve_averages_cumulative_spend_over_months(self):
+        index = CumulativeSpendIndex().update(self.history)
+
+        # Food: 10 on day 1, 10 + 20 by day 5 in November, 40 by day 3 in December
+        self.assertEqual(index.reference(5).to_dict(), {'Food': 30.0, 'Transport': 50.0})
+        self.assertEqual(index.reference(3).to_dict(), {'Food': 40.0})
+        # Days on which no month had any expense have no reference
+        self.assertTrue(index.reference(4).empty)
+
+    def test_only_new_or_changed_months_are_rebuilt(self):
+        index = CumulativeSpendIndex().update(self.history)
+        before = dict(index.contributions)
+
+        closed_month = pd.DataFrame({'date': pd.to_datetime(['2025-01-05']), 'amount': [90.0], 'category': ['Food']})
+        index.update(pd.concat([self.history, closed_month], ignore_index=True))
+
+        self.assertEqual(len(index.contributions), 3)
+        for month_key, contribution in before.items():
+            self.assertIs(index.contributions[month_key], contribution)
+        self.assertEqual(index.reference(5)['Food'], 60.0)
+
+        # Dropping a month removes it from the curve again
+        index.update(self.history[self.history['date'] >= '2024-12-01'])
+        self.assertEqual(index.reference(5).to_dict(), {'Food': 40.0, 'Transport': 50.0})
+
+    def test_deviation_insight_is_unchanged_with_a_warm_index(self):
+        history = generate_rows(3000, months=6, categories=5, seed=3, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(600, months=1, categories=5, seed=4, end='2025-02-01').drop(columns='user_id')
+        current = current[current['date'].dt.day <= 17]
+
+        cold_insights, warm_insights = [], []
+        index = SpendIndexCache(max_entries=1).get('user')
+        analyze_spending_deviations(current.copy(), history.copy(), cold_insights)
+        analyze_spending_deviations(current.copy(), history.copy(), [], index)
+        analyze_spending_deviations(current.copy(), history.copy(), warm_insights, index)
+
+        self.assertEqual(cold_insights, warm_insights)
+        self.assertEqual(len(cold_insights), 1)
+
+    def test_changed_amounts_rebuild_their_month(self):
+        index = CumulativeSpendIndex().update(self.history)
+        changed = self.history.assign(amount=[10.0, 20.0, 40.0, 70.0])
+        self.assertEqual(index.update(changed).reference(5).to_dict(), {'Food': 30.0, 'Transport': 70.0})
+
+    def test_only_real_users_get_an_index(self):
+        history = generate_rows(300, months=3, categories=4, seed=5, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(60, months=1, categories=4, seed=6, end='2025-02-01').drop(columns='user_id')
+        payload = {
+            'expenses': to_payload_rows(current),
+            'all_expenses': to_payload_rows(history),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 1000,
+            'total_spent': float(current['amount'].sum())
+        }
+        analysis_service.spend_indexes.invalidate()
+        analysis_service.analyze(payload)
+        self.assertEqual(analysis_service.spend_indexes.invalidate(), 0)
+
+        analysis_service.analyze(dict(payload, user_id='indexed-user'))
+        self.assertEqual(analysis_service.spend_indexes.invalidate(analysis_service.user_fingerprint({'user_id': 'indexed-user'})), 1)
+        analysis_service.analysis_states.invalidate()
+
+
+class TestAnalysisContext(unittest.TestCase):
+    # Test the per-request context of date parts, category codes and memoized aggregates
+
+    def setUp(self):
+        self.expenses = generate_rows(1500, months=3, categories=5, seed=11).drop(columns='user_id')
+        self.context = AnalysisContext(self.expenses)
+
+    def test_date_parts_match_pandas_accessors(self):
+        dates = self.expenses['date'].dt
+        np.testing.assert_array_equal(self.context.year, dates.year)
+        np.testing.assert_array_equal(self.context.month, dates.month)
+        np.testing.assert_array_equal(self.context.day, dates.day)
+        np.testing.assert_array_equal(np.array(WEEKDAY_NAMES)[self.context.weekday], dates.day_name())
+        self.assertEqual(self.context.last_month(), (2024, 12))
+        self.assertEqual(self.context.month_span(), 3)
+
+    def test_category_aggregates_are_memoized(self):
+        grouped = self.expenses.groupby('category')['amount']
+        pd.testing.assert_series_equal(self.context.category_sums(), grouped.sum())
+        pd.testing.assert_series_equal(self.context.category_counts(), grouped.size().rename('amount'))
+        pd.testing.assert_series_equal(self.context.category_stds(), grouped.std())
+        self.assertIs(self.context.category_sums(), self.context.category_sums())
+
+    def test_shared_context_gives_the_same_insights(self):
+        shared, separate = [], []
+        for insights, context in [(shared, self.context), (separate, None)]:
+            analyze_spending_variability(self.expenses, insights, context)
+            day_of_week_analysis(self.expenses, insights, context)
+            kmeans_clustering(self.expenses, insights, [], context=context)
+
+        self.assertEqual(shared, separate)
+        self.assertEqual(len(shared), 3)
+        # Functions no longer add helper columns to the caller's frame
+        self.assertEqual(list(self.expenses.columns), ['date', 'amount', 'category'])
+
+
+class TestStageScheduler(unittest.TestCase):
+    # Test the DAG scheduler behind the /analysis pipeline
+
+    def test_stages_run_after_their_inputs(self):
+        stages = [
+            Stage('total', lambda left, right: left + right, ['left', 'right'], ['total']),
+            Stage('split', lambda value: (value - 1, 1), ['value'], ['left', 'right']),
+            Stage('double', lambda total: total * 2, ['total'], ['doubled']),
+        ]
+        for workers in [1, 4]:
+            values = run_stages(stages, {'value': 5}, max_workers=workers)
+            self.assertEqual((values['left'], values['right'], values['total'], values['doubled']), (4, 1, 5, 10))
+
+    def test_independent_stages_run_concurrently(self):
+        # Both stages wait for each other, so this only finishes if they run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [Stage(name, lambda: barrier.wait() is not None, [], [name]) for name in ['first', 'second']]
+
+        values = run_stages(stages, {}, max_workers=2)
+        self.assertTrue(values['first'] and values['second'])
+
+    def test_invalid_graphs_and_failures(self):
+        with self.assertRaises(ValueError):
+            run_stages([Stage('a', lambda missing: missing, ['missing'], ['a'])], {})
+        with self.assertRaises(ValueError):
+            run_stages([Stage('a', lambda b: b, ['b'], ['a']), Stage('b', lambda a: a, ['a'], ['b'])], {})
+
+        # A cycle behind a runnable stage is rejected before that stage runs
+        ran = []
+        cyclic = [
+            Stage('start', lambda: ran.append('start') or 1, [], ['x']),
+            Stage('a', lambda x, c: c, ['x', 'c'], ['a']),
+            Stage('c', lambda a: a, ['a'], ['c']),
+        ]
+        for max_workers in (1, 2):
+            with self.assertRaisesRegex(ValueError, 'cycle: a, c'):
+                run_stages(cyclic, {}, max_workers=max_workers)
+        self.assertEqual(ran, [])
+
+        def fail():
+            raise RuntimeError("stage failed")
+        with self.assertRaises(RuntimeError):
+            run_stages([Stage('fail', fail, [], ['x']), Stage('ok', lambda: 1, [], ['y'])], {}, max_workers=2)
+
+    def test_parallel_analysis_matches_sequential(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        client = app_module.app.test_client()
+        history = generate_rows(2000, months=8, categories=6, seed=21, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(200, months=1, categories=6, seed=22, end='2025-02-01').drop(columns='user_id')
+        payload = {
+            'password': 'test_password',
+            'expenses': to_payload_rows(current),
+            'all_expenses': to_payload_rows(history),
+            'categories': [{'name': name, 'priority': i % 3 + 1} for i, name in enumerate(sorted(current['category'].unique()))],
+            'monthly_budget': 50000,
+            'goal_amount': 5000,
+            'total_spent': float(current['amount'].sum())
+        }
+
+        results = []
+        original_workers = analysis_service.ANALYSIS_WORKERS
+        try:
+            for workers in [1, 4]:
+                analysis_service.ANALYSIS_WORKERS = workers
+                app_module.result_cache.invalidate()
+                results.append(client.post('/analysis', json=payload).get_json())
+        finally:
+            analysis_service.ANALYSIS_WORKERS = original_workers
+
+        self.assertEqual(results[0], results[1])
+        self.assertGreater(len(results[0]['smart_insights']), 0)
+        del os.environ['FLASK_PASSWORD']
+
+class TestLatencyBudget(unittest.TestCase):
+    # Test that expensive stages are reduced, skipped or abandoned instead of overrunning a request's deadline
+
+    def test_slow_stages_are_reduced_or_skipped(self):
+        costs = StageCosts()
+        costs.observe('rules', 100, 10.0)
+        costs.observe('rules_reduced', 100, 0.001)
+        costs.observe('clusters', 100, 10.0)
+        stages = [
+            Stage('rules', lambda: 'full', [], ['rules'], sizes={'rows': 100}, optional=True, reduced=lambda: 'reduced'),
+            Stage('clusters', lambda: 'full', [], ['clusters'], sizes={'rows': 100}, optional=True),
+            Stage('limits', lambda: 'full', [], ['limits'], sizes={'rows': 100}),
+        ]
+
+        for workers in [1, 4]:
+            degraded = []
+            values = run_stages(stages, {'rules': None, 'clusters': None}, max_workers=workers,
+                                deadline=time.perf_counter() + 1, costs=costs, degraded_stages=degraded)
+            self.assertEqual((values['rules'], values['clusters'], values['limits']), ('reduced', None, 'full'))
+            self.assertEqual(sorted(degraded, key=lambda entry: entry['stage']),
+                             [{'stage': 'clusters', 'mode': 'skipped'}, {'stage': 'rules', 'mode': 'reduced'}])
+
+        # Without a deadline every stage runs in full
+        values = run_stages(stages, {'rules': None, 'clusters': None}, max_workers=1, costs=costs)
+        self.assertEqual((values['rules'], values['clusters']), ('full', 'full'))
+
+    def test_optional_stage_running_past_the_deadline_is_abandoned(self):
+        release = threading.Event()
+        stages = [
+            Stage('stuck', lambda: release.wait(5), [], ['stuck'], optional=True),
+            Stage('required', lambda: 'done', [], ['required']),
+        ]
+        degraded = []
+        try:
+            start = time.perf_counter()
+            values = run_stages(stages, {'stuck': []}, max_workers=2, deadline=start + 0.2, degraded_stages=degraded)
+            elapsed = time.perf_counter() - start
+        finally:
+            release.set()
+
+        self.assertLess(elapsed, 2)
+        self.assertEqual((values['stuck'], values['required']), ([], 'done'))
+        self.assertEqual(degraded, [{'stage': 'stuck', 'mode': 'timed_out'}])
+
+    def test_analysis_keeps_advice_when_out_of_time(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        client = app_module.app.test_client()
+        history = generate_rows(500, months=6, categories=5, seed=31, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(60, months=1, categories=5, seed=32, end='2025-02-01').drop(columns='user_id')
+        payload = {
+            'password': 'test_password',
+            'expenses': to_payload_rows(current),
+            'all_expenses': to_payload_rows(history),
+            'categories': [{'name': name, 'priority': i % 3 + 1} for i, name in enumerate(sorted(current['category'].unique()))],
+            'monthly_budget': 50000,
+            'goal_amount': 0,
+            'total_spent': float(current['amount'].sum())
+        }
+        app_module.result_cache.invalidate()
+
+        degraded = client.post('/analysis', json={**payload, 'deadline_ms': 0.001}).get_json()
+        self.assertGreater(len(degraded['advice']), 0)
+        self.assertGreater(len(degraded['category_limits']), 0)
+        self.assertIn({'stage': 'get_association_rules', 'mode': 'skipped'}, degraded['degraded_stages'])
+        self.assertEqual(degraded['association_rules'], [])
+
+        # The degraded result was not cached, so a request with time to spare gets the full analysis
+        full = client.post('/analysis', json=payload).get_json()
+        self.assertEqual(full['degraded_stages'], [])
+        self.assertGreater(len(full['association_rules']) + len(full['smart_insights']), 0)
+
+        response = client.post('/analysis', json={**payload, 'deadline_ms': 'soon'})
+        self.assertEqual(response.status_code, 400)
+        del os.environ['FLASK_PASSWORD']
+
+
+class TestAnalysisDelta(unittest.TestCase):
+    # Test /analysis/delta against a full re-analysis of the same month
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        from app import app, result_cache
+        self.client = app.test_client()
+        self.result_cache = result_cache
+        history = generate_rows(1500, months=6, categories=5, seed=91, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(60, months=1, categories=5, seed=92, end='2025-02-01').drop(columns='user_id')
+        self.history = to_payload_rows(history)
+        self.expenses = to_payload_rows(current[current['date'].dt.day <= 20])
+        self.categories = [{'name': name, 'priority': code % 3 + 1} for code, name in enumerate(sorted(current['category'].unique()))]
+
+    def full(self, expenses, user_id='delta-user'):
+        return self.client.post('/analysis', json={
+            'password': 'test_password',
+            'user_id': user_id,
+            'expenses': expenses,
+            'all_expenses': self.history + expenses,
+            'categories': self.categories,
+            'monthly_budget': 50000,
+            'goal_amount': 1000,
+            'total_spent': round(sum(expense['amount'] for expense in expenses), 2)
+        }).get_json()
+
+    def delta(self, **changes):
+        return self.client.post('/analysis/delta', json={'password': 'test_password', 'user_id': 'delta-user', **changes})
+
+    def test_delta_matches_a_full_analysis(self):
+        self.full(self.expenses)
+        added = {'amount': 321.5, 'date': self.expenses[2]['date'], 'category': self.expenses[2]['category']}
+        response = self.delta(expense=added)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), self.full(self.expenses + [added], user_id='other-user'))
+
+        response = self.delta(deleted_expense=self.expenses[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), self.full(self.expenses[1:] + [added], user_id='other-user'))
+
+    def test_unchanged_baskets_reuse_the_association_rules(self):
+        self.full(self.expenses)
+        state = analysis_service.analysis_states.get(analysis_service.user_fingerprint({'user_id': 'delta-user'}))
+        rules = state.association_rules
+
+        # Same day and category as an existing expense: no basket changes
+        self.delta(expense={'amount': 5, 'date': self.expenses[1]['date'], 'category': self.expenses[1]['category']})
+        self.assertIs(state.association_rules, rules)
+
+        new_day = {'amount': 5, 'date': self.expenses[1]['date'][:8] + '25', 'category': self.expenses[1]['category']}
+        self.assertEqual(self.delta(expense=new_day).status_code, 200)
+        self.assertIsNot(state.association_rules, rules)
+
+    def test_deltas_without_a_usable_state_need_a_full_analysis(self):
+        expense = dict(self.expenses[0])
+        self.assertEqual(self.delta(expense=expense).status_code, 409)
+
+        self.full(self.expenses)
+        self.assertEqual(self.delta(expense=dict(expense, date='2025-03-01')).status_code, 409)
+        self.assertEqual(self.delta(deleted_expense=dict(expense, amount=-1)).status_code, 409)
+        self.assertEqual(self.delta().status_code, 400)
+
+        # New history drops the state
+        self.client.post('/rollups/ingest', json={'password': 'test_password', 'user_id': 'delta-user', 'expenses': []})
+        self.assertEqual(self.delta(expense=expense).status_code, 409)
+
+    def test_cached_full_result_after_a_delta_drops_the_state(self):
+        first = self.full(self.expenses)
+        self.delta(expense={'amount': 77, 'date': self.expenses[0]['date'], 'category': self.expenses[0]['category']})
+        # The same full payload again: served from the cache, and the state of the delta is dropped
+        self.assertEqual(self.full(self.expenses), first)
+        self.assertEqual(self.delta(deleted_expense=self.expenses[0]).status_code, 409)
+
+        # The next full analysis builds the state again
+        self.full(self.expenses[1:])
+        self.assertEqual(self.delta(deleted_expense=self.expenses[1]).get_json(), self.full(self.expenses[2:], user_id='other-user'))
+
+    def test_cache_invalidation_drops_the_delta_state(self):
+        for body in ({'user_id': 'delta-user'}, {}):
+            self.full(self.expenses)
+            self.client.post('/cache/invalidate', json={'password': 'test_password', **body})
+            self.assertEqual(self.delta(deleted_expense=self.expenses[0]).status_code, 409)
+
+    def test_cached_full_result_keeps_its_own_state(self):
+        first = self.full(self.expenses)
+        self.assertEqual(self.full(self.expenses), first)
+        self.assertEqual(self.delta(deleted_expense=self.expenses[0]).get_json(), self.full(self.expenses[1:], user_id='other-user'))
+
+    def tearDown(self):
+        self.result_cache.invalidate()
+        analysis_service.analysis_states.invalidate()
+        if 'FLASK_PASSWORD' in os.environ:
+            del os.environ['FLASK_PASSWORD']
+
+
+class TestAnalysisJobs(unittest.TestCase):
+    # Test the asynchronous analysis job queue and its endpoints
+
+    def wait_for(self, jobs, job_id, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = jobs.status(job_id)
+            if job['status'] not in ('queued', 'running', 'cancelling'):
+                return job
+            time.sleep(0.05)
+        self.fail(f"job {job_id} did not finish")
+
+    def test_jobs_run_in_worker_processes(self):
+        finished = []
+        jobs = AnalysisJobs(square_after, max_workers=2, on_done=lambda result, context: finished.append((result, context)))
+        try:
+            job_ids = [jobs.submit({'value': value}, context=value) for value in [3, -1]]
+            done, failed = [self.wait_for(jobs, job_id) for job_id in job_ids]
+
+            self.assertEqual((done['status'], done['result']), ('done', 9))
+            self.assertGreaterEqual(done['queued_seconds'], 0)
+            self.assertGreaterEqual(done['run_seconds'], 0)
+            self.assertEqual(failed['status'], 'failed')
+            self.assertIn('negative value', failed['error'])
+            self.assertEqual(finished, [(9, 3)])
+            self.assertEqual(jobs.stats()['done_total'], 1)
+            self.assertEqual(jobs.stats()['failed_total'], 1)
+        finally:
+            jobs.shutdown()
+
+    def test_queue_is_bounded_and_queued_jobs_can_be_cancelled(self):
+        jobs = AnalysisJobs(square_after, max_workers=1, max_queued=3)
+        try:
+            running = jobs.submit({'value': 1, 'sleep': 1})
+            queued = [jobs.submit({'value': value}) for value in [2, 3]]
+            with self.assertRaises(JobQueueFull):
+                jobs.submit({'value': 4})
+            self.assertEqual(jobs.stats()['queued'] + jobs.stats()['running'], 3)
+
+            self.assertEqual(jobs.cancel(queued[1])['status'], 'cancelled')
+            self.assertEqual(self.wait_for(jobs, running)['result'], 1)
+            self.assertEqual(self.wait_for(jobs, queued[0])['result'], 4)
+            self.assertEqual(jobs.status(queued[1])['status'], 'cancelled')
+            self.assertIsNone(jobs.status('unknown'))
+
+            # A cached result is recorded as a finished job without using a worker
+            self.assertEqual(jobs.status(jobs.submit({'value': 5}, result=25))['result'], 25)
+        finally:
+            jobs.shutdown()
+
+    def test_running_jobs_keep_their_slot_until_their_worker_is_done(self):
+        finished = []
+        jobs = AnalysisJobs(square_after, max_workers=1, max_queued=1, on_done=lambda result, context: finished.append(result))
+        try:
+            running = jobs.submit({'value': 1, 'sleep': 1})
+            deadline = time.time() + 30
+            while jobs.status(running)['status'] != 'running' and time.time() < deadline:
+                time.sleep(0.02)
+
+            self.assertEqual(jobs.cancel(running)['status'], 'cancelling')
+            self.assertEqual(jobs.stats()['cancelling'], 1)
+            with self.assertRaises(JobQueueFull):
+                jobs.submit({'value': 2})
+
+            self.assertEqual(self.wait_for(jobs, running)['status'], 'cancelled')
+            self.assertNotIn('result', jobs.status(running))
+            self.assertEqual(finished, [])
+            self.assertEqual(jobs.stats()['cancelled_total'], 1)
+            self.assertEqual(self.wait_for(jobs, jobs.submit({'value': 2}))['result'], 4)
+        finally:
+            jobs.shutdown()
+
+    def test_job_endpoints_match_synchronous_analysis(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        client = app_module.app.test_client()
+        history = generate_rows(300, months=6, categories=5, seed=51, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(40, months=1, categories=5, seed=52, end='2025-02-01').drop(columns='user_id')
+        payload = {
+            'password': 'test_password',
+            'expenses': to_payload_rows(current),
+            'all_expenses': to_payload_rows(history),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 0,
+            'total_spent': float(current['amount'].sum())
+        }
+        headers = {'X-Flask-Password': 'test_password'}
+        app_module.result_cache.invalidate()
+
+        try:
+            response = client.post('/analysis/jobs', json=payload)
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()['job_id']
+            self.assertEqual(response.headers['Location'], f'/analysis/jobs/{job_id}')
+
+            self.assertEqual(client.get(f'/analysis/jobs/{job_id}').status_code, 401)
+            job = self.wait_for(app_module.analysis_jobs, job_id)
+            self.assertEqual(client.get(f'/analysis/jobs/{job_id}', headers=headers).get_json(), json.loads(json.dumps(job)))
+            self.assertEqual(job['status'], 'done')
+
+            # The finished job filled the result cache, so the synchronous request returns the same analysis
+            hits = app_module.result_cache.stats()['hits']
+            self.assertEqual(client.post('/analysis', json=payload).get_json(), job['result'])
+            self.assertEqual(app_module.result_cache.stats()['hits'], hits + 1)
+
+            self.assertEqual(client.get('/analysis/jobs', headers=headers).get_json()['done_total'], 1)
+            self.assertEqual(client.delete('/analysis/jobs/unknown', headers=headers).status_code, 404)
+            self.assertEqual(client.post('/analysis/jobs', json=dict(payload, total_spent=0)).status_code, 400)
+        finally:
+            app_module.analysis_jobs.shutdown()
+            del os.environ['FLASK_PASSWORD']
+
+
+class TestBatchAnalysis(unittest.TestCase):
+    # Test the in-process analyze() API and the offline batch runner built on it
+
+    def setUp(self):
+        self.payloads = []
+        for user_id in range(5):
+            history = generate_rows(200, months=6, categories=5, seed=60 + user_id, end='2025-01-01').drop(columns='user_id')
+            current = generate_rows(30, months=1, categories=5, seed=70 + user_id, end='2025-02-01').drop(columns='user_id')
+            self.payloads.append({
+                'user_id': user_id,
+                'expenses': to_payload_rows(current),
+                'all_expenses': to_payload_rows(history),
+                'categories': [{'name': name, 'priority': 1} for name in sorted(current['category'].unique())],
+                'monthly_budget': 50000,
+                'goal_amount': 1000,
+                'total_spent': float(current['amount'].sum())
+            })
+        self.invalid = {'user_id': 99, 'expenses': [], 'categories': [], 'monthly_budget': 1, 'goal_amount': 0, 'total_spent': 0, 'all_expenses': []}
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def test_analyze_matches_the_route(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        from app import app
+        response = app.test_client().post('/analysis', json=dict(self.payloads[0], password='test_password'))
+        self.assertEqual(analysis_service.analyze(self.payloads[0]), response.get_json())
+        with self.assertRaises(ValueError):
+            analysis_service.analyze(self.invalid)
+        del os.environ['FLASK_PASSWORD']
+
+    def test_workers_keep_no_per_user_state(self):
+        payload = dict(self.payloads[1], user_id='stateless-user')
+        user = analysis_service.user_fingerprint(payload)
+        expected = analysis_service.analyze(payload)
+        analysis_service.analysis_states.invalidate(user)
+        analysis_service.spend_indexes.invalidate(user)
+
+        self.assertEqual(analysis_service.analyze(payload, save_state=False), expected)
+        self.assertIsNone(analysis_service.analysis_states.get(user))
+        self.assertEqual(analysis_service.spend_indexes.invalidate(user), 0)
+
+    def test_jsonl_dump_is_analyzed_in_order_on_a_process_pool(self):
+        input_path = os.path.join(self.work_dir.name, 'payloads.jsonl')
+        with open(input_path, 'w') as f:
+            for payload in self.payloads[:3] + [self.invalid] + self.payloads[3:]:
+                f.write(json.dumps(payload) + '\n')
+
+        expected = [analysis_service.analyze(payload) for payload in self.payloads]
+        for workers in ['1', '2']:
+            output_path = os.path.join(self.work_dir.name, f'results-{workers}.jsonl')
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertEqual(batch_analysis.main([input_path, output_path, '--workers', workers, '--chunk-size', '2']), 1)
+            summary = json.loads(output.getvalue())
+
+            with open(output_path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([record['user_id'] for record in records], [0, 1, 2, 99, 3, 4])
+            self.assertIn('Total spent', records[3]['error'])
+            self.assertEqual([record['result'] for record in records if 'result' in record], expected)
+            self.assertEqual((summary['users'], summary['errors']), (6, 1))
+            self.assertGreater(summary['users_per_second'], 0)
+            self.assertIn('build_frames', summary['stage_seconds'])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow not installed')
+    def test_parquet_dump(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        input_path = os.path.join(self.work_dir.name, 'payloads.parquet')
+        pq.write_table(pa.Table.from_pylist(self.payloads), input_path)
+
+        self.assertEqual(list(batch_analysis.read_payloads(input_path)), self.payloads)
+        summary = batch_analysis.run_batch(input_path, os.path.join(self.work_dir.name, 'results.jsonl'), workers=1)
+        self.assertEqual((summary['users'], summary['errors']), (5, 0))
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+
+class TestSharedFrames(unittest.TestCase):
+    # Test the shared memory handoff of expense columns to worker processes
+
+    def setUp(self):
+        self.history = generate_rows(3000, months=8, categories=6, seed=81, end='2025-01-01').drop(columns='user_id')
+        self.current = generate_rows(60, months=1, categories=6, seed=82, end='2025-02-01').drop(columns='user_id')
+
+    def test_attached_frame_is_a_view_of_the_segment(self):
+        with SharedExpenses(AnalysisContext(self.history), 'history') as shared:
+            self.assertIn(shared.name, shared_frames.live_segments())
+            with AttachedExpenses(shared.descriptor) as attached:
+                buffer = np.ndarray(shared.segment.size, dtype=np.uint8, buffer=attached.segment.buf)
+                self.assertTrue(np.shares_memory(attached.frame['amount'].to_numpy(), buffer))
+                self.assertTrue(np.shares_memory(attached.frame['date'].to_numpy(), buffer))
+                self.assertTrue(np.shares_memory(attached.frame['category'].cat.codes.to_numpy(), buffer))
+                self.assertEqual(shared_frames.attached_segments(), {shared.name: 1})
+
+                pd.testing.assert_series_equal(attached.frame['amount'], self.history['amount'].reset_index(drop=True), check_names=False)
+                self.assertEqual(list(attached.frame['category'].astype(object)), list(self.history['category']))
+                self.assertEqual(attached.context.month_span(), AnalysisContext(self.history).month_span())
+
+        self.assertEqual(shared_frames.live_segments(), {})
+        self.assertEqual(shared_frames.attached_segments(), {})
+        self.assertFalse(os.path.exists(os.path.join(shared_frames.SHM_DIR, shared.name)))
+
+    def test_worker_tasks_match_in_process_results(self):
+        expected_predictions = {}
+        category_linear_regression(self.history, expected_predictions)
+        expected_labels = []
+        Rule_Based_labeling(self.history, expected_labels)
+        expected_insights = []
+        analyze_spending_deviations(self.current, self.history, expected_insights)
+
+        with SharedExpenses(AnalysisContext(self.history)) as history, SharedExpenses(AnalysisContext(self.current)) as current:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                predictions = pool.submit(shared_frames.category_predictions_task, history.descriptor).result()
+                labels = pool.submit(shared_frames.importance_labels_task, history.descriptor).result()
+                insights = pool.submit(shared_frames.deviation_insights_task, current.descriptor, history.descriptor).result()
+
+        self.assertEqual(predictions, expected_predictions)
+        self.assertEqual(labels, expected_labels)
+        self.assertEqual(insights, expected_insights)
+
+    def test_analysis_with_process_workers_matches_threads(self):
+        payload = {
+            'expenses': to_payload_rows(self.current),
+            'all_expenses': to_payload_rows(self.history),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(self.current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 1000,
+            'total_spent': float(self.current['amount'].sum())
+        }
+        expected = analysis_service.analyze(payload)
+
+        workers = analysis_service.ANALYSIS_PROCESS_WORKERS
+        analysis_service.ANALYSIS_PROCESS_WORKERS = 1
+        try:
+            self.assertEqual(analysis_service.analyze(payload), expected)
+        finally:
+            analysis_service.ANALYSIS_PROCESS_WORKERS = workers
+            if analysis_service.stage_processes is not None:
+                analysis_service.stage_processes.shutdown()
+                analysis_service.stage_processes = None
+        self.assertEqual(shared_frames.live_segments(), {})
+
+    def test_leaked_and_orphaned_segments_are_detected(self):
+        shared = SharedExpenses(AnalysisContext(self.current), 'leaked')
+        with self.assertLogs('shared_frames', level='WARNING') as logs:
+            shared_frames._release_leaked_segments()
+        self.assertIn('leaked', logs.output[0])
+        shared.close()
+
+        # A segment named after a process that no longer exists
+        child = subprocess.Popen(['true'])
+        child.wait()
+        orphan = shared_memory.SharedMemory(name=f"{shared_frames.SEGMENT_PREFIX}{child.pid}_test", create=True, size=8)
+        orphan.close()
+        # Its creator crashed, so nothing tracks it any more
+        resource_tracker.unregister(orphan._name, 'shared_memory')
+        self.assertIn(orphan.name.lstrip('/'), shared_frames.orphaned_segments())
+        self.assertIn(orphan.name.lstrip('/'), shared_frames.remove_orphaned_segments())
+        self.assertNotIn(orphan.name.lstrip('/'), shared_frames.orphaned_segments())
+
+
+class TestBatchBusinessLogic(unittest.TestCase):
+    # Test that the multi-user batch variants give every user exactly the single-user results
+
+    def setUp(self):
+        expenses = generate_expenses(users=40, months=1, categories=6, expenses_per_day=2, seed=23, end='2025-03-01')
+        # Users whose month stops on different days, one with a single weekday, rows shuffled across users
+        last_day = 3 + expenses['user_id'].astype(int) % 25
+        expenses = expenses[expenses['date'].dt.day <= last_day]
+        single_day = expenses[(expenses['user_id'] == 1) & (expenses['date'].dt.day == 1)]
+        expenses = pd.concat([expenses[expenses['user_id'] != 1], single_day])
+        self.expenses = expenses.sample(frac=1, random_state=3).reset_index(drop=True)
+
+    def test_predictive_insights_match(self):
+        predicted = batch_predictive_insights(self.expenses)
+        self.assertEqual(len(predicted), self.expenses['user_id'].nunique())
+        for user_id, expenses in self.expenses.groupby('user_id'):
+            self.assertEqual(predicted[user_id], predictive_insights(expenses.drop(columns='user_id')))
+
+    def test_day_of_week_analysis_matches(self):
+        insights = batch_day_of_week_analysis(self.expenses)
+        for user_id, expenses in self.expenses.groupby('user_id'):
+            expected = []
+            day_of_week_analysis(expenses.drop(columns='user_id'), expected)
+            self.assertEqual(insights[user_id], expected)
+        self.assertEqual(insights[1], [])
+
+    def test_assign_limits_match(self):
+        rng = np.random.default_rng(5)
+        categories = pd.DataFrame({
+            'user_id': np.repeat(['a', 'b', 'c'], 4),
+            'name': np.tile(['Food', 'Rent', 'Fun', 'Travel'], 3),
+            'priority': rng.integers(1, 5, 12),
+        }).sample(frac=1, random_state=1).reset_index(drop=True)
+        allowed_spending = {'a': 1000.0, 'b': 2345.67, 'c': 0.0}
+
+        limits = batch_assign_limits(categories, allowed_spending)
+        self.assertEqual(limits['name'].tolist(), categories['name'].tolist())
+        for user_id, rows in categories.groupby('user_id'):
+            expected = assign_limits(rows[['name', 'priority']].copy(), allowed_spending[user_id])
+            self.assertEqual(limits[limits['user_id'] == user_id]['limit'].tolist(), expected['limit'].tolist())
+
+    def test_empty_input(self):
+        self.assertEqual(batch_predictive_insights(self.expenses.iloc[:0]), {})
+        self.assertEqual(batch_day_of_week_analysis(self.expenses.iloc[:0]), {})
+        self.assertEqual(len(batch_assign_limits(pd.DataFrame({'user_id': [], 'name': [], 'priority': []}), {})), 0)
+
+
+class TestSerialization(unittest.TestCase):
+    # Test the NumPy-aware response encoder and the response sections built without iterrows/to_dict
+
+    def test_dumps_numpy_values(self):
+        value = {'b': np.float64(1.25), 'a': np.int64(3), 'flag': np.bool_(True), 'values': np.array([1.5, 2.0]), 7: 'int key'}
+        encoded = serialization.dumps(value)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), {'a': 3, 'b': 1.25, 'flag': True, 'values': [1.5, 2.0], '7': 'int key'})
+        self.assertLess(encoded.index(b'"a"'), encoded.index(b'"b"'))
+        self.assertEqual(json.loads(serialization.dumps([np.float32(0.5), np.int32(-2)])), [0.5, -2])
+        with self.assertRaises(TypeError):
+            serialization.dumps({'value': object()})
+
+    def test_records_match_to_dict(self):
+        frame = assign_limits(pd.DataFrame({'name': ['Food', 'Rent', 'Fun'], 'priority': [1, 2, 3]}), 1234.5)
+        self.assertEqual(serialization.records(frame), frame.to_dict(orient='records'))
+        self.assertEqual(serialization.records(frame.iloc[:0]), [])
+
+    def test_jsonify_uses_fast_provider(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        from app import app
+        self.assertIsInstance(app.json, serialization.FastJSONProvider)
+        with app.app_context():
+            response = app.json.response({'total': np.float64(10.5), 'count': np.int64(2)})
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.get_data()), {'count': 2, 'total': 10.5})
+
+    def test_clustering_order_matches_sort_values(self):
+        # More categories than numpy's insertion sort handles, so the tie order of the quicksort matters
+        expenses = generate_rows(3000, months=2, categories=40, seed=11).drop(columns='user_id')
+        spending_clustering = []
+        spending_kmeans_clustering(expenses, spending_clustering)
+
+        total_spent = expenses.groupby('category')['amount'].sum().reset_index(name='total_spent')
+        _, total_spent['spending_group'] = cluster_labels_1d(total_spent['total_spent'])
+        expected = total_spent.sort_values(by='spending_group', key=lambda x: x.map({'High': 1, 'Moderate': 2, 'Low': 3}))
+        self.assertEqual(spending_clustering[0]['spending_group'],
+                         [{'category': category, 'spending_group': group} for category, group in zip(expected['category'], expected['spending_group'])])
+
+
+class TestCompressedTransport(unittest.TestCase):
+    # Test gzip/zstd request bodies, the decompressed size cap and Accept-Encoding negotiated responses
+
+    def setUp(self):
+        os.environ['FLASK_PASSWORD'] = 'test_password'
+        import app as app_module
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+        self.original_cache = app_module.result_cache
+        app_module.result_cache = ResultCache(max_entries=0)
+
+        history = generate_rows(600, months=6, categories=5, seed=81, end='2025-01-01').drop(columns='user_id')
+        current = generate_rows(60, months=1, categories=5, seed=82, end='2025-02-01').drop(columns='user_id')
+        self.body = json.dumps({
+            'password': 'test_password',
+            'expenses': to_payload_rows(current),
+            'all_expenses': to_payload_rows(history) + to_payload_rows(current),
+            'categories': [{'name': name, 'priority': 1} for name in sorted(current['category'].unique())],
+            'monthly_budget': 50000,
+            'goal_amount': 1000,
+            'total_spent': float(current['amount'].sum())
+        }).encode('utf-8')
+
+    def tearDown(self):
+        self.app_module.result_cache = self.original_cache
+
+    def post(self, data, **headers):
+        return self.client.post('/analysis', data=data, content_type='application/json', headers=headers)
+
+    def test_gzip_request_and_response(self):
+        plain = self.post(self.body)
+        self.assertEqual(plain.status_code, 200)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        compressed = self.post(gzip.compress(self.body), **{'Content-Encoding': 'gzip', 'Accept-Encoding': 'br, gzip;q=0.8'})
+        self.assertEqual(compressed.status_code, 200)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(compressed.data), len(plain.data))
+        self.assertEqual(json.loads(gzip.decompress(compressed.data)), plain.get_json())
+
+        # Refused encodings and small responses are sent as they are
+        self.assertNotIn('Content-Encoding', self.post(self.body, **{'Accept-Encoding': 'gzip;q=0'}).headers)
+        small = self.post(gzip.compress(b'{}'), **{'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'})
+        self.assertEqual(small.status_code, 401)
+        self.assertNotIn('Content-Encoding', small.headers)
+
+    @unittest.skipUnless(transport.zstandard is not None, "zstandard is not installed")
+    def test_zstd_request_and_response(self):
+        import zstandard
+        plain = self.post(self.body)
+        compressed = self.post(zstandard.ZstdCompressor().compress(self.body), **{'Content-Encoding': 'zstd', 'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'zstd')
+        self.assertEqual(json.loads(zstandard.ZstdDecompressor().decompress(compressed.data)), plain.get_json())
+
+    def test_invalid_bodies(self):
+        self.assertEqual(self.post(b'not gzip', **{'Content-Encoding': 'gzip'}).status_code, 400)
+        self.assertEqual(self.post(gzip.compress(self.body)[:-20], **{'Content-Encoding': 'gzip'}).status_code, 400)
+        self.assertEqual(self.post(self.body, **{'Content-Encoding': 'br'}).status_code, 415)
+        if transport.zstandard is None:
+            self.assertEqual(self.post(self.body, **{'Content-Encoding': 'zstd'}).status_code, 415)
+
+    def test_decompressed_size_cap(self):
+        original = self.app_module.MAX_DECOMPRESSED_BODY_BYTES
+        self.app_module.MAX_DECOMPRESSED_BODY_BYTES = len(self.body)
+        try:
+            self.assertEqual(self.post(gzip.compress(self.body), **{'Content-Encoding': 'gzip'}).status_code, 200)
+            self.assertEqual(self.post(gzip.compress(self.body + b' '), **{'Content-Encoding': 'gzip'}).status_code, 413)
+            # A body that compresses a thousandfold is stopped at the cap, not expanded in full
+            response = self.post(gzip.compress(b' ' * (16 * 1024 * 1024)), **{'Content-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 413)
+        finally:
+            self.app_module.MAX_DECOMPRESSED_BODY_BYTES = original
+
+    def test_compression_metrics(self):
+        self.post(gzip.compress(self.body), **{'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'})
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        for line in ['http_compression_saved_bytes_count{codec="request_gzip"}', 'http_compression_saved_bytes_count{codec="response_gzip"}',
+                     'http_compression_cpu_seconds_count{codec="request_gzip"}', 'http_compression_cpu_seconds_count{codec="response_gzip"}']:
+            self.assertIn(line, metrics)
+
+
 if __name__ == '__main__':
     # Set up test environment
     os.environ['FLASK_PASSWORD'] = 'test_password'
@@ -687,7 +2629,29 @@ if __name__ == '__main__':
         TestBusinessLogicMeaningful,
         TestMLModelsAccuracy,
         TestFlaskEndpointsRealWorld,
-        TestEdgeCasesAndValidation
+        TestBatchLabelingEndpoint,
+        TestEdgeCasesAndValidation,
+        TestRollupStore,
+        TestForecastStore,
+        TestHistoryStore,
+        TestAnomalyScoring,
+        TestResultCache,
+        TestStartupReadiness,
+        TestColumnarPayloads,
+        TestChatLLMClient,
+        TestStageMetrics,
+        TestBenchmarkSuite,
+        TestSpendIndex,
+        TestAnalysisContext,
+        TestStageScheduler,
+        TestLatencyBudget,
+        TestAnalysisDelta,
+        TestAnalysisJobs,
+        TestBatchAnalysis,
+        TestSharedFrames,
+        TestBatchBusinessLogic,
+        TestSerialization,
+        TestCompressedTransport
     ]
     
     loader = unittest.TestLoader()
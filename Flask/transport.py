@@ -0,0 +1,124 @@
+import gzip
+import io
+import os
+import time
+import zlib
+from werkzeug.wsgi import get_input_stream
+
+from columnar import UnsupportedPayload
+from metrics import COMPRESSION_CPU_SECONDS, COMPRESSION_SAVED_BYTES
+
+# zstd needs the optional 'zstandard' package; without it only gzip is accepted and offered
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors of a corrupt or truncated compressed body
+DECODE_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Responses are compressed from this size on, at these levels (gzip 1-9, zstd 1-22)
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", 6))
+ZSTD_LEVEL = int(os.getenv("RESPONSE_ZSTD_LEVEL", 3))
+
+CHUNK_BYTES = 64 * 1024
+
+
+# Raised when a decompressed request body goes over the size cap
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def response_encodings():
+    return ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+
+# Counts the compressed bytes read from the request stream
+class _CountingReader(io.RawIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+def _decompressing_reader(encoding, stream):
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedPayload("zstd request bodies require the 'zstandard' package")
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise UnsupportedPayload(f"Unsupported content encoding: {encoding}")
+
+
+# Decompress a gzip/zstd request body (Content-Encoding) chunk by chunk, stopping as soon as it grows past max_bytes,
+# and hand the plain body to the rest of the request, which then reads it as if it had been sent uncompressed.
+# Has to run before anything reads request.stream; returns (encoding, compressed bytes, decompressed bytes), or None
+def decompress_request(request, max_bytes):
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+
+    started = time.thread_time()
+    source = _CountingReader(get_input_stream(request.environ, max_content_length=request.max_content_length))
+    reader = _decompressing_reader(encoding, source)
+    # Chunks are written straight into the stream the rest of the request reads, so the body is never copied whole
+    body = io.BytesIO()
+    size = 0
+    try:
+        while True:
+            chunk = reader.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            size += body.write(chunk)
+            if size > max_bytes:
+                raise PayloadTooLarge(f"Decompressed request body is larger than {max_bytes} bytes")
+    except DECODE_ERRORS as e:
+        raise ValueError(f"Invalid {encoding} request body: {e}")
+    body.seek(0)
+
+    request.environ['wsgi.input'] = body
+    request.environ['CONTENT_LENGTH'] = str(size)
+    request.environ.pop('HTTP_CONTENT_ENCODING', None)
+
+    COMPRESSION_CPU_SECONDS.observe(f'request_{encoding}', time.thread_time() - started)
+    COMPRESSION_SAVED_BYTES.observe(f'request_{encoding}', size - source.bytes_read)
+    return encoding, source.bytes_read, size
+
+
+def _compress(encoding, data):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+# Compress a response body with the best encoding the client accepts (Accept-Encoding, zstd preferred on ties).
+# Streamed, already encoded and small responses are left alone
+def compress_response(request, response, min_bytes=RESPONSE_COMPRESS_MIN_BYTES):
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(response_encodings())
+    if encoding is None or response.content_length is None or response.content_length < min_bytes:
+        return response
+
+    started = time.thread_time()
+    data = response.get_data()
+    compressed = _compress(encoding, data)
+    COMPRESSION_CPU_SECONDS.observe(f'response_{encoding}', time.thread_time() - started)
+    if len(compressed) >= len(data):
+        return response
+
+    COMPRESSION_SAVED_BYTES.observe(f'response_{encoding}', len(data) - len(compressed))
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response